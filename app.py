@@ -3,14 +3,29 @@
     the MongoDB database.
 """
 import os
+import atexit
+import cProfile
+import functools
+import hashlib
+import sys
+import threading
+import time
 import uuid
-import requests
-from bson import json_util
+from datetime import datetime, timezone
+from bson import ObjectId
+from bson.errors import InvalidId
 from dotenv import load_dotenv
-from database import connection
+from pymongo.errors import PyMongoError
+from collections import OrderedDict
+from database import (connection, indexes, metrics, queries, revisions,
+                      serialization, versions)
+from news_crawler.frontier import FRONTIER_COLLECTION, URLFrontier
+from news_crawler.jobs import JOBS_COLLECTION, QUEUED, CrawlJobs
+from news_crawler.logs import QueuedLogging
 from flask_sqlalchemy import SQLAlchemy
-from flask import (Flask, make_response,
-                   request, jsonify)
+from sqlalchemy import inspect, text
+from flask import (Flask, Response, g, make_response,
+                   request, jsonify, url_for)
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_jwt_extended import (create_access_token, create_refresh_token,
                                 jwt_required, get_jwt, JWTManager)
@@ -21,11 +36,70 @@ load_dotenv()
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv("SECRET_KEY")
 app.config['JWT_SECRET_KEY'] = os.getenv("JWT_SECRET_KEY")
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("SQLALCHEMY_DATABASE_URI",
+                                                  'sqlite:///app.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_BLACKLIST_ENABLED'] = True
 app.config['JWT_BLACKLIST_TOKEN_CHECKS'] = ['access', 'refresh']
 app.config["JWT_ALGORITHM"] = "HS256"
+# pagination of the /api endpoints: default and maximum page size, and how
+# many documents are read from MongoDB per batch in streaming mode
+app.config['API_PAGE_SIZE'] = int(os.getenv("API_PAGE_SIZE", 100))
+app.config['API_MAX_PAGE_SIZE'] = int(os.getenv("API_MAX_PAGE_SIZE", 1000))
+app.config['API_STREAM_BATCH_SIZE'] = int(os.getenv("API_STREAM_BATCH_SIZE",
+                                                    500))
+# how often each worker reads the tokens revoked by the other workers, and
+# deletes the revoked tokens that have expired, in seconds
+app.config['JWT_REVOCATION_REFRESH_SECONDS'] = float(
+    os.getenv("JWT_REVOCATION_REFRESH_SECONDS", 1))
+app.config['JWT_REVOCATION_PRUNE_SECONDS'] = float(
+    os.getenv("JWT_REVOCATION_PRUNE_SECONDS", 600))
+# cache of the /api responses of each worker: maximum number of responses
+# and total size in bytes, time to live and how often the version of the
+# articles collection is read from MongoDB, in seconds
+app.config['API_CACHE_SIZE'] = int(os.getenv("API_CACHE_SIZE", 256))
+app.config['API_CACHE_MAX_BYTES'] = int(os.getenv("API_CACHE_MAX_BYTES",
+                                                  64 * 1024 * 1024))
+app.config['API_CACHE_TTL'] = float(os.getenv("API_CACHE_TTL", 300))
+app.config['API_CACHE_VERSION_SECONDS'] = float(
+    os.getenv("API_CACHE_VERSION_SECONDS", 1))
+# responses smaller than this are not compressed, in bytes
+app.config['API_COMPRESS_MIN_BYTES'] = int(os.getenv("API_COMPRESS_MIN_BYTES",
+                                                     1024))
+# at most CRAWL_MAX_JOBS crawls run at a time, the other jobs are queued.
+# A running job that did not report its progress for CRAWL_JOB_STALE_SECONDS
+# is considered lost
+app.config['CRAWL_MAX_JOBS'] = int(os.getenv("CRAWL_MAX_JOBS", 1))
+app.config['CRAWL_JOB_STALE_SECONDS'] = int(
+    os.getenv("CRAWL_JOB_STALE_SECONDS", 120))
+# profile one request out of API_PROFILE_SAMPLE with cProfile, 0 disables
+# it. Each worker writes its profile to API_PROFILE_DIR/api-<pid>.prof
+app.config['API_PROFILE_SAMPLE'] = int(os.getenv("API_PROFILE_SAMPLE", 0))
+app.config['API_PROFILE_DIR'] = os.getenv("API_PROFILE_DIR", "profiles")
+# with API_LOG_QUEUE the logs of the app are written by a background thread,
+# as JSON lines with API_LOG_JSON, see news_crawler/logs.py
+app.config['API_LOG_QUEUE'] = os.getenv("API_LOG_QUEUE") in ('1', 'true')
+app.config['API_LOG_JSON'] = os.getenv("API_LOG_JSON") in ('1', 'true')
+api_logging = None
+
+
+def start_logging() -> None:
+    """ Moves the log handlers of the app behind the queue of API_LOG_QUEUE.
+        Under gunicorn it is called by each worker once forked (post_fork in
+        gunicorn.conf.py), the thread writing the logs would not survive the
+        fork of a preloaded app.
+    """
+    global api_logging
+    if not app.config['API_LOG_QUEUE'] or api_logging is not None:
+        return
+    api_logging = QueuedLogging(app.logger, app.logger.handlers,
+                                json_format=app.config['API_LOG_JSON'])
+    api_logging.start()
+    atexit.register(api_logging.stop)
+
+
+if 'gunicorn' not in sys.modules:
+    start_logging()
 
 jwt = JWTManager(app)
 db = SQLAlchemy(app)
@@ -38,8 +112,12 @@ class RevokedTokenModel(db.Model):
     """
 
     __tablename__ = 'revoked_tokens'
+    # the workers poll the table on its id, which must never be reused
+    __table_args__ = {'sqlite_autoincrement': True}
     id = db.Column(db.Integer, primary_key=True)
-    jti = db.Column(db.String(120))
+    jti = db.Column(db.String(120), index=True)
+    # the exp claim of the token, after which the row can be deleted
+    expires = db.Column(db.Integer, index=True)
 
     def add(self) -> None:
         """ Adds the token to the DB when called
@@ -48,10 +126,306 @@ class RevokedTokenModel(db.Model):
         db.session.commit()
 
     @classmethod
-    def is_jti_blacklisted(cls, jti):
-        # Query the created SQLAlchemy db containing the revoked tokens
-        query = cls.query.filter_by(jti=jti).first()
-        return bool(query)
+    def delete_expired(cls, now) -> int:
+        """ Deletes the revoked tokens that have expired, since they are
+            rejected anyway. Returns the number of deleted rows.
+            The row with the highest id is kept: a table created before
+            AUTOINCREMENT was set would otherwise give its id again to the
+            next revoked token, which the other workers would never read.
+        """
+        last_id = db.session.query(db.func.max(cls.id)).scalar()
+        deleted = cls.query.filter(cls.expires < now, cls.id != last_id) \
+                           .delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+class RevokedTokenCache():
+    """ This class keeps the revoked tokens that have not expired yet in
+        memory, so that checking a token does not query the db.
+        Each gunicorn worker has its own cache, and reads the rows added by
+        the other workers at most every JWT_REVOCATION_REFRESH_SECONDS, with
+        a query on the primary key that only returns the new rows.
+    """
+    def __init__(self) -> None:
+        self.revoked = {}
+        self.last_id = 0
+        self.next_refresh = 0
+        self.next_prune = 0
+        self._lock = threading.Lock()
+
+    def add(self, jti, expires) -> None:
+        """ Adds a token revoked by this worker, it is seen right away.
+        """
+        with self._lock:
+            self.revoked[jti] = expires
+
+    def refresh(self, now) -> None:
+        with self._lock:
+            # another thread may have refreshed while this one waited
+            if now < self.next_refresh:
+                return
+            rows = db.session.query(RevokedTokenModel.id,
+                                    RevokedTokenModel.jti,
+                                    RevokedTokenModel.expires) \
+                             .filter(RevokedTokenModel.id > self.last_id) \
+                             .order_by(RevokedTokenModel.id).all()
+            for row_id, jti, expires in rows:
+                if expires is None or expires >= now:
+                    self.revoked[jti] = expires
+                self.last_id = row_id
+            if now >= self.next_prune:
+                self.revoked = {jti: expires
+                                for jti, expires in self.revoked.items()
+                                if expires is None or expires >= now}
+                RevokedTokenModel.delete_expired(int(now))
+                self.next_prune = \
+                    now + app.config['JWT_REVOCATION_PRUNE_SECONDS']
+            self.next_refresh = \
+                now + app.config['JWT_REVOCATION_REFRESH_SECONDS']
+
+    def is_revoked(self, jti) -> bool:
+        now = time.time()
+        if now >= self.next_refresh:
+            self.refresh(now)
+        return jti in self.revoked
+
+
+revoked_tokens = RevokedTokenCache()
+
+
+class ResponseCache():
+    """ This class is a LRU cache of the serialized /api responses, keyed by
+        host, endpoint and query arguments. An entry is only valid for the
+        version of the articles collection it was built from, and the
+        pipeline bumps the version when it writes articles.
+    """
+    def __init__(self) -> None:
+        self.entries = OrderedDict()
+        self.size = 0
+        self.version = 0
+        self.next_version_check = 0
+        self._lock = threading.Lock()
+
+    def current_version(self) -> int:
+        """ The version of the articles collection, read from MongoDB at
+            most every API_CACHE_VERSION_SECONDS.
+        """
+        now = time.time()
+        if now >= self.next_version_check:
+            self.version = versions.get_version(_conf.get_client().BBC,
+                                                'articles')
+            self.next_version_check = \
+                now + app.config['API_CACHE_VERSION_SECONDS']
+        return self.version
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry['version'] != version or \
+                    entry['expires'] < time.time():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, version, response) -> dict:
+        body = response.get_data()
+        entry = {
+            'key': key,
+            'version': version,
+            'expires': time.time() + app.config['API_CACHE_TTL'],
+            'body': body,
+            'status': response.status_code,
+            'headers': list(response.headers.items()),
+            'etag': hashlib.sha1(body).hexdigest(),
+            'encoded': {},
+        }
+        if len(body) > app.config['API_CACHE_MAX_BYTES']:
+            return entry
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.size += len(body)
+            while len(self.entries) > app.config['API_CACHE_SIZE'] or \
+                    self.size > app.config['API_CACHE_MAX_BYTES']:
+                self._remove(next(iter(self.entries)))
+        return entry
+
+    def encoded(self, entry, encoding) -> bytes:
+        """ Returns the body of the entry compressed with encoding, which
+            is only computed once per entry and encoding.
+        """
+        body = entry['encoded'].get(encoding)
+        if body is None:
+            body = serialization.encode(entry['body'], encoding)
+            with self._lock:
+                if encoding not in entry['encoded']:
+                    entry['encoded'][encoding] = body
+                    if self.entries.get(entry['key']) is entry:
+                        self.size += len(body)
+        return body
+
+    def _remove(self, key) -> None:
+        entry = self.entries.pop(key)
+        self.size -= len(entry['body']) + sum(
+            len(body) for body in entry['encoded'].values())
+
+
+response_cache = ResponseCache()
+
+
+def cached_response(view):
+    """ Serves the view from the response cache when the same query was
+        answered for the current version of the articles. The responses
+        have a strong ETag, and 304 is returned if it matches If-None-Match.
+        Streamed responses are not cached.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.args.get("stream") in ('1', 'true'):
+            return view(*args, **kwargs)
+
+        # the next links of the pages are absolute, so they depend on the
+        # host the request was sent to
+        key = (request.url_root, request.endpoint,
+               tuple(sorted(request.args.items(multi=True))))
+        version = response_cache.current_version()
+        entry = response_cache.get(key, version)
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            # only the results and the "no results" are cached, not the
+            # wrong requests
+            if response.status_code not in (200, 404):
+                return response
+            entry = response_cache.put(key, version, response)
+
+        response = Response(entry['body'], entry['status'], entry['headers'])
+        etag = entry['etag']
+        encoding = serialization.negotiate_encoding(request.accept_encodings)
+        if encoding and is_compressible(response):
+            response.set_data(response_cache.encoded(entry, encoding))
+            response.headers['Content-Encoding'] = encoding
+            # each encoding of the body is a different representation
+            etag = f'{etag}-{encoding}'
+        response.vary.add('Accept-Encoding')
+        response.set_etag(etag)
+        return response.make_conditional(request)
+    return wrapper
+
+
+def is_compressible(response) -> bool:
+    """ Only the successful, not streamed and not yet encoded responses of
+        at least API_COMPRESS_MIN_BYTES are compressed.
+    """
+    return response.status_code == 200 \
+        and not response.is_streamed \
+        and not response.direct_passthrough \
+        and 'Content-Encoding' not in response.headers \
+        and len(response.get_data()) >= app.config['API_COMPRESS_MIN_BYTES']
+
+
+class RequestProfiler():
+    """ This class profiles one request out of sample with cProfile, and
+        adds them up in one profile per worker. The profile is written every
+        dump_every profiled requests and when the worker exits, to be read
+        with python -m news_crawler.tracing functions.
+        cProfile only profiles one thread, so a request is skipped while
+        another one is profiled.
+    """
+    def __init__(self, sample, directory, dump_every=100) -> None:
+        self.sample = sample
+        self.directory = directory
+        self.dump_every = dump_every
+        self.requests = 0
+        self.profiled = 0
+        self.profile = None
+        self.pid = None
+        self._lock = threading.Lock()
+
+    def start(self) -> bool:
+        """ Starts profiling the current request if it is sampled. Returns
+            whether it is profiled.
+        """
+        self.requests += 1
+        if self.requests % self.sample or not self._lock.acquire(False):
+            return False
+        if self.pid != os.getpid():
+            # a new profile in each forked worker
+            self.profile = cProfile.Profile()
+            self.pid = os.getpid()
+        self.profile.enable()
+        return True
+
+    def stop(self) -> None:
+        self.profile.disable()
+        self.profiled += 1
+        if self.profiled % self.dump_every == 0:
+            self.dump()
+        self._lock.release()
+
+    def dump(self) -> None:
+        if self.profile is None or self.pid != os.getpid():
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.profile.dump_stats(os.path.join(self.directory,
+                                             f'api-{self.pid}.prof'))
+
+
+profiler = None
+if app.config['API_PROFILE_SAMPLE'] > 0:
+    profiler = RequestProfiler(app.config['API_PROFILE_SAMPLE'],
+                               app.config['API_PROFILE_DIR'])
+    atexit.register(profiler.dump)
+
+
+@app.before_request
+def start_timer() -> None:
+    g.request_started = time.perf_counter()
+    g.profiled = profiler is not None and profiler.start()
+
+
+@app.teardown_request
+def stop_profiler(exception=None) -> None:
+    if g.get('profiled'):
+        profiler.stop()
+
+
+# registered before compress_response so that it runs after it, and the
+# compression is timed too
+@app.after_request
+def record_metrics(response) -> Response:
+    """ Counts the request and records its latency, per route. A streamed
+        response is timed until its first byte.
+    """
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.API_REQUESTS.labels(route, request.method,
+                                response.status_code).inc()
+    started = g.get('request_started')
+    if started is not None:
+        metrics.API_LATENCY.labels(route, request.method).observe(
+            time.perf_counter() - started)
+    return response
+
+
+@app.after_request
+def compress_response(response) -> Response:
+    """ Compresses the responses with brotli or gzip, depending on the
+        Accept-Encoding header of the request.
+    """
+    encoding = serialization.negotiate_encoding(request.accept_encodings)
+    if encoding is None or not is_compressible(response):
+        return response
+    response.set_data(serialization.encode(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
 
 
 class User():
@@ -76,116 +450,353 @@ class User():
 def create_tables():
     """ Before the first request, after the server is started,
         this functions creates the Tokens db in instance/app.db
+        and the indexes of the articles collection
     """
     db.create_all()
+    # app.db files created before the revoked tokens had an expiry and
+    # indexes are upgraded in place
+    columns = [c['name'] for c in inspect(db.engine)
+               .get_columns(RevokedTokenModel.__tablename__)]
+    if 'expires' not in columns:
+        db.session.execute(text(
+            'ALTER TABLE revoked_tokens ADD COLUMN expires INTEGER'))
+    db.session.execute(text('CREATE INDEX IF NOT EXISTS '
+                            + 'ix_revoked_tokens_jti ON revoked_tokens (jti)'))
+    db.session.execute(text('CREATE INDEX IF NOT EXISTS '
+                            + 'ix_revoked_tokens_expires ON revoked_tokens '
+                            + '(expires)'))
+    db.session.commit()
+    try:
+        indexes.ensure_article_indexes(_conf.get_client().BBC.articles)
+        revisions.ensure_revision_indexes(
+            _conf.get_client().BBC[revisions.REVISIONS_COLLECTION])
+        get_frontier().ensure_indexes()
+        get_jobs().ensure_indexes()
+    except PyMongoError as e:
+        app.logger.warning(f'Could not ensure the articles indexes: {e}')
+
+
+def get_frontier() -> URLFrontier:
+    """ The URL frontier crawled by the spider.
+    """
+    return URLFrontier(_conf.get_client().BBC[FRONTIER_COLLECTION])
+
+
+def get_jobs() -> CrawlJobs:
+    """ The crawl jobs started with /scrape.
+    """
+    return CrawlJobs(_conf.get_client().BBC[JOBS_COLLECTION],
+                     max_jobs=app.config['CRAWL_MAX_JOBS'],
+                     stale_seconds=app.config['CRAWL_JOB_STALE_SECONDS'])
 
 
 @jwt.token_in_blocklist_loader
-def check_if_token_in_blacklist(jwt_header, jwt_payload) -> RevokedTokenModel:
-    # returns whether the token is blackliset or not after checking in the db
-    # upon each request
+def check_if_token_in_blacklist(jwt_header, jwt_payload) -> bool:
+    # returns whether the token is blackliset or not after checking in the
+    # in-memory cache of the revoked tokens upon each request
     jti = jwt_payload['jti']
-    return RevokedTokenModel.is_jti_blacklisted(jti)
+    return revoked_tokens.is_revoked(jti)
+
+
+def stream_ndjson(cursor, batch_size):
+    """ Reads the cursor batch by batch and yields one NDJSON chunk per
+        batch, so only one batch is held in memory at a time.
+    """
+    lines = []
+    for document in cursor.batch_size(batch_size):
+        lines.append(serialization.dumps(document))
+        if len(lines) == batch_size:
+            yield b'\n'.join(lines) + b'\n'
+            lines = []
+    if lines:
+        yield b'\n'.join(lines) + b'\n'
+
+
+def get_limit(stream) -> int:
+    """ Returns the page size requested with the limit argument, capped by
+        API_MAX_PAGE_SIZE. In streaming mode there is no limit by default,
+        which is returned as 0.
+        Raises ValueError if limit is not a positive integer.
+    """
+    limit = request.args.get("limit")
+    if limit is None:
+        return 0 if stream else min(app.config['API_PAGE_SIZE'],
+                                    app.config['API_MAX_PAGE_SIZE'])
+    limit = int(limit)
+    if limit <= 0:
+        raise ValueError('limit must be positive')
+    if not stream:
+        limit = min(limit, app.config['API_MAX_PAGE_SIZE'])
+    return limit
+
+
+def page_response(documents, limit, cursor_of, not_found_message) -> Response:
+    """ Builds the JSON response of one page. documents holds up to limit+1
+        articles, the extra one only tells that there is a next page, whose
+        link uses cursor_of(last article of the page) as the after argument.
+    """
+    result = list(documents)
+    next_url = None
+    if len(result) > limit:
+        result = result[:limit]
+        next_args = request.args.to_dict()
+        next_args['after'] = cursor_of(result[-1])
+        next_url = url_for(request.endpoint, _external=True, **next_args)
+
+    if result:
+        # pretty-printing is only done on request, since it makes the
+        # responses bigger and slower to build
+        body = serialization.dumps({'data': result, 'next': next_url},
+                                   pretty=request.args.get("pretty") in
+                                   ('1', 'true'))
+        return make_response(body, 200, {'message': 'Success',
+                                         'Content-Type': 'application/json'})
+    else:
+        return make_response('Result not found', 404,
+                             {'message': not_found_message})
+
+
+def find_articles(query, not_found_message) -> Response:
+    """ Runs the query against the articles collection using keyset
+        pagination on _id. The request can pass:
+            limit: the page size, capped by API_MAX_PAGE_SIZE
+            after: the _id of the last article of the previous page
+            stream: 1 to get all the matching articles as NDJSON instead
+                    of one JSON page
+    """
+    args = request.args
+    after = args.get("after")
+    stream = args.get("stream") in ('1', 'true')
+    try:
+        limit = get_limit(stream)
+    except ValueError:
+        return make_response('limit must be a positive integer', 400,
+                             {'message': 'Wrong request format'})
+
+    if after:
+        try:
+            query = {"$and": [query, {"_id": {"$gt": ObjectId(after)}}]}
+        except InvalidId:
+            return make_response('after must be an article _id', 400,
+                                 {'message': 'Wrong request format'})
+
+    collection = _conf.get_client().BBC.articles
+    document_cursor = collection.find(query).sort("_id", 1)
+
+    if stream:
+        if limit:
+            document_cursor = document_cursor.limit(limit)
+        return Response(stream_ndjson(document_cursor,
+                                      app.config['API_STREAM_BATCH_SIZE']),
+                        200, mimetype='application/x-ndjson')
+
+    # one more article than the page size is read to know if there is a
+    # next page without running a count
+    return page_response(document_cursor.limit(limit + 1), limit,
+                         lambda doc: str(doc['_id']), not_found_message)
 
 
 @app.route('/submit-urls', methods=['POST'])
 @jwt_required()
 def submit():
-    urls = request.json[0]['urls']
+    # the urls are added to the frontier, the ones that were already
+    # submitted are skipped whatever their state
+    body = request.json[0]
+    urls = body.get('urls')
     if urls:
-        if not os.path.exists('urls.txt'):
-            os.mkdir('url.txt')
-
-        with open('urls.txt', 'w') as f:
-            for url in urls:
-                f.write(f'{url}\n')
-
-        return make_response('Saved URLs to urls.txt', 200,
-                             {'message': "Success"})
+        try:
+            priority = int(body.get('priority', 0))
+        except (TypeError, ValueError):
+            return make_response('priority must be an integer', 400,
+                                 {'message': 'Bad request'})
+        counts = get_frontier().submit(urls, priority)
+        return make_response(jsonify(counts), 200, {'message': "Success"})
     else:
         return make_response('No URLs were sent', 400,
                              {'message': 'Please send URLs'})
 
 
+@app.route('/frontier')
+@jwt_required()
+def frontier_status():
+    # the number of urls in each state of the frontier
+    return make_response(jsonify(get_frontier().counts()), 200,
+                         {'message': 'Success'})
+
+
+@app.route('/frontier/failures')
+@jwt_required()
+def frontier_failures():
+    # the failed urls per last status, retried later or given up on
+    report = get_frontier().failure_report()
+    for group in report:
+        for key in ('next_retry', 'last_failure'):
+            if group[key] is not None:
+                group[key] = group[key].replace(
+                    tzinfo=timezone.utc).isoformat()
+    return make_response(jsonify(report), 200, {'message': 'Success'})
+
+
 @app.route("/scrape")
 @jwt_required()
 def scrape():
-    params = {
-        'spider_name': 'news_crawler',
-        'start_requests': 'true'
-    }
-    response = requests.get('http://localhost:9080/crawl.json', params=params)
-    return make_response(f'{response}', 200,
-                         {'message': "Success"})
+    # the crawl runs in its own scrapy process, so the worker is free as
+    # soon as the job is queued. It starts at once if less than
+    # CRAWL_MAX_JOBS crawls are running. With ?refresh=1 the crawled URLs
+    # are fetched again, conditionally, only the ones crawled more than
+    # refresh_older_than hours ago if given
+    if request.args.get('refresh') in ('1', 'true'):
+        older_than = request.args.get('refresh_older_than')
+        if older_than is not None:
+            try:
+                older_than = float(older_than) * 3600
+            except ValueError:
+                older_than = -1
+            if not 0 <= older_than < float('inf'):
+                return make_response('refresh_older_than must be a number '
+                                     'of hours', 400,
+                                     {'message': 'Wrong request format'})
+        try:
+            get_frontier().refresh(older_than)
+        except PyMongoError as e:
+            app.logger.error(f'Could not refresh the frontier: {e}')
+            return make_response('MongoDB is unreachable', 503,
+                                 {'message': 'Service unavailable'})
+    jobs = get_jobs()
+    job = jobs.create()
+    jobs.dispatch()
+    return job_response(jobs, jobs.get(job['_id']), 202)
+
+
+@app.route("/jobs")
+@jwt_required()
+def list_jobs():
+    jobs = get_jobs()
+    jobs.dispatch()
+    return make_response(jsonify([job_summary(jobs, job)
+                                  for job in jobs.recent()]),
+                         200, {'message': 'Success'})
+
+
+@app.route("/jobs/<job_id>")
+@jwt_required()
+def job_status(job_id):
+    # the queued jobs are started from here too, in case the crawl that
+    # should have started them was lost
+    jobs = get_jobs()
+    jobs.dispatch()
+    job = jobs.get(job_id)
+    if job is None:
+        return make_response('Job not found', 404,
+                             {'message': 'Not found'})
+    return job_response(jobs, job, 200)
+
+
+@app.route("/jobs/<job_id>/cancel", methods=['POST'])
+@jwt_required()
+def cancel_job(job_id):
+    jobs = get_jobs()
+    job = jobs.cancel(job_id)
+    if job is None:
+        return make_response('Job not found', 404,
+                             {'message': 'Not found'})
+    jobs.dispatch()
+    return job_response(jobs, job, 202)
+
+
+def job_summary(jobs, job) -> dict:
+    """ The state and progress of a job, with its dates in ISO format.
+    """
+    summary = {'job_id': job['_id']}
+    for key in ('state', 'reason', 'created_at', 'started_at', 'finished_at',
+                'updated_at', 'cancel_requested', 'stats'):
+        value = job.get(key)
+        if value is not None:
+            # the dates are read from MongoDB as naive UTC datetimes
+            summary[key] = value.replace(tzinfo=timezone.utc).isoformat() \
+                if isinstance(value, datetime) else value
+    if job['state'] == QUEUED:
+        summary['queue_position'] = jobs.queue_position(job)
+    summary['status_url'] = url_for('job_status', job_id=job['_id'])
+    return summary
+
+
+def job_response(jobs, job, status) -> Response:
+    return make_response(jsonify(job_summary(jobs, job)), status,
+                         {'message': 'Success',
+                          'Location': url_for('job_status',
+                                              job_id=job['_id'])})
+
+
+@app.route('/health')
+def health():
+    # pings MongoDB through the worker's shared client, used by the
+    # load balancer / docker to check that the worker can serve reads
+    if _conf.ping():
+        return make_response('OK', 200, {'message': 'Success'})
+    return make_response('MongoDB is unreachable', 503,
+                         {'message': 'Service unavailable'})
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # the metrics of all the gunicorn workers and of the crawls they
+    # started, scraped by Prometheus
+    body, content_type = metrics.render()
+    return Response(body, 200, content_type=content_type)
 
 
 @app.route('/api/get-all')
 @jwt_required()
+@cached_response
 def get_all():
-
-    client = _conf.connect_to_DB()
-    db = client.BBC
-    collection = db.articles
-    document_cursor = collection.find()
-    result = list(document_cursor)
-    client.close()
-    if result:
-        return make_response(json_util.dumps({'data': result},
-                                             indent=4,
-                                             ensure_ascii=False),
-                             200, {'message': 'Success'})
-    else:
-        return make_response('Result not found', 404,
-                             {'message': 'Collection is empy'})
+    return find_articles({}, 'Collection is empy')
 
 
 @app.route('/api/filter-by-date')
 @jwt_required()
+@cached_response
 def filter_by_date():
+    """ Returns the articles created in a date range, given either as
+        from/to ISO dates or datetimes (any of the two can be omitted),
+        or as a year, year-month or year-month-day. Both are turned into a
+        range on the created_at.datetime index.
+    """
     args = request.args
     year = args.get("year")
     month = args.get("month")
     day = args.get("day")
-    if year and month and day:
-        query = {
-            "created_at.year": int(year),
-            "created_at.month": int(month),
-            "created_at.day": int(day)
-        }
-    elif year and month:
-        query = {
-            "created_at.year": int(year),
-            "created_at.month": int(month),
-        }
-    elif year:
-        query = {
-            "created_at.year": int(year),
-        }
-    else:
+    date_from = args.get("from")
+    date_to = args.get("to")
+    try:
+        if date_from or date_to:
+            query = queries.parse_date_bounds(date_from, date_to)
+        elif year:
+            query = queries.date_range(*queries.calendar_range(
+                int(year),
+                int(month) if month else None,
+                int(day) if month and day else None
+            ))
+        else:
+            raise ValueError('No date given')
+    except ValueError:
         return make_response(
-            'You can only search by: year, year-month, or year-month-day.',
+            'You can only search by: from-to, year, year-month, '
+            + 'or year-month-day.',
             400, {'message': 'Wrong request format'}
         )
 
-    client = _conf.connect_to_DB()
-    db = client.BBC
-    collection = db.articles
-    document_cursor = collection.find(query)
-    result = list(document_cursor)
-    client.close()
-    if result:
-        return make_response(json_util.dumps({'data': result},
-                                             indent=4,
-                                             ensure_ascii=False),
-                             200, {'message': 'Success'})
-    else:
-        return make_response('Result not found', 404,
-                             {'message': 'No records match the query'})
+    return find_articles(query, 'No records match the query')
 
 
 @app.route('/api/search-by-tags')
 @jwt_required()
+@cached_response
 def search_by_tags():
+    """ Returns the articles having any of the tags, or all of them with
+        mode=all. The tags are compared as slugs so the case and the
+        punctuation do not matter.
+    """
     args = request.args
     tags = args.get("tags")
     tags_list = tags.split(',') if tags else []
@@ -195,34 +806,25 @@ def search_by_tags():
             400, {'message': 'Wrong request format'}
         )
 
-    result = []
-
-    client = _conf.connect_to_DB()
-    db = client.BBC
-    collection = db.articles
-    for tag in tags_list:
-        query = {"tags": {
-                    '$regex': tag,
-                    '$options': 'i'
-                }
-            }
-        document_cursor = collection.find(query)
-        list_cursor = list(document_cursor)
-        [result.append(rec) for rec in list(list_cursor)]
-    client.close()
-    if result:
-        return make_response(json_util.dumps({'data': result},
-                                             indent=4,
-                                             ensure_ascii=False),
-                             200, {'message': 'Success'})
-    else:
-        return make_response('Result not found', 404,
-                             {'message': 'No records match the query'})
+    mode = args.get("mode", "any")
+    if mode not in ('any', 'all'):
+        return make_response('mode must be any or all', 400,
+                             {'message': 'Wrong request format'})
+
+    # one query on the tag_slugs multikey index, an article matching
+    # several tags is only returned once
+    query = queries.tag_search(tags_list, match_all=(mode == 'all'))
+    return find_articles(query, 'No records match the query')
 
 
 @app.route('/api/search-by-keywords')
 @jwt_required()
+@cached_response
 def search_by_keywords():
+    """ Full-text search on the article_text index. The articles are ranked
+        by relevance and each one is returned once. mode=all requires all
+        the keywords (AND), the default mode=any requires one of them (OR).
+    """
     args = request.args
     keywords = args.get("keywords")
     keywords_list = keywords.split(',') if keywords else []
@@ -231,30 +833,68 @@ def search_by_keywords():
             'Specify comma seperated values',
             400, {'message': 'Wrong request format'}
         )
+    mode = args.get("mode", "any")
+    if mode not in ('any', 'all'):
+        return make_response('mode must be any or all', 400,
+                             {'message': 'Wrong request format'})
 
-    result = []
-
-    client = _conf.connect_to_DB()
-    db = client.BBC
-    collection = db.articles
-    for keyword in keywords_list:
-        query = {"text": {
-                    '$regex': keyword,
-                    '$options': 'i'
-                }
-            }
-        document_cursor = collection.find(query)
-        list_cursor = list(document_cursor)
-        [result.append(rec) for rec in list(list_cursor)]
-    client.close()
-    if result:
-        return make_response(json_util.dumps({'data': result},
-                                             indent=4,
-                                             ensure_ascii=False),
-                             200, {'message': 'Success'})
+    stream = args.get("stream") in ('1', 'true')
+    try:
+        limit = get_limit(stream)
+        pipeline = queries.text_search_pipeline(
+            keywords_list, match_all=(mode == 'all'),
+            after=args.get("after"),
+            limit=(limit + 1 if not stream else limit)
+        )
+    except ValueError:
+        return make_response('limit or after is invalid', 400,
+                             {'message': 'Wrong request format'})
+
+    collection = _conf.get_client().BBC.articles
+    document_cursor = collection.aggregate(
+        pipeline, batchSize=app.config['API_STREAM_BATCH_SIZE'])
+
+    if stream:
+        return Response(stream_ndjson(document_cursor,
+                                      app.config['API_STREAM_BATCH_SIZE']),
+                        200, mimetype='application/x-ndjson')
+
+    return page_response(
+        document_cursor, limit,
+        lambda doc: queries.encode_score_cursor(doc['score'], doc['_id']),
+        'No records match the query')
+
+
+@app.route('/api/article-revisions')
+@jwt_required()
+@cached_response
+def article_revisions():
+    """ Returns the revision history of the article at url, from the latest
+        version to the first, or the article as it was at a revision with
+        revision=<number>.
+    """
+    args = request.args
+    url = args.get("url")
+    if not url:
+        return make_response('Specify the url of the article', 400,
+                             {'message': 'Wrong request format'})
+    db = _conf.get_client().BBC
+    try:
+        revision = int(args["revision"]) if "revision" in args else None
+    except ValueError:
+        return make_response('revision must be an integer', 400,
+                             {'message': 'Wrong request format'})
+    if revision is None:
+        result = revisions.history(db, url)
     else:
+        result = revisions.get_revision(db, url, revision)
+    if result is None:
         return make_response('Result not found', 404,
                              {'message': 'No records match the query'})
+    body = serialization.dumps({'data': result},
+                               pretty=args.get("pretty") in ('1', 'true'))
+    return make_response(body, 200, {'message': 'Success',
+                                     'Content-Type': 'application/json'})
 
 
 @app.route('/token/generate', methods=['POST'])
@@ -265,15 +905,12 @@ def token_generate():
         return make_response('Could not verify', 401,
                              {'WWW-Authenticate': 'Login required!'})
 
-    client = _conf.connect_to_DB()
-    db = client.BBC
-    collection = db.Users
+    collection = _conf.get_client().BBC.Users
     query = {
              "name": auth.username
              }
     document_cursor = collection.find(query)
     user = list(document_cursor)
-    client.close()
     if not user:
         return make_response('Could not verify', 401,
                              {'WWW-Authenticate': 'Login required!'})
@@ -295,10 +932,12 @@ def token_generate():
 @app.route('/token/revoke', methods=['POST'])
 @jwt_required()
 def token_revoke():
-    jti = get_jwt()['jti']
+    token = get_jwt()
+    jti = token['jti']
     try:
-        revoked_token = RevokedTokenModel(jti=jti)
+        revoked_token = RevokedTokenModel(jti=jti, expires=token.get('exp'))
         revoked_token.add()
+        revoked_tokens.add(jti, token.get('exp'))
         return {'message': 'Access token has been revoked'}
     except Exception as e:
         return {'message': 'Something went wrong'}, 500
@@ -307,9 +946,7 @@ def token_revoke():
 @app.route('/user/register', methods=['POST'])
 @jwt_required()
 def create_user():
-    client = _conf.connect_to_DB()
-    db = client.BBC
-    collection = db.Users
+    collection = _conf.get_client().BBC.Users
 
     data = request.get_json()
 
@@ -324,14 +961,11 @@ def create_user():
     document_cursor = collection.find(query)
 
     if list(document_cursor):
-        client.close()
         return make_response('Could not register', 409,
                              {"name": "name already exists!"})
 
     collection.insert_one(new_user)
 
-    client.close()
-
     return jsonify({'message': 'New user created!'})
 
 
@@ -0,0 +1,239 @@
+""" This module runs micro-benchmarks of the crawler and the API hot paths
+    on the local sample.html file, without network or database.
+
+    Usage:
+        python3 benchmark.py extractors [--pages 200]
+        python3 benchmark.py parse-pool [--corpus DIR] [--workers 1,2,4]
+        python3 benchmark.py serializers [--articles 1000]
+        python3 benchmark.py logging [--pages 20000]
+"""
+import argparse
+import glob
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from bson import json_util, ObjectId
+from scrapy.http import HtmlResponse
+from scrapy.selector import Selector
+from database import serialization
+from news_crawler.logs import EventLogger, QueuedLogging
+from news_crawler.extractors import extract_article
+from news_crawler.spiders.articles import EXTRACTORS, extract_page_body, \
+    process_response
+
+
+def _timeit(function, repeat) -> float:
+    """ Returns the number of calls per second of function.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return repeat / (time.perf_counter() - start)
+
+
+def bench_extractors(args) -> None:
+    """ Pages per second of each html extraction engine, with and without
+        parsing the html, which is the same for both engines, and of the
+        structured data path.
+    """
+    with open(args.sample, 'r') as file:
+        html = file.read()
+    parsed = Selector(text=html)
+
+    print(f"{'engine':<12}{'parse+extract':>16}{'extract only':>16}")
+    for name, extractor in EXTRACTORS.items():
+        # warm up, the css to xpath translations of parsel are cached
+        extractor(parsed)
+        total = _timeit(lambda: extractor(Selector(text=html)), args.pages)
+        extract = _timeit(lambda: extractor(parsed), args.pages)
+        print(f"{name:<12}{total:>11.1f} p/s{extract:>11.1f} p/s")
+
+    # the structured data path does not parse the html at all
+    with open(args.sample, 'rb') as file:
+        body = file.read()
+    structured = _timeit(
+        lambda: extract_article(HtmlResponse('https://www.bbc.com/news',
+                                             body=body, encoding='utf-8'),
+                                EXTRACTORS['lxml']),
+        args.pages)
+    print(f"{'structured':<12}{structured:>11.1f} p/s")
+
+
+def bench_parse_pool(args) -> None:
+    """ Pages per second of the parse pool used with ARTICLE_PARSE_PROCESSES
+        for each number of workers, on the saved pages of a directory or on
+        copies of sample.html.
+    """
+    if args.corpus:
+        paths = sorted(glob.glob(os.path.join(args.corpus, '*.html')))
+    else:
+        paths = [args.sample]
+    bodies = []
+    for path in paths:
+        with open(path, 'rb') as file:
+            bodies.append(file.read())
+    bodies = (bodies * (args.pages // len(bodies) + 1))[:args.pages]
+
+    print(f"{len(bodies)} pages, {os.cpu_count()} cpus, "
+          + f"extractor={args.extractor}, structured={args.structured}")
+    for workers in (int(w) for w in args.workers.split(',')):
+        with ProcessPoolExecutor(
+                workers,
+                mp_context=multiprocessing.get_context('spawn')) as pool:
+            # start the workers and import the spider before timing
+            list(pool.map(extract_page_body,
+                          ['https://www.bbc.com/news'] * workers,
+                          bodies[:workers], ['utf-8'] * workers,
+                          [args.extractor] * workers,
+                          [args.structured] * workers))
+            start = time.perf_counter()
+            list(pool.map(extract_page_body,
+                          ['https://www.bbc.com/news'] * len(bodies),
+                          bodies, ['utf-8'] * len(bodies),
+                          [args.extractor] * len(bodies),
+                          [args.structured] * len(bodies),
+                          chunksize=4))
+            elapsed = time.perf_counter() - start
+        print(f"{workers:>3} workers {len(bodies) / elapsed:>10.1f} p/s")
+
+
+def bench_serializers(args) -> None:
+    """ Time to build a page of the API and its size on the wire, with the
+        former json_util serializer and with orjson, compressed or not.
+    """
+    with open(args.sample, 'r') as file:
+        article = process_response(Selector(text=file.read()))
+    page = {'data': [dict(article, _id=ObjectId())
+                     for _ in range(args.articles)],
+            'next': None}
+
+    variants = {
+        'json_util indent=4': lambda: json_util.dumps(
+            page, indent=4, ensure_ascii=False).encode('utf-8'),
+        'orjson pretty': lambda: serialization.dumps(page, pretty=True),
+        'orjson': lambda: serialization.dumps(page),
+    }
+    compact = serialization.dumps(page)
+    for encoding in serialization.ENCODINGS:
+        variants[f'orjson + {encoding}'] = \
+            lambda encoding=encoding: serialization.encode(compact, encoding)
+
+    print(f"{args.articles} articles per page")
+    print(f"{'serializer':<20}{'time':>12}{'size':>14}")
+    for name, serialize in variants.items():
+        size = len(serialize())
+        elapsed = 1000 / _timeit(serialize, args.repeat)
+        print(f"{name:<20}{elapsed:>9.1f} ms{size / 1024:>11.1f} KiB")
+
+
+def _log_eager(logger, url) -> None:
+    # the lines each page logged before, formatted before the level check
+    logger.info(f"Getting {url}")
+    logger.info(f"GET {url} 200")
+    logger.info(f'Processing article from {url}')
+    logger.info(f"Inserting article from {url}" + " into MongoDB.")
+
+
+def _log_events(events, url) -> None:
+    events.info('request', 'Getting %s', url, url=url)
+    events.info('response', 'GET %s 200', url, url=url, status=200)
+    events.info('parse', 'Processing article from %s', url, url=url)
+    events.info('insert', 'Inserting article from %s into MongoDB.', url,
+                url=url)
+
+
+def bench_logging(args) -> None:
+    """ CPU time spent logging the INFO lines of a crawled page, written to
+        a file synchronously as before, and with the queued logging of
+        news_crawler/logs.py: by the thread of the crawl, which is the one
+        slowing the crawl down, and by all the threads, the background one
+        writing the queued records included.
+    """
+    urls = [f'https://www.bbc.com/news/world-{i}' for i in range(args.pages)]
+    variants = {
+        'sync f-strings': (_log_eager, None),
+        'sync events': (_log_events, None),
+        'queue': (_log_events, {}),
+        'queue json': (_log_events, {'json_format': True}),
+        'queue json 10%': (_log_events, {
+            'json_format': True,
+            'sample_rates': {'request': 0.1, 'response': 0.1,
+                             'parse': 0.1, 'insert': 0.1}}),
+        'level WARNING': (_log_events, None),
+    }
+
+    print(f"{args.pages} pages, 4 INFO lines per page")
+    print(f"{'logging':<16}{'crawl thread':>14}{'all threads':>14}"
+          + f"{'size':>12}")
+    for name, (log_page, queued) in variants.items():
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'crawler.log')
+            handler = logging.FileHandler(path)
+            handler.setFormatter(logging.Formatter(
+                '%(asctime)s [%(name)s] %(levelname)s: %(message)s'))
+            logger = logging.getLogger(f'benchmark.{name}')
+            logger.propagate = False
+            logger.setLevel(logging.WARNING if name == 'level WARNING'
+                            else logging.INFO)
+            logger.addHandler(handler)
+            logging_queue = None
+            if queued is not None:
+                logging_queue = QueuedLogging(logger, [handler],
+                                              queue_size=len(urls) * 4,
+                                              **queued)
+                logging_queue.start()
+
+            target = logger if log_page is _log_eager else EventLogger(logger)
+            start = time.thread_time()
+            cpu = time.process_time()
+            for url in urls:
+                log_page(target, url)
+            crawl = time.thread_time() - start
+            if logging_queue is not None:
+                logging_queue.stop()
+            cpu = time.process_time() - cpu
+            logger.removeHandler(handler)
+            handler.close()
+            size = os.path.getsize(path)
+        print(f"{name:<16}{crawl / len(urls) * 1e6:>9.1f} us/p"
+              + f"{cpu / len(urls) * 1e6:>9.1f} us/p"
+              + f"{size / 1024:>8.0f} KiB")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmarks of the crawler and the API')
+    parser.add_argument('--sample', default='sample.html')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    extractors = subparsers.add_parser('extractors')
+    extractors.add_argument('--pages', type=int, default=200)
+    extractors.set_defaults(run=bench_extractors)
+
+    parse_pool = subparsers.add_parser('parse-pool')
+    parse_pool.add_argument('--corpus', help='directory of saved pages')
+    parse_pool.add_argument('--pages', type=int, default=400)
+    parse_pool.add_argument('--workers', default='1,2,4')
+    parse_pool.add_argument('--extractor', default='lxml',
+                            choices=list(EXTRACTORS))
+    parse_pool.add_argument('--structured', action='store_true')
+    parse_pool.set_defaults(run=bench_parse_pool)
+
+    serializers = subparsers.add_parser('serializers')
+    serializers.add_argument('--articles', type=int, default=1000)
+    serializers.add_argument('--repeat', type=int, default=10)
+    serializers.set_defaults(run=bench_serializers)
+
+    logging_parser = subparsers.add_parser('logging')
+    logging_parser.add_argument('--pages', type=int, default=20000)
+    logging_parser.set_defaults(run=bench_logging)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -29,8 +29,33 @@ class MongoDBConfig(Config):
         self.__mongoDB_port = os.getenv("MONGODB_PORT")
         self.__mongoDB_host = os.getenv("MONGODB_HOST")
 
+        # connection pool settings, each gunicorn worker gets its own pool
+        # of this size. The timeouts are in milliseconds.
+        self.__pool_options = {
+            "maxPoolSize": int(os.getenv("MONGODB_MAX_POOL_SIZE", 50)),
+            "minPoolSize": int(os.getenv("MONGODB_MIN_POOL_SIZE", 0)),
+            "maxIdleTimeMS": int(os.getenv("MONGODB_MAX_IDLE_TIME_MS",
+                                           300000)),
+            "waitQueueTimeoutMS": int(os.getenv(
+                "MONGODB_WAIT_QUEUE_TIMEOUT_MS", 5000)),
+            "connectTimeoutMS": int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS",
+                                              5000)),
+            "socketTimeoutMS": int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS",
+                                             30000)),
+            "serverSelectionTimeoutMS": int(os.getenv(
+                "MONGODB_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+            "heartbeatFrequencyMS": int(os.getenv(
+                "MONGODB_HEARTBEAT_FREQUENCY_MS", 10000)),
+        }
+
     def get_credentials(self) -> Tuple:
         """ This function returns the credentials to be used in connection.py
         """
         return (self.__mongoDB_username, self.__mongoDB_pwd,
                 self.__mongoDB_port, self.__mongoDB_host)
+
+    def get_pool_options(self) -> dict:
+        """ This function returns the MongoClient pool and timeout options
+            to be used in connection.py
+        """
+        return dict(self.__pool_options)
@@ -1,9 +1,12 @@
 """ This modules connects to MongoDB.
 """
-from . import config
+from . import config, metrics
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
 from abc import abstractmethod
+import threading
 import urllib
+import os
 
 
 class Connect(object):
@@ -27,6 +30,7 @@ class MongoDB(Connect):
         self._conf = config.MongoDBConfig()
         (self.mongoDB_username, self.mongoDB_pwd,
          self.mongoDB_port, self.mongoDB_host) = self._conf.get_credentials()
+        self.pool_options = self._conf.get_pool_options()
 
         # here quote_plus is used because the password or username might have
         # characters in them, which will return an error while connecting to
@@ -34,6 +38,18 @@ class MongoDB(Connect):
         self.mongoDB_pwd = urllib.parse.quote_plus(self.mongoDB_pwd)
         self.mongoDB_username = urllib.parse.quote_plus(self.mongoDB_username)
 
+        # the shared client is created lazily on the first call to
+        # get_client(), and it remembers the pid of the process that created
+        # it so that a forked gunicorn worker never reuses its parent's sockets
+        self._client = None
+        self._client_pid = None
+        self._lock = threading.Lock()
+
+    def _mongo_uri(self) -> str:
+        return f'mongodb://{self.mongoDB_username}:{self.mongoDB_pwd }@' \
+               + f'{self.mongoDB_host}:{self.mongoDB_port}/' \
+               + f'compose?authSource=admin&ssl=true'
+
     def connect_to_DB(self, **kwargs) -> MongoClient:
         # from .env file, the host/ip address is predefined, here we can
         # overwrite the ip address while calling this function if MongoDB's
@@ -41,7 +57,42 @@ class MongoDB(Connect):
         if kwargs:
             for key, value in kwargs.items():
                 self.mongoDB_host = value
-        mongo_uri = f'mongodb://{self.mongoDB_username}:{self.mongoDB_pwd }@' \
-                    + f'{self.mongoDB_host}:{self.mongoDB_port}/' \
-                    + f'compose?authSource=admin&ssl=true'
-        return MongoClient(mongo_uri)
+        return MongoClient(self._mongo_uri())
+
+    def get_client(self) -> MongoClient:
+        """ Returns the process-wide MongoClient, creating it on first use.
+            MongoClient is thread-safe and keeps its own connection pool,
+            so it has to be shared instead of opened and closed per request.
+        """
+        pid = os.getpid()
+        if self._client is None or self._client_pid != pid:
+            with self._lock:
+                if self._client is None or self._client_pid != pid:
+                    # connect=False defers the TCP/TLS handshake until the
+                    # first operation, which happens after gunicorn forks
+                    self._client = MongoClient(
+                        self._mongo_uri(), connect=False,
+                        event_listeners=[metrics.CommandLatencyListener()],
+                        **self.pool_options)
+                    self._client_pid = pid
+        return self._client
+
+    def ping(self) -> bool:
+        """ Health check of the shared client, returns False instead of
+            raising if MongoDB cannot be reached.
+        """
+        try:
+            self.get_client().admin.command('ping')
+            return True
+        except PyMongoError:
+            return False
+
+    def close(self) -> None:
+        """ Closes the shared client of the current process, the next call to
+            get_client() opens a new one.
+        """
+        with self._lock:
+            if self._client is not None and self._client_pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._client_pid = None
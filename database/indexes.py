@@ -0,0 +1,47 @@
+""" This module creates the indexes the API queries rely on.
+    It is called by the Flask app and the Scrapy pipeline when they start,
+    create_index is a no-op when the index already exists.
+"""
+import logging
+from pymongo import TEXT
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# a collection can only have one text index, it covers the headline, the
+# tags and the text of the article with the headline weighing the most
+ARTICLE_TEXT_INDEX = 'article_text'
+ARTICLE_TEXT_WEIGHTS = {
+    'headline': 10,
+    'tags': 5,
+    'text': 1,
+}
+
+
+def ensure_article_indexes(collection) -> None:
+    """ Creates the indexes of the articles collection.
+    """
+    # tag_slugs is an array, so this is a multikey index with one entry
+    # per tag of each article
+    collection.create_index('tag_slugs', name='tag_slugs')
+    collection.create_index('created_at.datetime', name='created_at')
+    try:
+        # the pipeline upserts the articles on their url
+        collection.create_index('article_url', name='article_url',
+                                unique=True)
+    except OperationFailure as e:
+        # happens when the collection already holds duplicated articles,
+        # python -m database.migrations dedupe removes them
+        logger.warning(f"Could not create the article_url index: {e}")
+    try:
+        collection.create_index(
+            [(field, TEXT) for field in ARTICLE_TEXT_WEIGHTS],
+            name=ARTICLE_TEXT_INDEX,
+            weights=ARTICLE_TEXT_WEIGHTS,
+            default_language='english'
+        )
+    except OperationFailure as e:
+        # happens when another text index already exists on the collection,
+        # it has to be dropped by hand before this one can be created
+        logger.warning(f"Could not create the {ARTICLE_TEXT_INDEX} "
+                       + f"index: {e}")
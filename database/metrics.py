@@ -0,0 +1,66 @@
+""" This module defines the Prometheus metrics of the API and of its MongoDB
+    operations, and renders all the metrics for /metrics.
+
+    Each gunicorn worker, and each crawl started by the API, is a process of
+    its own. When PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py sets it)
+    every process writes its metrics to files in that directory, and they
+    are summed when rendered, whichever worker serves /metrics. The
+    variable has to be set before prometheus_client is imported.
+"""
+import os
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+from pymongo import monitoring
+
+API_REQUESTS = Counter(
+    'api_requests_total', 'Requests served by the API',
+    ['route', 'method', 'status'])
+API_LATENCY = Histogram(
+    'api_request_duration_seconds', 'Time to serve a request of the API',
+    ['route', 'method'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+
+MONGODB_LATENCY = Histogram(
+    'mongodb_command_duration_seconds',
+    'Time of the MongoDB commands of the API', ['command'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5))
+MONGODB_FAILURES = Counter(
+    'mongodb_command_failures_total',
+    'MongoDB commands of the API that failed', ['command'])
+
+
+class CommandLatencyListener(monitoring.CommandListener):
+    """ Records the duration of each command sent by a MongoClient, given
+        to it with event_listeners.
+    """
+
+    def started(self, event) -> None:
+        pass
+
+    def succeeded(self, event) -> None:
+        MONGODB_LATENCY.labels(event.command_name).observe(
+            event.duration_micros / 1e6)
+
+    def failed(self, event) -> None:
+        MONGODB_LATENCY.labels(event.command_name).observe(
+            event.duration_micros / 1e6)
+        MONGODB_FAILURES.labels(event.command_name).inc()
+
+
+def registry():
+    """ The registry of all the processes in multiprocess mode, or of this
+        process.
+    """
+    if not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        return REGISTRY
+    collector_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry)
+    return collector_registry
+
+
+def render() -> tuple:
+    """ Returns the metrics in the Prometheus text format, and their
+        content type.
+    """
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
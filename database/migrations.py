@@ -0,0 +1,148 @@
+""" This module updates the articles that are already stored in MongoDB
+    when the format of a field changes. The documents are read with a
+    projection of the needed fields only and updated with batched
+    unordered bulk writes.
+
+    Usage:
+        python -m database.migrations {tags,dates,dedupe} [--all]
+                                            [--batch-size 1000]
+"""
+import argparse
+import logging
+import os
+from pymongo import DeleteMany, UpdateOne
+from . import connection, indexes, queries, versions
+
+logger = logging.getLogger(__name__)
+
+
+def _bulk_update(collection, query, projection, update_of,
+                 batch_size) -> int:
+    """ Calls update_of(document) on each document matching the query and
+        writes the returned updates batch_size at a time.
+        Returns the number of modified documents.
+    """
+    modified = 0
+    operations = []
+    cursor = collection.find(query, projection).batch_size(batch_size)
+    for document in cursor:
+        update = update_of(document)
+        if update:
+            operations.append(UpdateOne({'_id': document['_id']}, update))
+        if len(operations) == batch_size:
+            modified += collection.bulk_write(operations,
+                                              ordered=False).modified_count
+            operations = []
+    if operations:
+        modified += collection.bulk_write(operations,
+                                          ordered=False).modified_count
+    return modified
+
+
+def backfill_tag_slugs(collection, batch_size=1000, everything=False) -> int:
+    """ Stores the normalized tag_slugs of the articles that do not have
+        them yet, or of all the articles if everything is True.
+    """
+    query = {} if everything else {'tag_slugs': {'$exists': False}}
+    return _bulk_update(
+        collection, query, {'tags': 1},
+        lambda doc: {'$set': {
+            'tag_slugs': queries.normalize_tags(doc.get('tags') or [])
+        }},
+        batch_size
+    )
+
+
+def _created_at_update(document, skipped) -> dict:
+    created_at = document.get('created_at') or {}
+    if not isinstance(created_at, dict):
+        return None
+    try:
+        parsed = queries.parse_created_at(created_at.get('ISO_datetime'))
+    except (ValueError, OverflowError) as e:
+        # a malformed date is left as it is rather than stopping the backfill
+        logger.warning(f"Skipping {document['_id']}: invalid ISO_datetime "
+                       + f"{created_at.get('ISO_datetime')!r} ({e})")
+        skipped.append(document['_id'])
+        return None
+    return {'$set': {'created_at.datetime': parsed}}
+
+
+def backfill_created_at(collection, batch_size=1000,
+                        everything=False) -> tuple:
+    """ Stores created_at.datetime as a BSON date, parsed from
+        created_at.ISO_datetime, for the articles that do not have it yet,
+        or for all the articles if everything is True.
+        Returns the number of modified documents and the ids of the
+        documents skipped because their ISO_datetime could not be parsed.
+    """
+    query = {} if everything \
+        else {'created_at.datetime': {'$exists': False}}
+    skipped = []
+    modified = _bulk_update(collection, query, {'created_at.ISO_datetime': 1},
+                            lambda doc: _created_at_update(doc, skipped),
+                            batch_size)
+    return modified, skipped
+
+
+def remove_duplicates(collection, batch_size=1000) -> int:
+    """ Keeps the most recently inserted article of each article_url and
+        deletes the others, so that the unique article_url index can be
+        built. Returns the number of deleted documents.
+    """
+    deleted = 0
+    operations = []
+    duplicates = collection.aggregate([
+        {"$group": {"_id": "$article_url",
+                    "ids": {"$push": "$_id"},
+                    "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True)
+    for group in duplicates:
+        # ObjectIds grow with the insertion time
+        older = sorted(group['ids'])[:-1]
+        operations.append(DeleteMany({'_id': {'$in': older}}))
+        if len(operations) == batch_size:
+            deleted += collection.bulk_write(operations,
+                                             ordered=False).deleted_count
+            operations = []
+    if operations:
+        deleted += collection.bulk_write(operations,
+                                         ordered=False).deleted_count
+    return deleted
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Migrate the articles stored in MongoDB')
+    parser.add_argument('migration', choices=['tags', 'dates', 'dedupe'])
+    parser.add_argument('--database',
+                        default=os.getenv('MONGODB_DATABASE') or 'BBC')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--all', action='store_true',
+                        help='also rewrite the documents already migrated')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    _conf = connection.MongoDB()
+    collection = _conf.get_client()[args.database].articles
+
+    if args.migration == 'dedupe':
+        modified = remove_duplicates(collection, args.batch_size)
+    elif args.migration == 'tags':
+        modified = backfill_tag_slugs(collection, args.batch_size, args.all)
+    elif args.migration == 'dates':
+        modified, skipped = backfill_created_at(collection, args.batch_size,
+                                                args.all)
+        if skipped:
+            logger.warning(f'dates: {len(skipped)} articles skipped, their '
+                           + 'ISO_datetime could not be parsed')
+    indexes.ensure_article_indexes(collection)
+    if modified:
+        versions.bump_version(collection.database, collection.name)
+    logger.info(f'{args.migration}: {modified} articles updated')
+    _conf.close()
+
+
+if __name__ == '__main__':
+    main()
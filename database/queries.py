@@ -0,0 +1,136 @@
+""" This module builds the MongoDB queries used by the API endpoints,
+    so that they can be tested without a running database.
+"""
+import re
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from dateutil.parser import isoparse
+
+
+def parse_created_at(iso_datetime):
+    """ Returns the ISO string stored by the spider as a UTC datetime,
+        or None if it is empty.
+    """
+    if not iso_datetime:
+        return None
+    parsed = isoparse(iso_datetime)
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def calendar_range(year, month=None, day=None) -> tuple:
+    """ Returns the [start, end) datetimes of a year, a month or a day.
+    """
+    if day:
+        start = datetime(year, month, day, tzinfo=timezone.utc)
+        return start, start + timedelta(days=1)
+    if month:
+        start = datetime(year, month, 1, tzinfo=timezone.utc)
+        if month == 12:
+            return start, datetime(year + 1, 1, 1, tzinfo=timezone.utc)
+        return start, datetime(year, month + 1, 1, tzinfo=timezone.utc)
+    return (datetime(year, 1, 1, tzinfo=timezone.utc),
+            datetime(year + 1, 1, 1, tzinfo=timezone.utc))
+
+
+def date_range(start=None, end=None, end_inclusive=False) -> dict:
+    """ Returns the query on the created_at.datetime index.
+        start is inclusive, end is exclusive unless end_inclusive is True.
+    """
+    bounds = {}
+    if start:
+        bounds["$gte"] = start
+    if end:
+        bounds["$lte" if end_inclusive else "$lt"] = end
+    return {"created_at.datetime": bounds}
+
+
+def parse_date_bounds(date_from=None, date_to=None) -> dict:
+    """ Returns the query of the from/to arguments of the API, which are
+        ISO dates or datetimes. A date without a time as the upper bound
+        includes the whole day. Raises ValueError if they are malformed.
+    """
+    start = parse_created_at(date_from)
+    end = parse_created_at(date_to)
+    end_inclusive = True
+    if date_to and len(date_to) == len('YYYY-MM-DD'):
+        end, end_inclusive = end + timedelta(days=1), False
+    if start and end and start > end:
+        raise ValueError('from must be before to')
+    return date_range(start, end, end_inclusive)
+
+
+def normalize_tags(tags) -> list:
+    """ Returns the tags as lowercased slugs, e.g. "Russia-Ukraine war"
+        becomes "russia-ukraine-war". They are stored next to the display
+        tags in tag_slugs, which has a multikey index.
+    """
+    slugs = []
+    for tag in tags:
+        slug = re.sub(r'[\W_]+', '-', (tag or '').lower()).strip('-')
+        if slug and slug not in slugs:
+            slugs.append(slug)
+    return slugs
+
+
+def tag_search(tags, match_all=False) -> dict:
+    """ Returns the query on the tag_slugs index, matching articles that
+        have any of the tags, or all of them with match_all.
+    """
+    return {"tag_slugs": {"$all" if match_all else "$in":
+                          normalize_tags(tags)}}
+
+
+def text_search(keywords, match_all=False) -> dict:
+    """ Returns a $text query on the article_text index.
+        With match_all each keyword is quoted, which makes MongoDB require
+        all of them (AND), otherwise any keyword matches (OR).
+    """
+    keywords = [k.replace('"', '').strip() for k in keywords]
+    keywords = [k for k in keywords if k]
+    if match_all:
+        search = ' '.join(f'"{k}"' for k in keywords)
+    else:
+        search = ' '.join(keywords)
+    return {"$text": {"$search": search}}
+
+
+def encode_score_cursor(score, _id) -> str:
+    """ The cursor of a ranked result is the relevance score and the _id of
+        the last article of the page.
+    """
+    return f'{score!r}_{_id}'
+
+
+def decode_score_cursor(cursor) -> tuple:
+    """ Reverse of encode_score_cursor, raises ValueError if the cursor is
+        malformed.
+    """
+    score, _, _id = cursor.partition('_')
+    try:
+        return float(score), ObjectId(_id)
+    except Exception:
+        raise ValueError(f'Invalid cursor {cursor}')
+
+
+def text_search_pipeline(keywords, match_all=False,
+                         after=None, limit=None) -> list:
+    """ Returns the aggregation pipeline of a ranked keyword search.
+        The articles are sorted by relevance then by _id, and after is a
+        cursor from encode_score_cursor used for keyset pagination.
+    """
+    pipeline = [
+        {"$match": text_search(keywords, match_all)},
+        {"$addFields": {"score": {"$meta": "textScore"}}},
+    ]
+    if after:
+        score, _id = decode_score_cursor(after)
+        pipeline.append({"$match": {"$or": [
+            {"score": {"$lt": score}},
+            {"score": score, "_id": {"$gt": _id}},
+        ]}})
+    pipeline.append({"$sort": {"score": -1, "_id": 1}})
+    if limit:
+        pipeline.append({"$limit": limit})
+    return pipeline
@@ -0,0 +1,200 @@
+""" This module keeps the revision history of the articles.
+    The articles collection holds the latest version of each article, with
+    the hash of its tracked fields and its revision number. When a crawl
+    finds an article whose hash changed, the replaced version is stored in
+    the article_revisions collection as a delta turning the newer version
+    back into it, rather than as a full copy. An older version is rebuilt
+    by applying the deltas from the latest version backwards.
+    An article whose hash did not change is not written at all.
+"""
+import hashlib
+import re
+from datetime import datetime, timezone
+from difflib import SequenceMatcher
+from pymongo import ASCENDING, DESCENDING, InsertOne, ReplaceOne
+from database import serialization
+
+# MongoDB collection name
+REVISIONS_COLLECTION = 'article_revisions'
+
+# the fields whose change makes a new revision, the others (images, author,
+# ...) are only updated along with them
+TRACKED_FIELDS = ('headline', 'text', 'tags')
+
+_TRACKED_PROJECTION = {'article_url': 1, '_id': 0,
+                       **{field: 1 for field in TRACKED_FIELDS}}
+
+# words and the whitespace between them, ''.join gives the text back
+_TOKENS = re.compile(r'\s+|\S+')
+
+
+def content_hash(article) -> str:
+    """ The hash of the tracked fields of an article.
+    """
+    return hashlib.sha1(serialization.dumps(
+        [article.get(field) for field in TRACKED_FIELDS])).hexdigest()
+
+
+def text_delta(new, old) -> list:
+    """ The [start, end, replacement] edits, in characters of new, that turn
+        new into old. The text is compared word by word.
+    """
+    new_tokens = _TOKENS.findall(new)
+    old_tokens = _TOKENS.findall(old)
+    offsets = [0]
+    for token in new_tokens:
+        offsets.append(offsets[-1] + len(token))
+    matcher = SequenceMatcher(None, new_tokens, old_tokens, autojunk=False)
+    return [[offsets[i1], offsets[i2], ''.join(old_tokens[j1:j2])]
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+            if tag != 'equal']
+
+
+def apply_text_delta(text, delta) -> str:
+    parts = []
+    position = 0
+    for start, end, replacement in delta:
+        parts.append(text[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(text[position:])
+    return ''.join(parts)
+
+
+def diff(new, old) -> dict:
+    """ The delta turning the tracked fields of new into the ones of old.
+        A changed text is stored as edits, the other fields as their old
+        value.
+    """
+    delta = {}
+    for field in TRACKED_FIELDS:
+        new_value, old_value = new.get(field), old.get(field)
+        if new_value == old_value:
+            continue
+        if field == 'text' and isinstance(new_value, str) \
+                and isinstance(old_value, str):
+            delta['text_edits'] = text_delta(new_value, old_value)
+        else:
+            delta[field] = old_value
+    return delta
+
+
+def patch(article, delta) -> dict:
+    """ Returns a copy of article with the delta applied.
+    """
+    article = dict(article)
+    for field, value in delta.items():
+        if field == 'text_edits':
+            article['text'] = apply_text_delta(article['text'], value)
+        else:
+            article[field] = value
+    return article
+
+
+def plan_writes(collection, documents) -> tuple:
+    """ Compares the crawled documents with the stored articles, on their
+        hash first and on their tracked fields only when it changed.
+        Returns the ReplaceOne of the new and changed articles, the
+        InsertOne of the revisions of the replaced versions, and the number
+        of unchanged articles.
+    """
+    # an article crawled twice in the same batch is written once,
+    # unordered upserts of the same url could otherwise race
+    latest = {doc['article_url']: doc for doc in documents}
+    stored = {doc['article_url']: doc for doc in collection.find(
+        {'article_url': {'$in': list(latest)}},
+        {'article_url': 1, 'content_hash': 1, 'revision': 1, '_id': 0})}
+    # the articles stored before the hashes were, hashed from their fields
+    legacy = [url for url, doc in stored.items() if 'content_hash' not in doc]
+    if legacy:
+        for doc in collection.find({'article_url': {'$in': legacy}},
+                                   _TRACKED_PROJECTION):
+            stored[doc['article_url']]['content_hash'] = content_hash(doc)
+
+    now = datetime.now(timezone.utc)
+    changed = {}
+    articles = []
+    unchanged = 0
+    for url, doc in latest.items():
+        doc['content_hash'] = content_hash(doc)
+        previous = stored.get(url)
+        if previous is not None \
+                and previous['content_hash'] == doc['content_hash']:
+            unchanged += 1
+            continue
+        revision = previous.get('revision', 1) + 1 if previous else 1
+        doc['revision'] = revision
+        doc['revised_at'] = now
+        if previous is not None:
+            changed[url] = previous
+        articles.append(ReplaceOne({'article_url': url}, doc, upsert=True))
+
+    revisions = []
+    if changed:
+        for old in collection.find({'article_url': {'$in': list(changed)}},
+                                   {'revised_at': 1, **_TRACKED_PROJECTION}):
+            url = old['article_url']
+            revisions.append(InsertOne({
+                'article_url': url,
+                'revision': changed[url].get('revision', 1),
+                'content_hash': changed[url]['content_hash'],
+                'revised_at': old.get('revised_at'),
+                'replaced_at': now,
+                'delta': diff(latest[url], old),
+            }))
+    return articles, revisions, unchanged
+
+
+def ensure_revision_indexes(collection) -> None:
+    collection.create_index([('article_url', ASCENDING),
+                             ('revision', DESCENDING)],
+                            name='article_revisions', unique=True)
+
+
+def history(db, article_url) -> list:
+    """ The versions of an article, from the latest to the first, each with
+        its revision, hash, date and the fields that changed in the next
+        revision. Returns None if the article is not stored.
+    """
+    article = db.articles.find_one({'article_url': article_url},
+                                   {'revision': 1, 'content_hash': 1,
+                                    'revised_at': 1, '_id': 0})
+    if article is None:
+        return None
+    versions = [{'revision': article.get('revision', 1),
+                 'content_hash': article.get('content_hash'),
+                 'revised_at': article.get('revised_at'),
+                 'changed': []}]
+    for revision in db[REVISIONS_COLLECTION].find(
+            {'article_url': article_url},
+            {'_id': 0}).sort('revision', DESCENDING):
+        versions.append({
+            'revision': revision['revision'],
+            'content_hash': revision['content_hash'],
+            'revised_at': revision.get('revised_at'),
+            'replaced_at': revision['replaced_at'],
+            'changed': sorted('text' if field == 'text_edits' else field
+                              for field in revision['delta']),
+        })
+    return versions
+
+
+def get_revision(db, article_url, revision) -> dict:
+    """ Rebuilds a revision of an article from its latest version, only
+        its tracked fields are versioned. Returns None if the article or
+        the revision does not exist.
+    """
+    article = db.articles.find_one({'article_url': article_url},
+                                   {'_id': 0})
+    if article is None or revision > article.get('revision', 1):
+        return None
+    for older in db[REVISIONS_COLLECTION].find(
+            {'article_url': article_url, 'revision': {'$gte': revision}},
+            {'_id': 0}).sort('revision', DESCENDING):
+        article = patch(article, older['delta'])
+        article['revision'] = older['revision']
+        article['content_hash'] = older['content_hash']
+        article['revised_at'] = older.get('revised_at')
+    if article.get('revision', 1) != revision:
+        return None
+    return article
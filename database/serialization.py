@@ -0,0 +1,60 @@
+""" This module serializes the MongoDB documents returned by the API.
+    It uses orjson, with a hook for the BSON types that gives the same
+    relaxed extended JSON as bson.json_util (ObjectId as {"$oid": ...} and
+    datetime as {"$date": ...}).
+"""
+import gzip
+from datetime import datetime, timezone
+import brotli
+import orjson
+from bson import json_util, ObjectId
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _bson_default(obj):
+    """ Called by orjson for the types it cannot serialize.
+    """
+    if isinstance(obj, ObjectId):
+        return {"$oid": str(obj)}
+    if isinstance(obj, datetime):
+        if obj.tzinfo is not None:
+            obj = obj.astimezone(timezone.utc).replace(tzinfo=None)
+        if obj < EPOCH:
+            millis = (obj - EPOCH) // EPOCH.resolution // 1000
+            return {"$date": {"$numberLong": str(millis)}}
+        millis = obj.microsecond // 1000
+        return {"$date": obj.strftime('%Y-%m-%dT%H:%M:%S')
+                + (f'.{millis:03d}' if millis else '') + 'Z'}
+    # the other BSON types are rare in the articles
+    return json_util.default(obj)
+
+
+def dumps(obj, pretty=False) -> bytes:
+    """ Returns obj as UTF-8 JSON, indented only if pretty is True.
+    """
+    option = orjson.OPT_PASSTHROUGH_DATETIME
+    if pretty:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(obj, default=_bson_default, option=option)
+
+
+# the content encodings the API can send, in order of preference
+ENCODINGS = {
+    'br': lambda body: brotli.compress(body, quality=4),
+    'gzip': lambda body: gzip.compress(body, compresslevel=6),
+}
+
+
+def negotiate_encoding(accept_encodings) -> str:
+    """ Returns the preferred encoding accepted by the client, from the
+        Accept-Encoding header parsed by werkzeug, or None.
+    """
+    for encoding in ENCODINGS:
+        if accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def encode(body, encoding) -> bytes:
+    return ENCODINGS[encoding](body)
@@ -0,0 +1,24 @@
+""" This module keeps a version counter per collection in MongoDB.
+    The writers bump it when they change the collection, and the readers
+    use it to know when their cached results are stale.
+"""
+
+# the collection holding one {_id: <collection name>, version: <int>}
+# document per versioned collection
+VERSIONS_COLLECTION = 'versions'
+
+
+def bump_version(db, name) -> None:
+    """ Increments the version of the collection name.
+    """
+    db[VERSIONS_COLLECTION].update_one({'_id': name},
+                                       {'$inc': {'version': 1}},
+                                       upsert=True)
+
+
+def get_version(db, name) -> int:
+    """ Returns the version of the collection name, 0 if it was never
+        bumped.
+    """
+    document = db[VERSIONS_COLLECTION].find_one({'_id': name})
+    return document['version'] if document else 0
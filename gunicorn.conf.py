@@ -0,0 +1,31 @@
+""" gunicorn settings, read from the working directory when gunicorn starts.
+    The workers and the crawls they start write their Prometheus metrics to
+    PROMETHEUS_MULTIPROC_DIR, so that /metrics sums them whichever worker
+    serves it (see database/metrics.py).
+    With API_LOG_QUEUE each worker starts its own log queue once forked, so
+    the app can be preloaded.
+"""
+import os
+import shutil
+import tempfile
+
+# set before the app, and so prometheus_client, is imported
+metrics_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join(tempfile.gettempdir(), 'news_crawler_metrics'))
+
+
+def on_starting(server) -> None:
+    # the files of a previous run would be summed with the new ones
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def post_fork(server, worker) -> None:
+    from app import start_logging
+    start_logging()
+
+
+def child_exit(server, worker) -> None:
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
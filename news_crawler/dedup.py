@@ -0,0 +1,76 @@
+""" This module keeps the set of the article URLs already stored in
+    MongoDB in memory, so that the downloader middleware does not have to
+    query the database before each request.
+"""
+import hashlib
+import math
+from urllib.parse import urlsplit, urlunsplit
+from w3lib.url import canonicalize_url
+
+
+def canonical_url(url) -> str:
+    """ Returns the URL in the form used for deduplication. The og:url of an
+        article and the URL it was requested with can differ by the scheme,
+        the case of the host, a trailing slash, the order of the query
+        arguments or a fragment.
+    """
+    if not url:
+        return url
+    scheme, netloc, path, query, _ = urlsplit(canonicalize_url(url))
+    if scheme == 'http':
+        scheme = 'https'
+    return urlunsplit((scheme, netloc.lower(), path.rstrip('/') or '/',
+                       query, ''))
+
+
+class BloomFilter(object):
+    """ A Bloom filter sized for capacity items with the given false
+        positive rate. It never misses an added item, but can report an item
+        that was never added with a probability of about error_rate.
+    """
+
+    def __init__(self, capacity, error_rate=0.001) -> None:
+        self.size = max(8, int(-capacity * math.log(error_rate)
+                               / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # double hashing, two 64 bits halves of one digest give all the
+        # hash_count positions
+        digest = hashlib.blake2b(value.encode('utf-8'),
+                                 digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, value) -> None:
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+
+class SeenURLs(object):
+    """ The canonical URLs of the stored articles, kept either in a set
+        (exact, a few hundred bytes per URL) or in a Bloom filter (about
+        two bytes per URL at a 0.1% false positive rate).
+        exact tells whether a match can be trusted without asking MongoDB.
+    """
+
+    def __init__(self, mode='exact', capacity=1000000,
+                 error_rate=0.001) -> None:
+        if mode not in ('exact', 'bloom'):
+            raise ValueError(f'Unknown seen URLs filter {mode}')
+        self.exact = mode == 'exact'
+        self.urls = set() if self.exact \
+            else BloomFilter(capacity, error_rate)
+
+    def add(self, url) -> None:
+        if url:
+            self.urls.add(canonical_url(url))
+
+    def __contains__(self, url) -> bool:
+        return canonical_url(url) in self.urls
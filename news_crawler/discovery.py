@@ -0,0 +1,284 @@
+""" This module discovers the URLs of new articles from news sitemaps, sitemap
+    indexes and RSS/Atom feeds, and adds them to the URL frontier.
+
+    Each source keeps a lastmod high-water mark in the discovery_sources
+    collection of MongoDB: only the entries modified after it are submitted,
+    and only the sitemaps whose lastmod in their index is after the one they
+    were last fetched with are fetched again. The validators of the last
+    response of a source are stored as well, so an unchanged source costs a
+    conditional request.
+    The sources are parsed as they are decompressed, element by element,
+    without building the document tree.
+
+    Usage:
+        scrapy crawl news_crawler -s DISCOVERY_ENABLED=1
+        python -m news_crawler.discovery status
+        python -m news_crawler.discovery reset [source]
+"""
+import argparse
+import gzip
+import io
+import logging
+import os
+from datetime import datetime, timezone
+from dateutil import parser as date_parser
+from lxml import etree
+
+# MongoDB collection name
+SOURCES_COLLECTION = 'discovery_sources'
+
+# the kinds of entries of a source
+SITEMAP = 'sitemap'
+ARTICLE = 'article'
+
+# the elements holding one entry, in sitemap indexes, sitemaps, RSS and
+# Atom feeds
+_ENTRY_TAGS = {'sitemap': SITEMAP, 'url': ARTICLE, 'item': ARTICLE,
+               'entry': ARTICLE}
+# the elements holding the modification date of an entry, the news
+# sitemaps give the publication date
+_DATE_TAGS = ('lastmod', 'publication_date', 'pubDate', 'date', 'updated',
+              'published')
+# the namespaces of the url of an entry: sitemaps, Atom, RSS 1.0, and none
+# in RSS 2.0
+_URL_NAMESPACES = {None, 'http://www.sitemaps.org/schemas/sitemap/0.9',
+                   'http://www.google.com/schemas/sitemap/0.84',
+                   'http://www.w3.org/2005/Atom', 'http://purl.org/rss/1.0/'}
+
+logger = logging.getLogger(__name__)
+
+
+class SourceTooLarge(ValueError):
+    """ Raised when a gzipped source decompresses to more than its maximum
+        size.
+    """
+
+
+class _CappedGzipFile(gzip.GzipFile):
+    """ A GzipFile raising SourceTooLarge once more than max_size bytes were
+        decompressed, so a gzip bomb is never decompressed in full.
+    """
+
+    def __init__(self, fileobj, max_size) -> None:
+        super().__init__(fileobj=fileobj)
+        self.max_size = max_size
+        self.decompressed = 0
+
+    def read(self, size=-1) -> bytes:
+        # one byte more than left is enough to know the source is too large
+        left = self.max_size - self.decompressed + 1
+        data = super().read(left if size is None or size < 0
+                            else min(size, left))
+        self.decompressed += len(data)
+        if self.decompressed > self.max_size:
+            raise SourceTooLarge(f'the source decompresses to more than '
+                                 f'{self.max_size} bytes')
+        return data
+
+
+def open_source(body, max_size=0) -> io.IOBase:
+    """ A file object over the body of a source, decompressed while it is
+        read if it is gzipped, up to max_size bytes unless max_size is 0,
+        like the DOWNLOAD_MAXSIZE of the responses.
+    """
+    stream = io.BytesIO(body)
+    if body[:2] == b'\x1f\x8b':
+        if max_size:
+            return _CappedGzipFile(stream, max_size)
+        return gzip.GzipFile(fileobj=stream)
+    return stream
+
+
+def parse_date(value):
+    """ Returns the W3C or RFC 822 date as a UTC datetime, or None.
+    """
+    if not value:
+        return None
+    try:
+        parsed = date_parser.parse(value.strip())
+    except (ValueError, OverflowError):
+        return None
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def _entry(element) -> tuple:
+    url = None
+    lastmod = None
+    for child in element.iterdescendants(tag=etree.Element):
+        name = etree.QName(child)
+        # the url is the first loc or link of the entry itself, not the loc
+        # of one of its images or videos
+        if name.localname in ('loc', 'link') and url is None \
+                and name.namespace in _URL_NAMESPACES \
+                and child.getparent() is element:
+            # an Atom link has its url in href
+            url = (child.text or child.get('href') or '').strip() or None
+        elif name.localname in _DATE_TAGS:
+            date = parse_date(child.text)
+            if date is not None and (lastmod is None or date > lastmod):
+                lastmod = date
+    return url, lastmod
+
+
+def parse_entries(stream):
+    """ Yields the (kind, url, lastmod) of the entries of a sitemap index,
+        a sitemap or a feed, lastmod being None when the entry has no date.
+        The elements are freed once read, so the memory used does not
+        depend on the size of the source.
+    """
+    for _, element in etree.iterparse(stream, events=('end',),
+                                      resolve_entities=False, huge_tree=True):
+        if not isinstance(element.tag, str):
+            continue
+        kind = _ENTRY_TAGS.get(etree.QName(element).localname)
+        if kind is None:
+            continue
+        url, lastmod = _entry(element)
+        element.clear(keep_tail=True)
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        if url:
+            yield kind, url, lastmod
+
+
+def _utc(value):
+    # MongoDB returns naive UTC datetimes
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+class SourceDiscovery(object):
+    """ The discovery sources and their high-water marks, in a MongoDB
+        collection. The discovered URLs are submitted to frontier with
+        priority.
+    """
+
+    def __init__(self, collection, frontier, priority=0) -> None:
+        self.collection = collection
+        self.frontier = frontier
+        self.priority = priority
+
+    def validators(self, sources) -> dict:
+        """ The validators of the last response of each source that has
+            been fetched.
+        """
+        return {source['_id']: source.get('validators') or {}
+                for source in self.collection.find(
+                    {'_id': {'$in': list(sources)}}, {'validators': 1})}
+
+    def process(self, source, body, validators=None,
+                listed_lastmod=None, max_size=0) -> dict:
+        """ Submits the articles of the source modified after its mark, and
+            moves the mark to the latest modification. listed_lastmod is the
+            lastmod of the source in its sitemap index. A gzipped source
+            decompressing to more than max_size bytes raises SourceTooLarge,
+            without moving the mark.
+            Returns the counts of entries, of new entries and of URLs added
+            to the frontier, and the (url, lastmod) of the sitemaps of an
+            index that changed since they were fetched.
+        """
+        stored = self.collection.find_one({'_id': source}) or {}
+        watermark = _utc(stored.get('lastmod'))
+        counts = {'entries': 0, 'new': 0, 'added': 0, 'sitemaps': []}
+        sitemaps = {}
+        latest = [watermark]
+
+        def new_articles(entries):
+            for kind, url, lastmod in entries:
+                counts['entries'] += 1
+                if kind == SITEMAP:
+                    sitemaps[url] = lastmod
+                    continue
+                if lastmod is not None:
+                    if watermark is not None and lastmod <= watermark:
+                        continue
+                    if latest[0] is None or lastmod > latest[0]:
+                        latest[0] = lastmod
+                # an entry without a date is submitted every time, the
+                # frontier ignores it once it is known
+                counts['new'] += 1
+                yield url
+
+        with open_source(body, max_size) as stream:
+            counts['added'] = self.frontier.submit(
+                new_articles(parse_entries(stream)),
+                self.priority)['added']
+
+        if sitemaps:
+            marks = {doc['_id']: _utc(doc.get('listed_lastmod'))
+                     for doc in self.collection.find(
+                         {'_id': {'$in': list(sitemaps)}},
+                         {'listed_lastmod': 1})}
+            counts['sitemaps'] = [
+                (url, lastmod) for url, lastmod in sitemaps.items()
+                if lastmod is None or marks.get(url) is None
+                or lastmod > marks[url]]
+
+        update = {'$set': {'checked_at': datetime.now(timezone.utc),
+                           'entries': counts['entries']},
+                  '$inc': {'added': counts['added']}}
+        if validators is not None:
+            update['$set']['validators'] = validators
+        marks = {'lastmod': latest[0], 'listed_lastmod': listed_lastmod}
+        marks = {key: value for key, value in marks.items()
+                 if value is not None}
+        if marks:
+            update['$max'] = marks
+        self.collection.update_one({'_id': source}, update, upsert=True)
+        return counts
+
+    def checked(self, source, listed_lastmod=None) -> None:
+        """ Records that the source did not change since it was fetched.
+        """
+        update = {'$set': {'checked_at': datetime.now(timezone.utc)}}
+        if listed_lastmod is not None:
+            update['$max'] = {'listed_lastmod': listed_lastmod}
+        self.collection.update_one({'_id': source}, update)
+
+    def reset(self, source=None) -> int:
+        """ Forgets the marks of source, or of all the sources, so that all
+            their entries are submitted again at the next discovery.
+        """
+        query = {} if source is None else {'_id': source}
+        return self.collection.delete_many(query).deleted_count
+
+    def status(self) -> list:
+        return list(self.collection.find().sort('_id'))
+
+
+def main() -> None:
+    # imported here, the spider only needs the discovery class
+    from database import connection
+    from news_crawler.frontier import FRONTIER_COLLECTION, URLFrontier
+
+    parser = argparse.ArgumentParser(
+        description='Manage the sitemap and feed discovery')
+    parser.add_argument('command', choices=['status', 'reset'])
+    parser.add_argument('source', nargs='?',
+                        help='the source to reset, all of them by default')
+    parser.add_argument('--database',
+                        default=os.getenv('MONGODB_DATABASE') or 'BBC')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    _conf = connection.MongoDB()
+    db = _conf.get_client()[args.database]
+    discovery = SourceDiscovery(db[SOURCES_COLLECTION],
+                                URLFrontier(db[FRONTIER_COLLECTION]))
+    if args.command == 'status':
+        print(f"{'lastmod':<27}{'checked':<27}{'added':>8}  source")
+        for source in discovery.status():
+            lastmod = source.get('lastmod')
+            print(f"{lastmod.isoformat() if lastmod else '-':<27}"
+                  + f"{source['checked_at'].isoformat():<27}"
+                  + f"{source.get('added', 0):>8}  {source['_id']}")
+    elif args.command == 'reset':
+        logger.info(f'reset: {discovery.reset(args.source)} sources')
+    _conf.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+""" This module handles the extensions.
+    Extensions are installed in settings.py, and are notified of the
+    events of the crawl through the scrapy signals.
+"""
+import cProfile
+import json
+import logging
+import os
+import time
+import pymongo
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.log import get_scrapy_root_handler
+from prometheus_client import start_http_server
+from twisted.internet import task
+from database.metrics import registry
+from news_crawler.logs import QueuedLogging
+from news_crawler.metrics import ITEMS, PAGES, RESPONSE_BYTES
+from news_crawler.tracing import TRACE_KEY, record, request_traced
+from news_crawler.jobs import (CANCELLED, FAILED, FINISHED, JOBS_COLLECTION,
+                               CrawlJobs)
+
+# Get the logging instance initiated by Scrapy framework
+logger = logging.getLogger(__name__)
+
+
+class CrawlJobExtension:
+    """ Reports the progress of a crawl started as a job by the API every
+        CRAWL_JOB_PROGRESS_INTERVAL seconds, and stops the crawl when the
+        job is cancelled. It is only enabled when the crawl was started with
+        the CRAWL_JOB_ID setting.
+    """
+
+    def __init__(self, crawler, jobs, job_id, interval) -> None:
+        self.crawler = crawler
+        self.jobs = jobs
+        self.job_id = job_id
+        self.interval = interval
+        self.loop = None
+        self.started = None
+        self.cancelling = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        job_id = settings.get('CRAWL_JOB_ID')
+        if not job_id:
+            raise NotConfigured
+        client = pymongo.MongoClient(settings.get('MONGO_URI'))
+        jobs = CrawlJobs(
+            client[settings.get('MONGO_DATABASE')][JOBS_COLLECTION],
+            max_jobs=settings.getint('CRAWL_MAX_JOBS', 1),
+            stale_seconds=settings.getint('CRAWL_JOB_STALE_SECONDS', 120))
+        s = cls(crawler, jobs, job_id,
+                settings.getfloat('CRAWL_JOB_PROGRESS_INTERVAL', 10))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def progress(self) -> dict:
+        """ The counts of the crawl so far, from the crawler stats.
+        """
+        stats = self.crawler.stats
+        elapsed = time.time() - (self.started or time.time())
+        items = stats.get_value('item_scraped_count', 0)
+        pages = stats.get_value('response_received_count', 0)
+        return {
+            'pages': pages,
+            'items': items,
+            'errors': stats.get_value('frontier/failed', 0)
+            + stats.get_value('spider_exceptions/count', 0),
+            'bytes': stats.get_value('downloader/response_bytes', 0),
+            'elapsed_seconds': round(elapsed, 1),
+            'pages_per_minute': round(pages * 60 / elapsed, 2)
+            if elapsed else 0,
+            'items_per_minute': round(items * 60 / elapsed, 2)
+            if elapsed else 0,
+        }
+
+    def spider_opened(self, spider) -> None:
+        self.started = time.time()
+        # the spider cannot be closed while it is being opened, a job
+        # cancelled meanwhile is stopped at the first report
+        self.jobs.heartbeat(self.job_id, self.progress())
+        self.loop = task.LoopingCall(self.report, spider)
+        self.loop.start(self.interval, now=False)
+
+    def report(self, spider) -> None:
+        cancelled = self.jobs.heartbeat(self.job_id, self.progress())
+        if cancelled and not self.cancelling:
+            logger.info(f'Job {self.job_id} cancelled, closing the spider.')
+            self.cancelling = True
+            self.crawler.engine.close_spider(spider, 'cancelled')
+
+    def spider_closed(self, spider, reason) -> None:
+        """ Ends the job, and starts the next queued one in the freed slot.
+        """
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        if reason == 'finished':
+            state = FINISHED
+        elif reason == 'cancelled':
+            state = CANCELLED
+        else:
+            state = FAILED
+        self.jobs.finish(self.job_id, state, reason, self.progress())
+        self.jobs.dispatch()
+        self.jobs.collection.database.client.close()
+
+
+class MetricsExtension:
+    """ Counts the pages, bytes and articles of the crawl in the Prometheus
+        metrics of news_crawler/metrics.py. It is enabled by METRICS_ENABLED.
+        A crawl started by the API shares the PROMETHEUS_MULTIPROC_DIR of
+        the gunicorn workers, so its metrics are served by the /metrics of
+        the API. Otherwise METRICS_PORT serves them from the crawl process.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+        port = settings.getint('METRICS_PORT')
+        if port:
+            start_http_server(port, registry=registry())
+            logger.info(f'Serving the metrics on port {port}')
+        s = cls()
+        crawler.signals.connect(s.response_received,
+                                signal=signals.response_received)
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        return s
+
+    def response_received(self, response, request, spider) -> None:
+        PAGES.labels(response.status).inc()
+        RESPONSE_BYTES.inc(len(response.body))
+
+    def item_scraped(self, item, response, spider) -> None:
+        ITEMS.inc()
+
+
+class TracingExtension:
+    """ With TRACE_ENABLED, times the stages of each request of the crawl
+        (see news_crawler/tracing.py) and writes them as JSON lines to
+        TRACE_DIR/crawl-<pid>.jsonl, with their totals in microseconds in
+        the trace/<stage>/us stats, the fast stages taking less than a
+        millisecond per request.
+        With PROFILE_ENABLED, profiles the crawl with cProfile and writes
+        the profile to PROFILE_DIR/crawl-<pid>.prof when it ends. Only the
+        reactor thread is profiled, not the parse pool nor the pipeline
+        writes.
+    """
+
+    # the downloader middlewares timed in their own stage
+    middleware_stages = ('dedup', 'user_agent')
+
+    def __init__(self, crawler, trace_dir=None, profile_dir=None) -> None:
+        self.crawler = crawler
+        self.trace_dir = trace_dir
+        self.profile_dir = profile_dir
+        self.trace_file = None
+        self.profile = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        tracing = settings.getbool('TRACE_ENABLED')
+        profiling = settings.getbool('PROFILE_ENABLED')
+        if not tracing and not profiling:
+            raise NotConfigured
+        s = cls(crawler,
+                settings.get('TRACE_DIR', 'traces') if tracing else None,
+                settings.get('PROFILE_DIR', 'profiles') if profiling
+                else None)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        if tracing:
+            crawler.signals.connect(s.request_scheduled,
+                                    signal=signals.request_scheduled)
+            crawler.signals.connect(s.request_reached_downloader,
+                                    signal=signals.request_reached_downloader)
+            crawler.signals.connect(s.response_received,
+                                    signal=signals.response_received)
+            crawler.signals.connect(s.item_scraped,
+                                    signal=signals.item_scraped)
+            crawler.signals.connect(s.request_traced, signal=request_traced)
+        return s
+
+    def spider_opened(self, spider) -> None:
+        if self.trace_dir is not None:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            path = os.path.join(self.trace_dir, f'crawl-{os.getpid()}.jsonl')
+            self.trace_file = open(path, 'a')
+            logger.info(f'Tracing the requests to {path}')
+        if self.profile_dir is not None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def spider_closed(self, spider) -> None:
+        if self.trace_file is not None:
+            self.trace_file.close()
+        if self.profile is not None:
+            self.profile.disable()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, f'crawl-{os.getpid()}.prof')
+            self.profile.dump_stats(path)
+            logger.info(f'Profile of the crawl written to {path}')
+
+    def _middlewares(self, trace) -> float:
+        return sum(trace.get(name, 0) for name in self.middleware_stages)
+
+    def request_scheduled(self, request, spider) -> None:
+        # a retried request is a copy, which keeps the trace
+        trace = request.meta.setdefault(TRACE_KEY, {})
+        request.meta['trace_at'] = (time.perf_counter(),
+                                    self._middlewares(trace))
+
+    def request_reached_downloader(self, request, spider) -> None:
+        trace = request.meta.get(TRACE_KEY)
+        if trace is None or 'trace_at' not in request.meta:
+            return
+        now = time.perf_counter()
+        scheduled_at, middlewares = request.meta['trace_at']
+        # the downloader middlewares ran in between, in their own stages
+        record(request.meta, 'scheduler', now - scheduled_at
+               - (self._middlewares(trace) - middlewares))
+        request.meta['trace_at'] = (now, 0)
+
+    def response_received(self, response, request, spider) -> None:
+        if TRACE_KEY not in request.meta or 'trace_at' not in request.meta:
+            return
+        elapsed = time.perf_counter() - request.meta['trace_at'][0]
+        download = request.meta.get('download_latency', elapsed)
+        record(request.meta, 'download', download)
+        record(request.meta, 'slot', max(0, elapsed - download))
+
+    def request_traced(self, url, trace, outcome) -> None:
+        stats = self.crawler.stats
+        for name, seconds in trace.items():
+            stats.inc_value(f'trace/{name}/us', int(seconds * 1e6))
+        self.trace_file.write(json.dumps({'url': url, 'outcome': outcome,
+                                          'stages': trace}) + '\n')
+
+    def item_scraped(self, item, response, spider) -> None:
+        finished_at = response.meta.get('trace_finished_at')
+        if finished_at is None:
+            return
+        seconds = time.perf_counter() - finished_at
+        self.crawler.stats.inc_value('trace/pipeline/us', int(seconds * 1e6))
+        self.trace_file.write(json.dumps({'url': response.url,
+                                          'stages': {'pipeline': seconds}})
+                              + '\n')
+
+
+class LoggingExtension:
+    """ With LOG_QUEUE_ENABLED, moves the log handler of the crawl behind a
+        queue written by a background thread, with JSON lines if LOG_JSON
+        is set, and samples or rate limits the records of the events of
+        LOG_SAMPLE_RATES and LOG_RATE_LIMITS (see news_crawler/logs.py).
+        The records dropped are counted in the log/dropped/* stats.
+    """
+
+    def __init__(self, stats, logging_queue) -> None:
+        self.stats = stats
+        self.logging_queue = logging_queue
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        handler = get_scrapy_root_handler()
+        if not settings.getbool('LOG_QUEUE_ENABLED') or handler is None:
+            raise NotConfigured
+        logging_queue = QueuedLogging(
+            logging.root, [handler],
+            json_format=settings.getbool('LOG_JSON'),
+            sample_rates=settings.getdict('LOG_SAMPLE_RATES'),
+            rate_limits=settings.getdict('LOG_RATE_LIMITS'),
+            queue_size=settings.getint('LOG_QUEUE_SIZE', 10000))
+        logging_queue.start()
+        s = cls(crawler.stats, logging_queue)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.engine_stopped,
+                                signal=signals.engine_stopped)
+        return s
+
+    def spider_closed(self, spider) -> None:
+        for event, count in self.logging_queue.dropped().items():
+            self.stats.set_value(f'log/dropped/{event}', count)
+
+    def engine_stopped(self) -> None:
+        # writes the records left in the queue
+        self.logging_queue.stop()
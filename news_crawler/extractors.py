@@ -0,0 +1,289 @@
+""" This module implements a faster engine to extract an article from its
+    html page. It gives the same result as process_response in
+    spiders/articles.py, but instead of building a scrapy selector for each
+    element and translating css to xpath on each call, it walks the direct
+    children of the article once with xpath expressions compiled when the
+    module is imported.
+
+    The engine used by the spider is chosen with the ARTICLE_EXTRACTOR
+    setting.
+
+    process_structured_data is a faster path that reads the article from
+    the JSON embedded in the page (the application/ld+json block and the
+    window.__INITIAL_DATA__ payload) without parsing the html.
+"""
+import json
+import re
+from dateutil.parser import isoparse
+from lxml import etree
+from database.queries import normalize_tags, parse_created_at
+
+
+def _xpath(path) -> etree.XPath:
+    # smart_strings=False returns plain str instead of strings that keep a
+    # reference to their lxml tree
+    return etree.XPath(path, smart_strings=False)
+
+
+OG_URL = _xpath('//meta[@property="og:url"]/@content')
+ARTICLES = _xpath('//article')
+HEADLINE = _xpath('//*[@id="main-heading"]/text()')
+TIME = _xpath('descendant-or-self::time/@datetime')
+TAG_SECTIONS = _xpath("//section[contains(@data-component, 'tag-list')]")
+TAG_ITEMS = _xpath('descendant-or-self::ul/li')
+LINK_TEXT = _xpath('descendant-or-self::a/text()')
+DIV_TEXT = _xpath('descendant-or-self::div/text()')
+TEXT_BLOCK_TEXT = _xpath('descendant-or-self::p/text()'
+                         ' | descendant-or-self::a/text()'
+                         ' | descendant-or-self::b/text()')
+LISTS = _xpath('descendant-or-self::ul')
+LIST_ITEMS = _xpath('descendant-or-self::li')
+LIST_ITEM_TEXT = _xpath('descendant-or-self::li/text()'
+                        ' | descendant-or-self::p/text()'
+                        ' | descendant-or-self::a/text()'
+                        ' | descendant-or-self::b/text()')
+IMAGE_ALT = _xpath('descendant-or-self::img/@alt')
+IMAGE_SRC = _xpath('descendant-or-self::img/@src')
+SPAN_TEXT = _xpath('descendant-or-self::span/text()')
+
+
+def created_at_fields(created_at) -> dict:
+    """ The date is stored as ISO format (string), and as year, month, and
+        time seperately, in the offset of the page. datetime holds it as a
+        UTC BSON date, which is indexed and used for filtering with time
+        while querying.
+    """
+    local_at = isoparse(created_at) if created_at else None
+    return {
+        "ISO_datetime": created_at,
+        "datetime": parse_created_at(created_at),
+        "year": local_at.year if created_at else created_at,
+        "month": local_at.month if created_at else created_at,
+        "day": local_at.day if created_at else created_at,
+        "time": str(local_at.time()) if created_at else created_at,
+        }
+
+
+def _first(values, default=None):
+    return values[0] if values else default
+
+
+def get_root(response):
+    """ Returns the lxml root of a scrapy Response or Selector, the page is
+        parsed once by scrapy and cached on the response.
+    """
+    return getattr(response, 'selector', response).root
+
+
+def process_response_lxml(response) -> dict:
+    """ Same as process_response, gets the response which is the html of
+        the url page and returns the details of the article.
+    """
+    root = get_root(response)
+    articles = ARTICLES(root)
+    img_counter = 0
+    images = []
+    text = []
+    result = {'article_url': _first(OG_URL(root))}
+
+    created_at = ''
+    for article in articles:
+        created_at = _first(TIME(article))
+        if created_at is not None:
+            break
+    result['created_at'] = created_at_fields(created_at or '')
+
+    result['headline'] = _first(HEADLINE(root), 'not-found') \
+        if articles else 'not-found'
+    result['author(s)'] = []
+
+    for article in articles:
+        for item in article.iterchildren('div'):
+            div = item.get('data-component')
+
+            if div == 'byline-block':
+                author = DIV_TEXT(item)[0].replace('By ', '').strip()
+                result['author(s)'].append(author.split(' and '))
+
+            elif div == 'text-block':
+                tmp = TEXT_BLOCK_TEXT(item)
+                text.append(f"{tmp[0] if tmp else ''}\n")
+
+            elif div == 'unordered-list-block':
+                for ul in LISTS(item):
+                    for li in LIST_ITEMS(ul):
+                        text.append(f"- {' '.join(LIST_ITEM_TEXT(li))}\n")
+
+            elif div == 'image-block':
+                img_alt = _first(IMAGE_ALT(item))
+                if img_alt != 'line':
+                    text.append(f"\t@Image-{img_counter}\n")
+                    images.append({
+                        'image_ref': f'Image-{img_counter}',
+                        'source': _first(IMAGE_SRC(item)),
+                        'description': img_alt
+                    })
+                    img_counter += 1
+
+            elif div == 'subheadline-block':
+                text.append(f"---{SPAN_TEXT(item)[0]}---\n")
+
+    tags = []
+    if articles:
+        for section in TAG_SECTIONS(root):
+            for li in TAG_ITEMS(section):
+                tags.append(_first(LINK_TEXT(li)))
+
+    result['text'] = ''.join(text)
+    result['images'] = images
+    result['tags'] = tags
+    result['tag_slugs'] = normalize_tags(tags)
+
+    return result
+
+
+# the fields of the result of the extractors, without tag_slugs which is
+# computed from the tags
+ARTICLE_FIELDS = ('article_url', 'created_at', 'headline', 'author(s)',
+                  'text', 'images', 'tags')
+
+LD_JSON = re.compile(r'<script[^>]*type="application/ld\+json"[^>]*>'
+                     r'(.*?)</script>', re.S)
+INITIAL_DATA = 'window.__INITIAL_DATA__='
+_decoder = json.JSONDecoder()
+
+
+def _ld_json_article(page) -> dict:
+    """ Returns the first schema.org *Article object of the ld+json blocks.
+    """
+    for match in LD_JSON.finditer(page):
+        try:
+            data = json.loads(match.group(1))
+        except ValueError:
+            continue
+        objects = data if isinstance(data, list) \
+            else data.get('@graph', [data])
+        for obj in objects:
+            if isinstance(obj, dict) and \
+                    str(obj.get('@type', '')).endswith('Article'):
+                return obj
+    return {}
+
+
+def _initial_data_article(page) -> dict:
+    """ Returns the data of the article component of __INITIAL_DATA__,
+        which is a JSON document stored in a javascript string.
+    """
+    start = page.find(INITIAL_DATA)
+    if start == -1:
+        return {}
+    try:
+        literal, _ = _decoder.raw_decode(page, start + len(INITIAL_DATA))
+        data = json.loads(literal) if isinstance(literal, str) else literal
+    except ValueError:
+        return {}
+    for key, component in (data.get('data') or {}).items():
+        if key.startswith('article?') and isinstance(component, dict):
+            return component.get('data') or {}
+    return {}
+
+
+def _inline_text(block) -> str:
+    """ The text of a paragraph, link or fragment block, or the text of its
+        children joined with spaces.
+    """
+    model = block.get('model') or {}
+    if isinstance(model.get('text'), str):
+        return model['text']
+    return ' '.join(_inline_text(child) for child in model.get('blocks', []))
+
+
+def _content(blocks) -> tuple:
+    """ Returns the authors, text and images of the content blocks of
+        __INITIAL_DATA__, formatted as process_response does.
+    """
+    authors = []
+    text = []
+    images = []
+    for block in blocks:
+        kind = block.get('type')
+        model = block.get('model') or {}
+
+        if kind == 'byline':
+            for contributor in model.get('blocks', []):
+                name = (contributor.get('model') or {}).get('name', '')
+                authors.append(name.replace('By ', '').strip()
+                               .split(' and '))
+
+        elif kind == 'text':
+            for paragraph in model.get('blocks', []):
+                text.append(f"{_inline_text(paragraph)}\n")
+
+        elif kind == 'unorderedList':
+            for li in model.get('blocks', []):
+                text.append(f"- {_inline_text(li)}\n")
+
+        elif kind == 'image':
+            image = model.get('image') or {}
+            if image.get('alt') != 'line':
+                text.append(f"\t@Image-{len(images)}\n")
+                images.append({
+                    'image_ref': f'Image-{len(images)}',
+                    'source': image.get('src'),
+                    'description': image.get('alt')
+                })
+
+        elif kind in ('subheadline', 'crosshead'):
+            text.append(f"---{_inline_text(block)}---\n")
+
+    return authors, ''.join(text), images
+
+
+def process_structured_data(response) -> dict:
+    """ Gets the article from the JSON embedded in the page. Returns only
+        the fields that were found, the others have to be extracted from the
+        html.
+    """
+    page = response.text
+    result = {}
+
+    ld_json = _ld_json_article(page)
+    if ld_json.get('url'):
+        result['article_url'] = ld_json['url']
+    if ld_json.get('datePublished'):
+        result['created_at'] = created_at_fields(ld_json['datePublished'])
+    if ld_json.get('headline'):
+        result['headline'] = ld_json['headline']
+
+    article = _initial_data_article(page)
+    blocks = ((article.get('content') or {}).get('model') or {}) \
+        .get('blocks')
+    if blocks:
+        (result['author(s)'], result['text'],
+         result['images']) = _content(blocks)
+    if 'topics' in article:
+        result['tags'] = [topic.get('title')
+                          for topic in article['topics'] or []]
+    if 'headline' not in result and article.get('headline'):
+        result['headline'] = article['headline']
+
+    return result
+
+
+def extract_article(response, fallback, structured=True) -> tuple:
+    """ Tries the structured data first, and calls the fallback html
+        extractor only if fields are missing.
+        Returns the result and the path used: 'structured', 'mixed' (the
+        missing fields were taken from the html) or 'html'.
+    """
+    result = process_structured_data(response) if structured else {}
+    if all(field in result for field in ARTICLE_FIELDS):
+        path = 'structured'
+    else:
+        path = 'mixed' if result else 'html'
+        html_result = fallback(response)
+        result = {field: result.get(field, html_result[field])
+                  for field in ARTICLE_FIELDS}
+    result = {field: result[field] for field in ARTICLE_FIELDS}
+    result['tag_slugs'] = normalize_tags(result['tags'])
+    return result, path
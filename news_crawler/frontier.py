@@ -0,0 +1,404 @@
+""" This module implements the URL frontier, the queue of the article URLs
+    to crawl. It is stored in the frontier collection of MongoDB, so it
+    survives restarts and can be fed by several API workers at a time.
+
+    Each URL is stored once, under its canonical form, with a priority and
+    a state:
+        pending -> in_flight -> done or failed
+                       |  ^
+                       v  |
+                      retry
+    A URL whose crawl failed is retried after a jittered exponential
+    backoff, until it failed max_attempts times or failed with a permanent
+    status.
+
+    The HTTP validators of the last response of a URL (ETag, Last-Modified,
+    hash and length of the body) are stored with it. refresh puts the done
+    URLs back in the pending state, flagged so that the spider re-fetches
+    them conditionally.
+    Submitting a URL that is already in the frontier does nothing, whatever
+    its state, so a URL is never crawled twice.
+
+    The frontier is the queue shared by all the crawl processes, see
+    launcher.py. A URL in flight is leased to the worker that claimed it for
+    lease_seconds, and the worker renews the leases of its URLs with
+    heartbeat while it runs. The URLs of a worker that died are claimed
+    again by the other workers once their lease expired.
+
+    Usage:
+        python -m news_crawler.frontier submit urls.txt [--priority 0]
+        python -m news_crawler.frontier status
+        python -m news_crawler.frontier requeue
+        python -m news_crawler.frontier failures
+        python -m news_crawler.frontier refresh [--older-than 24]
+                                                [--articles]
+"""
+import argparse
+import logging
+import os
+import random
+import socket
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from news_crawler.dedup import canonical_url
+
+logger = logging.getLogger(__name__)
+
+# MongoDB collection name
+FRONTIER_COLLECTION = 'frontier'
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+RETRY = 'retry'
+STATES = (PENDING, IN_FLIGHT, DONE, RETRY, FAILED)
+
+# the statuses that are not worth retrying
+PERMANENT_STATUSES = (404, 410)
+
+# the directory of scrapy.cfg, where the crawls are started
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the order in which the pending URLs are crawled
+NEXT_URLS_SORT = [('priority', DESCENDING), ('submitted_at', ASCENDING)]
+
+
+def worker_id() -> str:
+    """ A name unique to the current process, on any machine.
+    """
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+
+
+class URLFrontier(object):
+    """ The URLs to crawl, in a MongoDB collection, as seen by one worker.
+        The end of the crawl of a URL (done, retry or failed) is buffered
+        and written in bulk, ack_size at a time and before each claim.
+        The n-th retry of a URL waits base_delay * 2 ** (n - 1) seconds, at
+        most max_delay, of which a random half.
+    """
+
+    def __init__(self, collection, ack_size=100, worker=None,
+                 lease_seconds=300, max_attempts=5, base_delay=60,
+                 max_delay=6 * 3600,
+                 permanent_statuses=PERMANENT_STATUSES) -> None:
+        self.collection = collection
+        self.ack_size = ack_size
+        self.acks = []
+        self.worker = worker or worker_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.permanent_statuses = set(permanent_statuses)
+        # the number of claimed URLs whose lease had expired
+        self.reclaimed = 0
+
+    def ensure_indexes(self) -> None:
+        """ The pending URLs are read in order from next_urls, the expired
+            leases from leases and the URLs to retry from retries.
+        """
+        self.collection.create_index(
+            [('state', ASCENDING)] + NEXT_URLS_SORT, name='next_urls')
+        self.collection.create_index(
+            [('state', ASCENDING), ('lease_expires', ASCENDING)],
+            name='leases')
+        self.collection.create_index(
+            [('state', ASCENDING), ('retry_at', ASCENDING)], name='retries')
+
+    def _claimable(self, now) -> dict:
+        return {'$or': [{'state': PENDING},
+                        {'state': IN_FLIGHT, 'lease_expires': {'$lt': now}},
+                        {'state': RETRY, 'retry_at': {'$lte': now}}]}
+
+    def _lease(self, now) -> datetime:
+        return now + timedelta(seconds=self.lease_seconds)
+
+    def submit(self, urls, priority=0, batch_size=1000,
+               refresh=False) -> dict:
+        """ Adds the URLs that are not in the frontier yet, batch_size at a
+            time. urls can be any iterable, such as the lines of a file, it
+            is never loaded in memory at once. refresh flags URLs whose
+            article is already stored.
+            Returns the number of added URLs, and of URLs already submitted.
+        """
+        counts = {'added': 0, 'duplicates': 0}
+        batch = {}
+        for url in urls:
+            url = url.strip()
+            if not url:
+                continue
+            url_id = canonical_url(url)
+            if url_id in batch:
+                counts['duplicates'] += 1
+                continue
+            batch[url_id] = url
+            if len(batch) == batch_size:
+                self._insert(batch, priority, refresh, counts)
+                batch = {}
+        if batch:
+            self._insert(batch, priority, refresh, counts)
+        return counts
+
+    def _insert(self, batch, priority, refresh, counts) -> None:
+        now = datetime.now(timezone.utc)
+        # $setOnInsert leaves the URLs already in the frontier untouched
+        operations = [UpdateOne({'_id': url_id},
+                                {'$setOnInsert': {
+                                    'url': url,
+                                    'priority': priority,
+                                    'state': PENDING,
+                                    'attempts': 0,
+                                    'refresh': refresh,
+                                    'submitted_at': now,
+                                    'updated_at': now,
+                                }},
+                                upsert=True)
+                      for url_id, url in batch.items()]
+        result = self.collection.bulk_write(operations, ordered=False)
+        counts['added'] += result.upserted_count
+        counts['duplicates'] += len(operations) - result.upserted_count
+
+    def claim(self, limit) -> list:
+        """ Leases at most limit pending URLs, or URLs whose lease expired,
+            to this worker, the highest priority and oldest first, and
+            returns them. A URL leased to a worker cannot be claimed by
+            another one.
+        """
+        self.flush()
+        now = datetime.now(timezone.utc)
+        candidates = list(self.collection.find(
+            self._claimable(now), {'state': 1})
+            .sort(NEXT_URLS_SORT).limit(limit))
+        if not candidates:
+            return []
+        # the URLs claimed meanwhile by another worker are not claimable
+        # anymore, and are left out by the same condition
+        claim = uuid.uuid4().hex
+        self.collection.update_many(
+            {'$and': [{'_id': {'$in': [c['_id'] for c in candidates]}},
+                      self._claimable(now)]},
+            {'$set': {'state': IN_FLIGHT, 'claim': claim,
+                      'worker': self.worker,
+                      'lease_expires': self._lease(now),
+                      'updated_at': now},
+             '$inc': {'attempts': 1}})
+        claimed = list(self.collection.find(
+            {'claim': claim, 'state': IN_FLIGHT},
+            {'url': 1, 'priority': 1, 'attempts': 1, 'refresh': 1,
+             'validators': 1}).sort(NEXT_URLS_SORT))
+        expired = {c['_id'] for c in candidates if c['state'] == IN_FLIGHT}
+        self.reclaimed += sum(entry['_id'] in expired for entry in claimed)
+        return claimed
+
+    def heartbeat(self) -> int:
+        """ Renews the leases of the URLs in flight of this worker.
+            Returns their number.
+        """
+        now = datetime.now(timezone.utc)
+        return self.collection.update_many(
+            {'worker': self.worker, 'state': IN_FLIGHT},
+            {'$set': {'lease_expires': self._lease(now)}}).modified_count
+
+    def done(self, url_id, validators=None) -> None:
+        """ Marks a URL as crawled, with the validators of its response if
+            it was fetched in full.
+        """
+        update = {'state': DONE, 'refresh': False}
+        if validators is not None:
+            update['validators'] = validators
+        self._ack(url_id, {'$set': update})
+
+    def refresh(self, older_than=None) -> int:
+        """ Puts back in the pending state the URLs crawled more than
+            older_than seconds ago, or all of them, to be fetched again
+            conditionally. Returns their number.
+        """
+        query = {'state': DONE}
+        if older_than is not None:
+            query['updated_at'] = {'$lt': datetime.now(timezone.utc)
+                                   - timedelta(seconds=older_than)}
+        return self.collection.update_many(
+            query,
+            {'$set': {'state': PENDING, 'refresh': True, 'attempts': 0,
+                      'updated_at': datetime.now(timezone.utc)}}
+        ).modified_count
+
+    def backoff(self, attempts) -> float:
+        """ The seconds to wait before the retry following the attempts-th
+            failure.
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def failed(self, url_id, reason, status=None, attempts=1) -> str:
+        """ Records the failure of the attempts-th crawl of a URL, with the
+            status of the response if there was one. The URL is retried
+            later, unless it failed too many times or the status is
+            permanent. Returns the new state of the URL.
+        """
+        now = datetime.now(timezone.utc)
+        update = {'state': FAILED, 'error': reason, 'last_status': status,
+                  'failed_at': now}
+        if attempts < self.max_attempts \
+                and status not in self.permanent_statuses:
+            update['state'] = RETRY
+            update['retry_at'] = now + timedelta(
+                seconds=self.backoff(attempts))
+        # the last failures are kept for the report
+        self._ack(url_id, {
+            '$set': update,
+            '$push': {'failures': {'$each': [{'status': status,
+                                              'error': reason,
+                                              'at': now}],
+                                   '$slice': -self.max_attempts}}})
+        return update['state']
+
+    def _ack(self, url_id, update) -> None:
+        if url_id is None:
+            return
+        update['$set']['updated_at'] = datetime.now(timezone.utc)
+        # a url whose lease expired may have been claimed by another worker
+        self.acks.append(UpdateOne({'_id': url_id, 'state': IN_FLIGHT,
+                                    'worker': self.worker}, update))
+        if len(self.acks) >= self.ack_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Writes the buffered done and failed states.
+        """
+        if self.acks:
+            acks, self.acks = self.acks, []
+            self.collection.bulk_write(acks, ordered=False)
+
+    def release(self) -> int:
+        """ Puts back in the pending state the URLs leased to this worker
+            that are still in flight, when the crawl stopped before the end.
+            Returns the number of released URLs.
+        """
+        self.flush()
+        return self._requeue({'worker': self.worker, 'state': IN_FLIGHT})
+
+    def requeue(self) -> int:
+        """ Puts all the in flight URLs back in the pending state, without
+            waiting for their lease to expire. Only safe when no crawl runs.
+            Returns the number of requeued URLs.
+        """
+        return self._requeue({'state': IN_FLIGHT})
+
+    def _requeue(self, query) -> int:
+        return self.collection.update_many(
+            query,
+            {'$set': {'state': PENDING,
+                      'updated_at': datetime.now(timezone.utc)},
+             '$unset': {'claim': '', 'worker': '',
+                        'lease_expires': ''}}).modified_count
+
+    def counts(self) -> dict:
+        """ Returns the number of URLs in each state.
+        """
+        counts = dict.fromkeys(STATES, 0)
+        for group in self.collection.aggregate(
+                [{'$group': {'_id': '$state', 'count': {'$sum': 1}}}]):
+            counts[group['_id']] = group['count']
+        return counts
+
+    def failure_report(self) -> list:
+        """ Returns the number of URLs to retry and given up on per last
+            status, with the largest number of attempts and the next retry.
+        """
+        report = self.collection.aggregate([
+            {'$match': {'state': {'$in': [RETRY, FAILED]}}},
+            {'$group': {'_id': {'status': '$last_status', 'state': '$state'},
+                        'count': {'$sum': 1},
+                        'max_attempts': {'$max': '$attempts'},
+                        'next_retry': {'$min': '$retry_at'},
+                        'last_failure': {'$max': '$failed_at'}}},
+            {'$sort': {'count': DESCENDING}},
+        ])
+        return [dict(group.pop('_id'), **group) for group in report]
+
+    def in_flight(self, exclude_worker=None) -> int:
+        """ Returns the number of URLs in flight, of all the workers but
+            exclude_worker.
+        """
+        query = {'state': IN_FLIGHT}
+        if exclude_worker is not None:
+            query['worker'] = {'$ne': exclude_worker}
+        return self.collection.count_documents(query)
+
+    def workers(self) -> dict:
+        """ Returns the number of URLs in flight of each worker.
+        """
+        return {group['_id']: group['count']
+                for group in self.collection.aggregate([
+                    {'$match': {'state': IN_FLIGHT}},
+                    {'$group': {'_id': '$worker', 'count': {'$sum': 1}}}])}
+
+
+def main() -> None:
+    # imported here, the spiders only need the frontier class
+    from database import connection
+
+    parser = argparse.ArgumentParser(description='Manage the URL frontier')
+    parser.add_argument('command',
+                        choices=['submit', 'status', 'requeue', 'failures',
+                                 'refresh'])
+    parser.add_argument('file', nargs='?', default='-',
+                        help='file of URLs to submit, one per line')
+    parser.add_argument('--priority', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--older-than', type=float,
+                        help='refresh the URLs crawled more than this many '
+                        + 'hours ago')
+    parser.add_argument('--articles', action='store_true',
+                        help='also refresh the stored articles that are not '
+                        + 'in the frontier')
+    parser.add_argument('--database',
+                        default=os.getenv('MONGODB_DATABASE') or 'BBC')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    _conf = connection.MongoDB()
+    frontier = URLFrontier(_conf.get_client()[args.database]
+                           [FRONTIER_COLLECTION])
+    frontier.ensure_indexes()
+
+    if args.command == 'submit':
+        with (sys.stdin if args.file == '-' else open(args.file)) as file:
+            counts = frontier.submit(file, args.priority, args.batch_size)
+        logger.info(f"submit: {counts['added']} URLs added, "
+                    + f"{counts['duplicates']} already submitted")
+    elif args.command == 'status':
+        for state, count in frontier.counts().items():
+            print(f'{state:<10}{count:>10}')
+        for worker, count in frontier.workers().items():
+            print(f'{worker}: {count} URLs in flight')
+    elif args.command == 'requeue':
+        logger.info(f'requeue: {frontier.requeue()} URLs requeued')
+    elif args.command == 'refresh':
+        if args.articles:
+            articles = _conf.get_client()[args.database].articles.find(
+                {}, {'article_url': 1, '_id': 0}).batch_size(args.batch_size)
+            counts = frontier.submit(
+                (article.get('article_url') or '' for article in articles),
+                args.priority, args.batch_size, refresh=True)
+            logger.info(f"refresh: {counts['added']} stored articles added")
+        older_than = args.older_than * 3600 \
+            if args.older_than is not None else None
+        logger.info(f'refresh: {frontier.refresh(older_than)} URLs to '
+                    + 'fetch again')
+    elif args.command == 'failures':
+        print(f"{'status':<8}{'state':<8}{'urls':>8}{'attempts':>10}"
+              + '  next retry')
+        for group in frontier.failure_report():
+            print(f"{str(group['status']):<8}{group['state']:<8}"
+                  + f"{group['count']:>8}{group['max_attempts']:>10}  "
+                  + f"{group['next_retry'] or '-'}")
+    _conf.close()
+
+
+if __name__ == '__main__':
+    main()
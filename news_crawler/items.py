@@ -11,3 +11,4 @@ class ArticleItem(scrapy.Item):
     text = scrapy.Field()
     images = scrapy.Field()
     tags = scrapy.Field()
+    tag_slugs = scrapy.Field()
@@ -0,0 +1,181 @@
+""" This module runs the crawls as background jobs, so that the API returns
+    as soon as a crawl is requested instead of waiting for it to end.
+
+    The jobs are stored in the crawl_jobs collection of MongoDB, shared by
+    all the API workers. A job is queued, then started in its own scrapy
+    process as soon as less than max_jobs crawls are running. Each running
+    job holds one of the max_jobs slots, and the unique index on the slot
+    makes sure two API workers never start more crawls than that.
+    The crawl reports its progress in the job with the CrawlJobExtension of
+    extensions.py, and starts the next queued job when it ends.
+
+        queued -> running -> finished, failed or cancelled
+"""
+import subprocess
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from news_crawler.frontier import PROJECT_DIR
+
+# MongoDB collection name
+JOBS_COLLECTION = 'crawl_jobs'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# the crawl processes started by this process, kept to reap them once they
+# exit
+_processes = []
+
+
+def spawn_crawl(job_id) -> int:
+    """ Starts the crawl of a job in a new scrapy process, detached from
+        the current one. Returns its pid.
+    """
+    _processes[:] = [p for p in _processes if p.poll() is None]
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'scrapy', 'crawl', 'news_crawler',
+         '-s', f'CRAWL_JOB_ID={job_id}'],
+        cwd=PROJECT_DIR, stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True)
+    _processes.append(process)
+    return process.pid
+
+
+class CrawlJobs(object):
+    """ The crawl jobs, in a MongoDB collection.
+        A running job that did not report its progress for stale_seconds is
+        considered lost, and its slot is given to the next queued job.
+    """
+
+    def __init__(self, collection, max_jobs=1, stale_seconds=120) -> None:
+        self.collection = collection
+        self.max_jobs = max_jobs
+        self.stale_seconds = stale_seconds
+
+    def ensure_indexes(self) -> None:
+        # only the running jobs have a slot
+        self.collection.create_index(
+            'slot', unique=True, name='running_slots',
+            partialFilterExpression={'slot': {'$exists': True}})
+        self.collection.create_index([('state', ASCENDING),
+                                      ('created_at', ASCENDING)],
+                                     name='queue')
+
+    def create(self) -> dict:
+        """ Queues a new job and returns it.
+        """
+        now = datetime.now(timezone.utc)
+        job = {
+            '_id': uuid.uuid4().hex,
+            'state': QUEUED,
+            'created_at': now,
+            'updated_at': now,
+            'stats': {},
+        }
+        self.collection.insert_one(job)
+        return job
+
+    def get(self, job_id) -> dict:
+        return self.collection.find_one({'_id': job_id})
+
+    def recent(self, limit=20) -> list:
+        return list(self.collection.find().sort('created_at', DESCENDING)
+                    .limit(limit))
+
+    def queue_position(self, job) -> int:
+        """ The number of queued jobs that will start before job.
+        """
+        return self.collection.count_documents(
+            {'state': QUEUED, 'created_at': {'$lt': job['created_at']}})
+
+    def cancel(self, job_id) -> dict:
+        """ Cancels a queued job at once. A running job is only flagged,
+            its crawl stops at its next progress report.
+            Returns the job, or None if it does not exist.
+        """
+        now = datetime.now(timezone.utc)
+        job = self.collection.find_one_and_update(
+            {'_id': job_id, 'state': QUEUED},
+            {'$set': {'state': CANCELLED, 'finished_at': now,
+                      'updated_at': now}},
+            return_document=ReturnDocument.AFTER)
+        if job is None:
+            job = self.collection.find_one_and_update(
+                {'_id': job_id, 'state': RUNNING},
+                {'$set': {'cancel_requested': True}},
+                return_document=ReturnDocument.AFTER)
+        return job or self.get(job_id)
+
+    def dispatch(self, start=spawn_crawl) -> list:
+        """ Starts the oldest queued jobs in the free slots, with
+            start(job_id) which returns the pid of the crawl.
+            Returns the ids of the started jobs.
+        """
+        self.reap_stale()
+        started = []
+        for slot in range(self.max_jobs):
+            now = datetime.now(timezone.utc)
+            try:
+                job = self.collection.find_one_and_update(
+                    {'state': QUEUED},
+                    {'$set': {'state': RUNNING, 'slot': slot,
+                              'started_at': now, 'updated_at': now}},
+                    sort=[('created_at', ASCENDING)],
+                    return_document=ReturnDocument.AFTER)
+            except DuplicateKeyError:
+                # the slot is held by a running job
+                continue
+            if job is None:
+                break
+            try:
+                pid = start(job['_id'])
+            except OSError as e:
+                self.finish(job['_id'], FAILED, f'Could not start: {e}')
+                continue
+            self.collection.update_one({'_id': job['_id']},
+                                       {'$set': {'pid': pid}})
+            started.append(job['_id'])
+        return started
+
+    def heartbeat(self, job_id, stats) -> bool:
+        """ Saves the progress of a running job.
+            Returns whether the job was cancelled.
+        """
+        job = self.collection.find_one_and_update(
+            {'_id': job_id},
+            {'$set': {'stats': stats,
+                      'updated_at': datetime.now(timezone.utc)}},
+            projection={'cancel_requested': 1, 'state': 1})
+        return job is None or job.get('cancel_requested', False) \
+            or job['state'] != RUNNING
+
+    def finish(self, job_id, state, reason=None, stats=None) -> None:
+        """ Ends a job and frees its slot.
+        """
+        now = datetime.now(timezone.utc)
+        update = {'state': state, 'reason': reason, 'finished_at': now,
+                  'updated_at': now}
+        if stats is not None:
+            update['stats'] = stats
+        self.collection.update_one({'_id': job_id},
+                                   {'$set': update, '$unset': {'slot': ''}})
+
+    def reap_stale(self) -> int:
+        """ Fails the running jobs whose crawl stopped reporting, usually
+            because its process was killed.
+        """
+        now = datetime.now(timezone.utc)
+        return self.collection.update_many(
+            {'state': RUNNING,
+             'updated_at': {'$lt': now - timedelta(
+                 seconds=self.stale_seconds)}},
+            {'$set': {'state': FAILED, 'reason': 'lost',
+                      'finished_at': now, 'updated_at': now},
+             '$unset': {'slot': ''}}).modified_count
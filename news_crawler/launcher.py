@@ -0,0 +1,109 @@
+""" This module starts several crawl processes that share the URL frontier,
+    and reports their combined throughput until they all end.
+    Each worker claims its own URLs from the frontier, so the workers can
+    also be started on several machines using the same MongoDB.
+
+    Usage:
+        python -m news_crawler.launcher --workers 4 [--interval 10]
+                                        [-s NAME=VALUE ...]
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from news_crawler.frontier import (DONE, FAILED, FRONTIER_COLLECTION,
+                                   IN_FLIGHT, PENDING, PROJECT_DIR,
+                                   URLFrontier)
+
+logger = logging.getLogger(__name__)
+
+
+def start_worker(index, settings) -> subprocess.Popen:
+    """ Starts a crawl process, which logs to its own file.
+    """
+    args = [sys.executable, '-m', 'scrapy', 'crawl', 'news_crawler',
+            '-s', f'FRONTIER_WORKER={socket.gethostname()}-{os.getpid()}'
+            + f'-w{index}',
+            '-s', f'LOG_FILE=crawler-w{index}.log']
+    for setting in settings:
+        args += ['-s', setting]
+    return subprocess.Popen(args, cwd=PROJECT_DIR)
+
+
+def processed(counts) -> int:
+    return counts[DONE] + counts[FAILED]
+
+
+def report(frontier, start, started_at, last, last_at) -> dict:
+    """ Logs the progress of the frontier since the start and since the
+        last report. Returns the current counts.
+    """
+    counts = frontier.counts()
+    now = time.monotonic()
+    total_rate = (processed(counts) - processed(start)) \
+        / max(now - started_at, 1e-9)
+    rate = (processed(counts) - processed(last)) / max(now - last_at, 1e-9)
+    logger.info(f'done={counts[DONE]} failed={counts[FAILED]} '
+                + f'pending={counts[PENDING]} '
+                + f'in_flight={counts[IN_FLIGHT]} '
+                + f'{rate:.1f} URLs/s now, {total_rate:.1f} URLs/s overall')
+    return counts
+
+
+def main() -> None:
+    # imported here, the workers only need the frontier class
+    from database import connection
+
+    parser = argparse.ArgumentParser(
+        description='Start crawl workers sharing the URL frontier')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--interval', type=float, default=10,
+                        help='seconds between two reports')
+    parser.add_argument('-s', '--set', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='scrapy setting passed to each worker')
+    parser.add_argument('--database',
+                        default=os.getenv('MONGODB_DATABASE') or 'BBC')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    _conf = connection.MongoDB()
+    frontier = URLFrontier(_conf.get_client()[args.database]
+                           [FRONTIER_COLLECTION])
+    frontier.ensure_indexes()
+
+    start = last = frontier.counts()
+    started_at = last_at = time.monotonic()
+    workers = [start_worker(i, args.set) for i in range(args.workers)]
+    logger.info(f'Started {len(workers)} workers')
+    try:
+        while any(worker.poll() is None for worker in workers):
+            time.sleep(args.interval)
+            last = report(frontier, start, started_at, last, last_at)
+            last_at = time.monotonic()
+    except KeyboardInterrupt:
+        # a first SIGINT makes scrapy finish the requests in progress and
+        # release the other URLs of the worker
+        logger.info('Stopping the workers')
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGINT)
+        for worker in workers:
+            worker.wait()
+
+    end = frontier.counts()
+    elapsed = time.monotonic() - started_at
+    logger.info(f'{processed(end) - processed(start)} URLs in {elapsed:.1f}s'
+                + f' by {len(workers)} workers, '
+                + f'{(processed(end) - processed(start)) / elapsed:.1f}'
+                + ' URLs/s, exit codes '
+                + ' '.join(str(worker.returncode) for worker in workers))
+    _conf.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+""" This module makes logging cheap on the hot paths of the crawler and of
+    the API, when it runs with LOG_QUEUE_ENABLED (see LoggingExtension in
+    extensions.py) or API_LOG_QUEUE (see app.py).
+
+    The handlers of a logger are moved behind a queue: the thread logging a
+    record only puts it in the queue, and a background thread formats it,
+    as a line of text or of JSON, and writes it. The messages are formatted
+    lazily, by the background thread, so their arguments must not change
+    once logged. When the queue is full the records are dropped rather than
+    blocking the crawl.
+
+    The hot paths log events through an EventLogger, with the fields of the
+    event, which the JSON lines keep:
+        events.info('response', 'GET %s %s', url, status,
+                    url=url, status=status)
+    The records of an event can be sampled (LOG_SAMPLE_RATES, the share of
+    records kept) or rate limited (LOG_RATE_LIMITS, records per second).
+    An event is sampled before its record is even created, which is most of
+    the cost of a record. The records not logged by an EventLogger, and the
+    warnings and errors, are always kept.
+"""
+import logging
+import queue
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+import orjson
+
+# the attributes every record has, the others were given with extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) \
+    | {'message', 'asctime'}
+
+# the filter of the started QueuedLogging, which the event loggers sample
+# their events with
+_event_filter = None
+
+
+class JSONFormatter(logging.Formatter):
+    """ Formats a record as a JSON line with its time, level, logger and
+        message, and the fields given with extra=.
+    """
+
+    def format(self, record) -> str:
+        created = datetime.fromtimestamp(record.created, timezone.utc)
+        document = {
+            'time': created.isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                # the spider loggers add the spider itself
+                document[key] = getattr(value, 'name', value) \
+                    if key == 'spider' else value
+        if record.exc_info:
+            document['exception'] = self.formatException(record.exc_info)
+        return orjson.dumps(document, default=str).decode('utf-8')
+
+
+class EventFilter(object):
+    """ Keeps sample_rates[event] of the records of an event, and at most
+        rate_limits[event] records of an event per second. The dropped
+        records are counted per event.
+    """
+
+    def __init__(self, sample_rates=None, rate_limits=None,
+                 rng=random.random, clock=time.monotonic) -> None:
+        self.sample_rates = dict(sample_rates or {})
+        self.rate_limits = dict(rate_limits or {})
+        self.rng = rng
+        self.clock = clock
+        # the [tokens, time] of the bucket of each rate limited event
+        self.buckets = {}
+        self.dropped = Counter()
+
+    def keep(self, event) -> bool:
+        rate = self.sample_rates.get(event)
+        if rate is not None and self.rng() >= rate:
+            self.dropped[event] += 1
+            return False
+        limit = self.rate_limits.get(event)
+        if limit is not None and not self._take(event, limit):
+            self.dropped[event] += 1
+            return False
+        return True
+
+    def _take(self, event, limit) -> bool:
+        now = self.clock()
+        bucket = self.buckets.get(event)
+        if bucket is None:
+            bucket = self.buckets[event] = [limit, now]
+        # the bucket refills at limit tokens per second, up to limit
+        bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * limit)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+
+class EventLogger(object):
+    """ Logs the events of a hot path to logger, with the fields of the
+        event. While a QueuedLogging is started, the events it drops are not
+        even turned into records.
+    """
+
+    def __init__(self, logger) -> None:
+        self.logger = logger
+
+    def log(self, level, event, msg, *args, **fields) -> None:
+        if not self.logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING and _event_filter is not None \
+                and not _event_filter.keep(event):
+            return
+        fields['event'] = event
+        self.logger.log(level, msg, *args, extra=fields)
+
+    def debug(self, event, msg, *args, **fields) -> None:
+        self.log(logging.DEBUG, event, msg, *args, **fields)
+
+    def info(self, event, msg, *args, **fields) -> None:
+        self.log(logging.INFO, event, msg, *args, **fields)
+
+    def warning(self, event, msg, *args, **fields) -> None:
+        self.log(logging.WARNING, event, msg, *args, **fields)
+
+
+class LazyQueueHandler(QueueHandler):
+    """ Puts the records in the queue as they are, their message is
+        formatted by the handlers of the listener. The records are dropped
+        once the queue holds queue_size of them.
+    """
+
+    def __init__(self, log_queue, queue_size) -> None:
+        super().__init__(log_queue)
+        self.queue_size = queue_size
+        self.queue_full = 0
+
+    def prepare(self, record) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record) -> None:
+        # a SimpleQueue is unbounded, but much cheaper to put in than a
+        # bounded Queue
+        if self.queue.qsize() >= self.queue_size:
+            self.queue_full += 1
+            return
+        self.queue.put_nowait(record)
+
+
+class QueuedLogging(object):
+    """ Moves handlers of logger behind a queue written by a background
+        thread, with the events sampled by an EventFilter, and formatted
+        as JSON lines with json_format. stop() writes the records left in
+        the queue and gives the handlers back to logger.
+    """
+
+    def __init__(self, logger, handlers, json_format=False, sample_rates=None,
+                 rate_limits=None, queue_size=10000) -> None:
+        self.logger = logger
+        self.handlers = list(handlers)
+        self.formatters = [handler.formatter for handler in self.handlers]
+        self.filter = EventFilter(sample_rates, rate_limits)
+        self.handler = LazyQueueHandler(queue.SimpleQueue(), queue_size)
+        self.listener = QueueListener(self.handler.queue, *self.handlers,
+                                      respect_handler_level=True)
+        self.json_format = json_format
+
+    def start(self) -> None:
+        global _event_filter
+        for handler in self.handlers:
+            if self.json_format:
+                handler.setFormatter(JSONFormatter())
+            self.logger.removeHandler(handler)
+        self.logger.addHandler(self.handler)
+        self.listener.start()
+        _event_filter = self.filter
+
+    def stop(self) -> None:
+        global _event_filter
+        if _event_filter is self.filter:
+            _event_filter = None
+        self.logger.removeHandler(self.handler)
+        self.listener.stop()
+        for handler, formatter in zip(self.handlers, self.formatters):
+            handler.setFormatter(formatter)
+            self.logger.addHandler(handler)
+
+    def dropped(self) -> Counter:
+        """ The records dropped per event, and because the queue was full.
+        """
+        dropped = Counter(self.filter.dropped)
+        if self.handler.queue_full:
+            dropped['queue_full'] = self.handler.queue_full
+        return dropped
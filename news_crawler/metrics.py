@@ -0,0 +1,29 @@
+""" This module defines the Prometheus metrics of the crawler.
+    The pages, bytes and items are counted by the MetricsExtension of
+    extensions.py, the other metrics where they are measured. Rates such as
+    the pages per second or the dedup hit rate are computed by Prometheus,
+    see README.md.
+"""
+from prometheus_client import Counter, Histogram
+
+PAGES = Counter('crawler_pages_total', 'Responses received by the crawler',
+                ['status'])
+RESPONSE_BYTES = Counter('crawler_response_bytes_total',
+                         'Bytes of the responses received by the crawler')
+ITEMS = Counter('crawler_items_total', 'Articles scraped by the crawler')
+
+PARSE_TIME = Histogram(
+    'crawler_parse_duration_seconds',
+    'Time to extract an article from a page', ['path'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+WRITE_LATENCY = Histogram(
+    'crawler_pipeline_write_duration_seconds',
+    'Time of a write of the articles pipeline to MongoDB',
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+WRITTEN = Counter('crawler_pipeline_articles_total',
+                  'Articles handled by the pipeline', ['result'])
+
+DEDUP_LOOKUPS = Counter(
+    'crawler_dedup_lookups_total',
+    'Requests checked against the stored articles, hit when the article '
+    + 'was already stored', ['result'])
@@ -4,15 +4,25 @@
     Response based on what we need.
 """
 
+import hashlib
+import random
+from collections import deque
 from scrapy import signals, Request
 from scrapy.http import Response
+from scrapy.utils.httpobj import urlparse_cached
 import pymongo
-from scrapy.exceptions import IgnoreRequest
+from scrapy.exceptions import IgnoreRequest, NotConfigured
 import logging
 from user_agent import generate_user_agent
+from news_crawler.dedup import SeenURLs, canonical_url
+from news_crawler.logs import EventLogger
+from news_crawler.metrics import DEDUP_LOOKUPS
+from news_crawler.tracing import stage
 
 # Get the logging instance initiated by Scrapy framework
 logger = logging.getLogger(__name__)
+# the hot paths log events with their fields, see news_crawler/logs.py
+events = EventLogger(logger)
 
 
 class ShowUserAgentMiddleware:
@@ -25,34 +35,187 @@ class ShowUserAgentMiddleware:
         print(f"User Agent: {request.headers['User-Agent']}")
 
 
+def agent_id(agent) -> str:
+    """ A short id of the user agent, the same in every crawl, to name its
+        stats.
+    """
+    return hashlib.sha1(agent.encode('utf-8')).hexdigest()[:8]
+
+
+class UserAgentPool(object):
+    """ A pool of user agents, rotated in a shuffled order. A user agent
+        that failed more than max_failure_rate of its last requests, after
+        at least min_requests, is taken out of the rotation, as long as
+        min_active user agents are left.
+    """
+
+    def __init__(self, agents, min_requests=20, max_failure_rate=0.5,
+                 min_active=1, window=100, rng=random) -> None:
+        self.agents = list(agents)
+        self.min_requests = min_requests
+        self.max_failure_rate = max_failure_rate
+        self.min_active = min_active
+        self.window = window
+        # per user agent: requests, failures, and the outcomes of its last
+        # window requests
+        self.usage = {agent: {'requests': 0, 'failures': 0,
+                              'recent': deque(maxlen=window)}
+                      for agent in self.agents}
+        self.retired = set()
+        self.active = list(self.agents)
+        rng.shuffle(self.active)
+        self.position = -1
+
+    @classmethod
+    def generate(cls, size, os_weights, rng=random, **kwargs):
+        """ Generates size user agents once, for each OS of os_weights in
+            proportion to its weight. The same user agent is only kept once.
+        """
+        total = sum(os_weights.values())
+        agents = set()
+        for os_name, weight in os_weights.items():
+            count = max(1, round(size * weight / total))
+            for _ in range(count):
+                agents.add(generate_user_agent(os=os_name))
+        return cls(sorted(agents), rng=rng, **kwargs)
+
+    def next(self) -> str:
+        self.position = (self.position + 1) % len(self.active)
+        return self.active[self.position]
+
+    def is_active(self, agent) -> bool:
+        return agent not in self.retired
+
+    def record(self, agent, failed) -> bool:
+        """ Records the outcome of a request sent with agent. Returns
+            whether the agent was taken out of the rotation.
+        """
+        usage = self.usage.get(agent)
+        if usage is None:
+            return False
+        usage['requests'] += 1
+        usage['failures'] += failed
+        usage['recent'].append(failed)
+        recent = usage['recent']
+        if agent in self.retired or len(recent) < self.min_requests \
+                or sum(recent) / len(recent) <= self.max_failure_rate \
+                or len(self.active) <= self.min_active:
+            return False
+        self.retired.add(agent)
+        self.active.remove(agent)
+        self.position = min(self.position, len(self.active) - 1)
+        return True
+
+    def report(self) -> list:
+        """ The id, requests, failures and failure rate of each user agent,
+            with whether it was retired, from the most used.
+        """
+        return sorted(
+            ({'user_agent': agent, 'id': agent_id(agent),
+              'requests': usage['requests'],
+              'failures': usage['failures'],
+              'failure_rate': usage['failures'] / usage['requests']
+              if usage['requests'] else 0.0,
+              'retired': agent in self.retired}
+             for agent, usage in self.usage.items()),
+            key=lambda row: row['requests'], reverse=True)
+
+
 class ShuffleUserAgentMiddleware:
-    """ This module generate random user agents using the user_agent
-        library and add it to each request.
+    """ This middleware sets the user agent of each request from a pool of
+        USER_AGENT_POOL_SIZE user agents generated once with the user_agent
+        library, with USER_AGENT_OS_WEIGHTS for the share of each OS.
+        With USER_AGENT_STICKY each domain keeps the same user agent, until
+        it is retired.
+        The responses whose origin status is not 200 (nor one of
+        USER_AGENT_IGNORED_STATUSES, which do not depend on the user agent)
+        and the failed downloads count as failures of the user agent, see
+        UserAgentPool. The use of each user agent is logged and kept in the
+        user_agent/* stats when the spider closes.
     """
+
+    def __init__(self, stats, pool, sticky=False,
+                 ignored_statuses=(404, 410)) -> None:
+        self.stats = stats
+        self.pool = pool
+        self.sticky = sticky
+        self.ignored_statuses = set(ignored_statuses)
+        # the user agent of each domain with USER_AGENT_STICKY
+        self.domains = {}
+
     @classmethod
     def from_crawler(cls, crawler):
-        """ Used for signal spider logs.
+        """ Builds the pool of user agents.
             Whenever a spider is opened or closed, it will be logged.
         """
-        s = cls()
+        settings = crawler.settings
+        pool = UserAgentPool.generate(
+            settings.getint('USER_AGENT_POOL_SIZE', 50),
+            settings.getdict('USER_AGENT_OS_WEIGHTS',
+                             {'win': 1, 'mac': 1, 'linux': 1}),
+            min_requests=settings.getint('USER_AGENT_MIN_REQUESTS', 20),
+            max_failure_rate=settings.getfloat(
+                'USER_AGENT_MAX_FAILURE_RATE', 0.5),
+            min_active=settings.getint('USER_AGENT_MIN_ACTIVE', 1))
+        s = cls(crawler.stats, pool,
+                sticky=settings.getbool('USER_AGENT_STICKY'),
+                ignored_statuses=[int(status) for status in settings.getlist(
+                    'USER_AGENT_IGNORED_STATUSES', [404, 410])])
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
         return s
 
     def process_request(self, request, spider) -> None:
-        logger.info(f"Changing User Agent for {request.url}")
+        with stage(request.meta, 'user_agent'):
+            u_agent = request.meta.get('user_agent')
+            if u_agent is None or not self.pool.is_active(u_agent):
+                u_agent = self._choose(request)
+                request.meta['user_agent'] = u_agent
+            request.headers['User-Agent'] = u_agent
+
+    def _choose(self, request) -> str:
+        if not self.sticky:
+            return self.pool.next()
+        domain = urlparse_cached(request).hostname
+        u_agent = self.domains.get(domain)
+        if u_agent is None or not self.pool.is_active(u_agent):
+            u_agent = self.domains[domain] = self.pool.next()
+        return u_agent
 
-        # generate user-agent for mac, linux and windows browsers
-        u_agent = generate_user_agent(os=('mac', 'linux', 'win'))
-        request.headers['User-Agent'] = u_agent
+    def process_response(self, request, response, spider) -> Response:
+        status = origin_status(response)
+        self._record(request, status not in (200, 304)
+                     and status not in self.ignored_statuses)
+        return response
+
+    def process_exception(self, request, exception, spider) -> None:
+        self._record(request, True)
+
+    def _record(self, request, failed) -> None:
+        u_agent = request.meta.get('user_agent')
+        if u_agent is not None and self.pool.record(u_agent, failed):
+            logger.warning(f'User agent {u_agent} taken out of the rotation')
+            self.stats.inc_value('user_agent/retired')
 
     def spider_opened(self, spider) -> None:
         spider.logger.info('Spider %s opened from %s.%s'
                            % (spider.name, __name__, __class__.__name__))
+        self.stats.set_value('user_agent/pool_size', len(self.pool.agents))
 
     def spider_closed(self, spider) -> None:
         spider.logger.info('Spider %s closed from %s.%s'
                            % (spider.name, __name__, __class__.__name__))
+        for usage in self.pool.report():
+            if not usage['requests']:
+                continue
+            self.stats.set_value(f"user_agent/{usage['id']}/requests",
+                                 usage['requests'])
+            self.stats.set_value(f"user_agent/{usage['id']}/failures",
+                                 usage['failures'])
+            logger.info(f"{usage['id']}: {usage['requests']} requests, "
+                        + f"{usage['failure_rate']:.0%} failed"
+                        + (' (retired)' if usage['retired'] else '')
+                        + f": {usage['user_agent']}")
 
 
 class NewsCrawlerDownloaderMiddleware:
@@ -62,65 +225,114 @@ class NewsCrawlerDownloaderMiddleware:
     # MongoDB collection name
     collection_name = 'articles'
 
-    def __init__(self, mongo_uri, mongo_db) -> None:
+    def __init__(self, mongo_uri, mongo_db, stats,
+                 seen_urls_filter='exact', seen_urls_capacity=1000000,
+                 seen_urls_error_rate=0.001) -> None:
         """ Assigns the mongo uri and db name after getting them
            from the classmethod"""
         self.mongo_uri = mongo_uri
         self.mongo_db = mongo_db
+        self.stats = stats
+        self.seen_urls = SeenURLs(seen_urls_filter, seen_urls_capacity,
+                                  seen_urls_error_rate)
+        # canonical urls scraped during this crawl, the buffered pipeline
+        # may not have written them to MongoDB yet
+        self.scraped_urls = set()
 
     @classmethod
     def from_crawler(cls, crawler):
         """ Same as in each middleware class, but this time we
             create the instance with mongo_uri and mongo_db
         """
+        settings = crawler.settings
         s = cls(
-                mongo_uri=crawler.settings.get('MONGO_URI'),
-                mongo_db=crawler.settings.get('MONGO_DATABASE')
+                mongo_uri=settings.get('MONGO_URI'),
+                mongo_db=settings.get('MONGO_DATABASE'),
+                stats=crawler.stats,
+                seen_urls_filter=settings.get('SEEN_URLS_FILTER', 'exact'),
+                seen_urls_capacity=settings.getint('SEEN_URLS_CAPACITY',
+                                                   1000000),
+                seen_urls_error_rate=settings.getfloat(
+                    'SEEN_URLS_ERROR_RATE', 0.001)
             )
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
         return s
 
     def process_request(self, request, spider) -> None:
         """ Checks if the request's URL has been processed before,
-            by searching for its existence in the MongoDB collection.
+            by searching for it in the in-memory seen URLs. MongoDB is only
+            queried when the Bloom filter reports a possible match.
         """
+        with stage(request.meta, 'dedup'):
+            return self._check_processed(request)
+
+    def _check_processed(self, request) -> None:
         url = request.url
-        col = self.db[self.collection_name]
-        cursor = col.find_one({"article_url": url})
-        if cursor:
-            # if the url was found in the db, ignorr the request
-            # and log the event
-            logger.info(f'{url} is already processed. Ignoring request!')
-            raise IgnoreRequest
-        return None
+        # the articles refreshed on purpose are already stored
+        if request.meta.get('refresh'):
+            return None
+        if url not in self.seen_urls:
+            DEDUP_LOOKUPS.labels('miss').inc()
+            return None
+
+        if not self.seen_urls.exact and \
+                canonical_url(url) not in self.scraped_urls:
+            self.stats.inc_value('dedup/db_lookups')
+            col = self.db[self.collection_name]
+            cursor = col.find_one(
+                {"article_url": {"$in": list({url, canonical_url(url)})}},
+                {"_id": 1})
+            if not cursor:
+                self.stats.inc_value('dedup/false_positives')
+                DEDUP_LOOKUPS.labels('miss').inc()
+                return None
+
+        # if the url was found in the db, ignorr the request
+        # and log the event
+        self.stats.inc_value('dedup/ignored')
+        DEDUP_LOOKUPS.labels('hit').inc()
+        # the spider marks it as done, not failed, in the frontier
+        request.meta['already_processed'] = True
+        events.info('already_processed',
+                    '%s is already processed. Ignoring request!', url, url=url)
+        raise IgnoreRequest
 
     def process_response(self, request, response, spider) -> Response:
         """ If the response status is anything other than 200,
-            the request is ignored, the event is logged, and the url is
-            appended to a error_urls.txt file.
+            the request is ignored and the event is logged. The spider
+            records the failure with its status in the frontier, which
+            retries the url later.
         """
         # Excluding https://www.bbc.com/robots.txt since it needs different
         # implementation and it needs to be processed no matter what
         if not request.url.endswith("robots.txt"):
+            if response.status == 304 and (
+                    request.meta.get('refresh')
+                    or request.meta.get('discovery_source')):
+                # the page or the feed did not change since it was fetched,
+                # the spider does not parse it
+                events.info('response', 'GET %s 304', request.url,
+                            url=request.url, status=304)
+                request.meta['not_modified'] = True
+                raise IgnoreRequest
+
             # get the response status from the headers
-            response_status = \
-                    response.headers['X-Bbc-Origin-Response-Status'] \
-                    .decode('utf-8')
+            response_status = origin_status(response)
 
             url = request.url
             # check the status and act accordingly
-            if response_status == '200':
-                logger.info(f"GET {url} 200")
+            if response_status == 200:
+                events.info('response', 'GET %s 200', url, url=url,
+                            status=200)
                 return response
             else:
-                logger.warning(f"GET {url} {response_status}."
-                               + "Ignoring request!")
-
-                with open('error_urls.txt', 'a') as f:
-                    f.write(f'{url}\n')
-
-                logger.warning(f"Saved to error_urls.txt.")
+                events.warning('response', 'GET %s %s. Ignoring request!',
+                               url, response_status, url=url,
+                               status=response_status)
+                self.stats.inc_value(f'origin_status/{response_status}')
+                request.meta['origin_status'] = response_status
                 raise IgnoreRequest
         return response
 
@@ -140,9 +352,182 @@ class NewsCrawlerDownloaderMiddleware:
         self.client = pymongo.MongoClient(self.mongo_uri)
         self.db = self.client[self.mongo_db]
 
+        # stream only the urls of the stored articles into the seen URLs
+        cursor = self.db[self.collection_name].find(
+            {}, {"article_url": 1, "_id": 0}).batch_size(10000)
+        count = 0
+        for document in cursor:
+            self.seen_urls.add(document.get("article_url"))
+            count += 1
+        self.stats.set_value('dedup/seen_urls_loaded', count)
+        logger.info(f'Loaded {count} processed URLs.')
+
+    def item_scraped(self, item, response, spider) -> None:
+        """ Once an article went through the pipeline, both its og:url and
+            the URL it was requested with are marked as processed.
+        """
+        for url in (item.get('article_url'), response.url):
+            if url:
+                self.seen_urls.add(url)
+                self.scraped_urls.add(canonical_url(url))
+
     def spider_closed(self, spider) -> None:
         """ Closes the DB connection when the spider is closed.
         """
         spider.logger.info('Spider %s closed from %s.%s'
                            % (spider.name, __name__, __class__.__name__))
         self.client.close()
+
+
+def origin_status(response) -> int:
+    """ The status of the response of the origin server behind the BBC
+        cache, or the status of the response if it has none.
+    """
+    status = response.headers.get('X-Bbc-Origin-Response-Status')
+    try:
+        return int(status) if status else response.status
+    except ValueError:
+        return response.status
+
+
+class AdaptiveConcurrencyMiddleware:
+    """ This middleware adjusts the download delay and concurrency of each
+        domain (downloader slot) with AIMD, additive increase and
+        multiplicative decrease.
+
+        After each window of successful responses (as many as the current
+        concurrency), the delay is decreased by ADAPTIVE_DELAY_STEP down to
+        ADAPTIVE_MIN_DELAY, then the concurrency is increased by one up to
+        ADAPTIVE_MAX_CONCURRENCY.
+        When the origin answers with a status of ADAPTIVE_BACKOFF_STATUSES,
+        a download fails, or the average latency goes above
+        ADAPTIVE_TARGET_LATENCY, the concurrency is multiplied by
+        ADAPTIVE_DECREASE_FACTOR and the delay doubled. The responses of the
+        requests that were already sent then do not decrease them again.
+
+        DOWNLOAD_DELAY and CONCURRENT_REQUESTS_PER_DOMAIN are the starting
+        values. It has to run before NewsCrawlerDownloaderMiddleware, which
+        ignores the responses that are not 200.
+    """
+
+    # latencies are averaged with this weight for the last one
+    latency_weight = 0.3
+
+    def __init__(self, crawler, min_concurrency=1, max_concurrency=8,
+                 min_delay=0.25, max_delay=30.0, delay_step=0.25,
+                 target_latency=2.0, decrease_factor=0.5,
+                 backoff_statuses=(429, 500, 502, 503, 504)) -> None:
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay_step = delay_step
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.backoff_statuses = set(backoff_statuses)
+        # per slot: average latency, successes in the current window,
+        # number of responses received, and number of responses after which
+        # another decrease is allowed
+        self.states = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        return cls(
+            crawler,
+            min_concurrency=settings.getint('ADAPTIVE_MIN_CONCURRENCY', 1),
+            max_concurrency=settings.getint('ADAPTIVE_MAX_CONCURRENCY', 8),
+            min_delay=settings.getfloat('ADAPTIVE_MIN_DELAY', 0.25),
+            max_delay=settings.getfloat('ADAPTIVE_MAX_DELAY', 30.0),
+            delay_step=settings.getfloat('ADAPTIVE_DELAY_STEP', 0.25),
+            target_latency=settings.getfloat('ADAPTIVE_TARGET_LATENCY', 2.0),
+            decrease_factor=settings.getfloat('ADAPTIVE_DECREASE_FACTOR',
+                                              0.5),
+            backoff_statuses=[int(status) for status in settings.getlist(
+                'ADAPTIVE_BACKOFF_STATUSES', [429, 500, 502, 503, 504])]
+        )
+
+    def _slot(self, request):
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        return key, slot
+
+    def process_response(self, request, response, spider) -> Response:
+        key, slot = self._slot(request)
+        if slot is not None:
+            self.observe(key, slot, origin_status(response),
+                         request.meta.get('download_latency'))
+        return response
+
+    def process_exception(self, request, exception, spider) -> None:
+        # timeouts and connection errors are a sign of congestion too
+        key, slot = self._slot(request)
+        if slot is not None:
+            state = self.states.setdefault(key, {})
+            self._received(state)
+            self.decrease(key, slot, state)
+
+    def _received(self, state) -> None:
+        state['received'] = state.get('received', 0) + 1
+
+    def observe(self, key, slot, status, latency) -> None:
+        """ Updates the delay and concurrency of slot from the status and
+            latency of one of its responses.
+        """
+        if key not in self.states:
+            self._report(key, slot)
+        state = self.states.setdefault(key, {})
+        self._received(state)
+        if latency is not None:
+            average = state.get('latency', latency)
+            state['latency'] = average + self.latency_weight \
+                * (latency - average)
+            self.stats.set_value(f'adaptive/{key}/latency_ms',
+                                 int(state['latency'] * 1000))
+
+        if status in self.backoff_statuses \
+                or state.get('latency', 0) > self.target_latency:
+            self.decrease(key, slot, state)
+        elif status in (200, 304):
+            self.increase(key, slot, state)
+
+    def increase(self, key, slot, state) -> None:
+        state['successes'] = state.get('successes', 0) + 1
+        if state['successes'] < slot.concurrency:
+            return
+        state['successes'] = 0
+        if slot.delay > self.min_delay:
+            slot.delay = max(self.min_delay, slot.delay - self.delay_step)
+        elif slot.concurrency < self.max_concurrency:
+            slot.concurrency += 1
+        else:
+            return
+        self.stats.inc_value(f'adaptive/{key}/increases')
+        self._report(key, slot)
+
+    def decrease(self, key, slot, state) -> None:
+        state['successes'] = 0
+        # the responses of the requests sent before the last decrease
+        # would decrease it again
+        if state['received'] <= state.get('resume_after', 0):
+            return
+        slot.concurrency = max(self.min_concurrency,
+                               int(slot.concurrency * self.decrease_factor))
+        slot.delay = min(self.max_delay,
+                         max(slot.delay * 2, self.min_delay))
+        # the slot's active requests include the one being processed
+        state['resume_after'] = state['received'] \
+            + max(0, len(getattr(slot, 'active', ())) - 1)
+        self.stats.inc_value(f'adaptive/{key}/decreases')
+        logger.info(f'Backing off {key}: concurrency {slot.concurrency}, '
+                    + f'delay {slot.delay:.2f}s')
+        self._report(key, slot)
+
+    def _report(self, key, slot) -> None:
+        self.stats.set_value(f'adaptive/{key}/concurrency', slot.concurrency)
+        self.stats.set_value(f'adaptive/{key}/delay_ms',
+                             int(slot.delay * 1000))
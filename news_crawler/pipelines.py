@@ -2,37 +2,81 @@
     Same as middleware, it has to be installed in settings.py,
     and gets triggered after the middlewares finish their work.
 """
+import time
 import pymongo
 import scrapy
+from pymongo.errors import BulkWriteError, PyMongoError
+from twisted.internet import defer, task, threads
 from itemadapter import ItemAdapter
 import logging
+from database.indexes import ensure_article_indexes
+from database.revisions import (REVISIONS_COLLECTION,
+                                ensure_revision_indexes, plan_writes)
+from database.versions import bump_version
+from news_crawler.logs import EventLogger
+from news_crawler.metrics import WRITE_LATENCY, WRITTEN
 
 # get the logging instance created by Scrapy
 logger = logging.getLogger(__name__)
+# the hot paths log events with their fields, see news_crawler/logs.py
+events = EventLogger(logger)
+
+
+def _failed_url(error, operations) -> str:
+    """ The article_url of the operation of a write error, MongoDB returns
+        the operation with the error.
+    """
+    url = (error.get('op') or {}).get('q', {}).get('article_url')
+    return url or f"operation {error['index']} of {len(operations)}"
 
 
 class MongoDBPipeline(object):
     """ This class gets the data from articles.py after the
         response has been processed (cleansed and structured),
         and store them in MongoDB.
+
+        Articles are upserted on their article_url, so a re-crawled article
+        replaces the stored one instead of being inserted twice. A
+        re-crawled article whose headline, text and tags did not change is
+        not written, and the version a changed one replaces is kept as a
+        revision (see database/revisions.py).
+        With MONGO_BUFFERED_WRITES the items are buffered and written as
+        unordered bulk writes from a thread, MONGO_FLUSH_SIZE at a time or
+        every MONGO_FLUSH_INTERVAL seconds, so the reactor never waits for
+        MongoDB. One batch is written at a time, two batches compared with
+        the same stored article would both replace it.
     """
 
     # MongoDB collection name
     collection_name = 'articles'
 
-    def __init__(self, mongo_uri, mongo_db) -> None:
+    def __init__(self, mongo_uri, mongo_db, stats=None, buffered=False,
+                 flush_size=100, flush_interval=5.0) -> None:
         """ Assigns the mongo uri and db name after getting them
            from the classmethod"""
         self.mongo_uri = mongo_uri
         self.mongo_db = mongo_db
+        self.stats = stats
+        self.buffered = buffered
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.pending_flushes = set()
+        self.flush_lock = defer.DeferredLock()
+        self.flush_loop = None
 
     @classmethod
     def from_crawler(cls, crawler):
         """ Create the instance with mongo_uri and mongo_db
         """
+        settings = crawler.settings
         return cls(
-            mongo_uri=crawler.settings.get('MONGO_URI'),
-            mongo_db=crawler.settings.get('MONGO_DATABASE')
+            mongo_uri=settings.get('MONGO_URI'),
+            mongo_db=settings.get('MONGO_DATABASE'),
+            stats=crawler.stats,
+            buffered=settings.getbool('MONGO_BUFFERED_WRITES'),
+            flush_size=settings.getint('MONGO_FLUSH_SIZE', 100),
+            flush_interval=settings.getfloat('MONGO_FLUSH_INTERVAL', 5.0)
         )
 
     def open_spider(self, spider) -> None:
@@ -42,18 +86,137 @@ class MongoDBPipeline(object):
         logger.info('Connecting to MongoDB.')
         self.client = pymongo.MongoClient(self.mongo_uri)
         self.db = self.client[self.mongo_db]
+        ensure_article_indexes(self.db[self.collection_name])
+        ensure_revision_indexes(self.db[REVISIONS_COLLECTION])
+        if self.buffered and self.flush_interval > 0:
+            self.flush_loop = task.LoopingCall(self.flush)
+            self.flush_loop.start(self.flush_interval, now=False)
 
-    def close_spider(self, spider) -> None:
-        """ Close the spide and the DB connection
+    def close_spider(self, spider) -> defer.Deferred:
+        """ Flush the buffered items, then close the spide and the
+            DB connection
         """
+        if self.flush_loop is not None and self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush()
+        d = defer.DeferredList(list(self.pending_flushes))
+        d.addBoth(self._close_client)
+        return d
+
+    def _close_client(self, _) -> None:
         logger.info('Closing MongoDB connection.')
         self.client.close()
 
     def process_item(self, item, spider) -> scrapy.Item:
         """ Gets the structure of the crawled article from items.py, and
-            inserting the item as dict into MongoDB
+            upserting the item as dict into MongoDB
         """
-        logger.info(f"Inserting article from {item['article_url']}"
-                    + " into MongoDB.")
-        self.db[self.collection_name].insert_one(ItemAdapter(item).asdict())
+        document = ItemAdapter(item).asdict()
+        if self.buffered:
+            self.buffer.append(document)
+            if len(self.buffer) >= self.flush_size:
+                self.flush()
+            return item
+
+        events.info('insert', 'Inserting article from %s into MongoDB.',
+                    item['article_url'], url=item['article_url'])
+        self._flushed(self._bulk_write([document]), 1)
         return item
+
+    def flush(self) -> defer.Deferred:
+        """ Sends the buffered items to MongoDB as one unordered bulk write
+            in a thread, once the previous one is written. Returns the
+            Deferred of the write.
+        """
+        if not self.buffer:
+            return defer.succeed(None)
+        documents, self.buffer = self.buffer, []
+        events.info('insert', 'Inserting %s articles into MongoDB.',
+                    len(documents), articles=len(documents))
+        d = self.flush_lock.run(threads.deferToThread, self._bulk_write,
+                                documents)
+        d.addCallbacks(self._flushed, self._flush_failed,
+                       callbackArgs=(len(documents),),
+                       errbackArgs=(len(documents),))
+        self.pending_flushes.add(d)
+        d.addBoth(self._forget_flush, d)
+        return d
+
+    def _bulk_write(self, documents) -> tuple:
+        """ Runs in a thread of the reactor's thread pool when the writes are
+            buffered. Returns the upserted, modified and unchanged articles,
+            the stored revisions and the (article_url, error) of the
+            articles that could not be written, with the latency of the
+            write.
+        """
+        start = time.perf_counter()
+        collection = self.db[self.collection_name]
+        operations, revisions, unchanged = plan_writes(collection, documents)
+        upserted = modified = 0
+        failed = []
+        if operations:
+            if revisions:
+                # written first, so that a replaced version is never lost
+                try:
+                    self.db[REVISIONS_COLLECTION].bulk_write(revisions,
+                                                             ordered=False)
+                except BulkWriteError as e:
+                    # the revisions already stored by a write that failed
+                    # on the articles
+                    logger.warning(f"Could not store all the revisions: {e}")
+            try:
+                result = collection.bulk_write(operations, ordered=False)
+                upserted = result.upserted_count
+                modified = result.modified_count
+            except BulkWriteError as e:
+                # the other articles of the batch were still written
+                upserted = e.details.get('nUpserted', 0)
+                modified = e.details.get('nModified', 0)
+                failed = [(_failed_url(error, operations),
+                           error.get('errmsg'))
+                          for error in e.details.get('writeErrors', [])]
+            if upserted or modified:
+                # invalidates the results cached by the API
+                bump_version(self.db, self.collection_name)
+        latency = time.perf_counter() - start
+        return (upserted, modified, unchanged, len(revisions), failed), \
+            latency
+
+    def _flushed(self, write, batch_size) -> None:
+        (upserted, modified, unchanged, revisions, failed), latency = write
+        WRITE_LATENCY.observe(latency)
+        WRITTEN.labels('upserted').inc(upserted)
+        WRITTEN.labels('modified').inc(modified)
+        WRITTEN.labels('unchanged').inc(unchanged)
+        WRITTEN.labels('failed').inc(len(failed))
+        for url, error in failed:
+            logger.error(f"Could not write {url} into MongoDB: {error}")
+        if self.stats is None:
+            return
+        self.stats.inc_value('mongodb/batches')
+        self.stats.inc_value('mongodb/items_written',
+                             batch_size - unchanged - len(failed))
+        self.stats.inc_value('mongodb/upserted', upserted)
+        self.stats.inc_value('mongodb/modified', modified)
+        self.stats.inc_value('mongodb/unchanged', unchanged)
+        self.stats.inc_value('mongodb/revisions', revisions)
+        if failed:
+            self.stats.inc_value('mongodb/write_errors', len(failed))
+        self.stats.max_value('mongodb/batch_size_max', batch_size)
+        self.stats.inc_value('mongodb/write_latency_ms_total',
+                             int(latency * 1000))
+        self.stats.max_value('mongodb/write_latency_ms_max',
+                             int(latency * 1000))
+
+    def _flush_failed(self, failure, batch_size) -> None:
+        # the whole batch failed, the partial failures are handled by
+        # _flushed
+        failure.trap(PyMongoError)
+        logger.error(f"Could not write {batch_size} articles "
+                     + f"into MongoDB: {failure.value}")
+        if self.stats is not None:
+            self.stats.inc_value('mongodb/write_errors', batch_size)
+
+    def _forget_flush(self, result, d):
+        self.pending_flushes.discard(d)
+        return result
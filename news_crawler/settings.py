@@ -17,10 +17,78 @@ host = os.getenv("MONGODB_HOST")
 port = os.getenv("MONGODB_PORT")
 MONGO_URI = f'mongodb://{user}:{pwd}@{host}:{port}/compose?authSource=admin&ssl=true'
 MONGO_DATABASE = os.getenv("MONGODB_DATABASE")
+# Buffer the items in the pipeline and write them as unordered bulk upserts
+# when MONGO_FLUSH_SIZE items are buffered or every MONGO_FLUSH_INTERVAL
+# seconds, and when the spider closes
+MONGO_BUFFERED_WRITES = True
+MONGO_FLUSH_SIZE = 100
+MONGO_FLUSH_INTERVAL = 5
+
+# crawls started by the API run as jobs, see news_crawler/jobs.py: at most
+# CRAWL_MAX_JOBS crawls run at a time, and each reports its progress every
+# CRAWL_JOB_PROGRESS_INTERVAL seconds. A job that did not report for
+# CRAWL_JOB_STALE_SECONDS is considered lost.
+CRAWL_MAX_JOBS = int(os.getenv("CRAWL_MAX_JOBS", 1))
+CRAWL_JOB_PROGRESS_INTERVAL = 10
+CRAWL_JOB_STALE_SECONDS = int(os.getenv("CRAWL_JOB_STALE_SECONDS", 120))
+
+# the spider claims the URLs to crawl from the frontier collection
+# FRONTIER_BATCH_SIZE at a time. The claimed URLs are leased to the worker
+# for FRONTIER_LEASE_SECONDS, renewed while it runs, and claimed by the
+# other workers if it dies
+FRONTIER_BATCH_SIZE = 100
+FRONTIER_LEASE_SECONDS = 300
+
+# a failed URL is retried after FRONTIER_RETRY_BASE_DELAY seconds, doubled
+# after each failure up to FRONTIER_RETRY_MAX_DELAY (with a random jitter),
+# until it failed FRONTIER_RETRY_ATTEMPTS times or with a permanent status
+FRONTIER_RETRY_ATTEMPTS = 5
+FRONTIER_RETRY_BASE_DELAY = 60
+FRONTIER_RETRY_MAX_DELAY = 6 * 3600
+FRONTIER_PERMANENT_STATUSES = [404, 410]
+
+# with DISCOVERY_ENABLED the crawl first reads the news sitemaps, sitemap
+# indexes and RSS feeds of DISCOVERY_SOURCES, and adds the articles
+# modified since the last discovery to the frontier with DISCOVERY_PRIORITY
+DISCOVERY_ENABLED = os.getenv("DISCOVERY_ENABLED") in ('1', 'true')
+DISCOVERY_SOURCES = (
+    os.getenv("DISCOVERY_SOURCES")
+    or 'https://www.bbc.com/sitemaps/https-index-com-news.xml,'
+    + 'https://feeds.bbci.co.uk/news/rss.xml').split(',')
+DISCOVERY_PRIORITY = 0
+
+# URLs of the stored articles are kept in memory by the downloader
+# middleware, either exactly ('exact') or in a Bloom filter ('bloom') sized
+# for SEEN_URLS_CAPACITY URLs with SEEN_URLS_ERROR_RATE false positives
+SEEN_URLS_FILTER = 'exact'
+SEEN_URLS_CAPACITY = 1000000
+SEEN_URLS_ERROR_RATE = 0.001
+
+# Engine used to extract the articles from the pages, 'selectors' for
+# process_response in spiders/articles.py or 'lxml' for the faster
+# process_response_lxml in extractors.py, both give the same result
+ARTICLE_EXTRACTOR = 'lxml'
+# Read the article from the JSON-LD and __INITIAL_DATA__ embedded in the
+# page first, ARTICLE_EXTRACTOR is then only used for the missing fields
+ARTICLE_STRUCTURED_DATA = True
+# Number of processes parsing the pages outside of the reactor thread,
+# 0 parses them in the reactor thread. ARTICLE_PARSE_MAX_IN_FLIGHT pages
+# at most are sent to the processes at a time (2 per process by default)
+ARTICLE_PARSE_PROCESSES = 0
 
 # Logger custom settings
 LOG_FILE = 'crawler.log'
 LOG_LEVEL = 'INFO'
+# with LOG_QUEUE_ENABLED the log records are written by a background thread,
+# as JSON lines with LOG_JSON, and the records of the events of
+# LOG_SAMPLE_RATES (share kept) and LOG_RATE_LIMITS (records per second)
+# are sampled, see news_crawler/logs.py. For example
+# LOG_SAMPLE_RATES = {'response': 0.1} keeps one GET line out of ten
+LOG_QUEUE_ENABLED = os.getenv("LOG_QUEUE_ENABLED") in ('1', 'true')
+LOG_JSON = os.getenv("LOG_JSON") in ('1', 'true')
+LOG_QUEUE_SIZE = 10000
+LOG_SAMPLE_RATES = {}
+LOG_RATE_LIMITS = {}
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/106.0.0.0 Safari/537.36'
@@ -34,10 +102,41 @@ DOWNLOAD_DELAY = 3
 # The download delay setting will honor only one of:
 CONCURRENT_REQUESTS_PER_DOMAIN = 1
 
+# DOWNLOAD_DELAY and CONCURRENT_REQUESTS_PER_DOMAIN are only the starting
+# values of each domain, AdaptiveConcurrencyMiddleware lowers the delay and
+# raises the concurrency while the origin is healthy, within these bounds,
+# and backs off when it slows down or answers with an error status
+ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_MIN_CONCURRENCY = 1
+ADAPTIVE_MAX_CONCURRENCY = 8
+ADAPTIVE_MIN_DELAY = 0.25
+ADAPTIVE_MAX_DELAY = 30
+ADAPTIVE_DELAY_STEP = 0.25
+# seconds, of the average download latency
+ADAPTIVE_TARGET_LATENCY = 2.0
+ADAPTIVE_DECREASE_FACTOR = 0.5
+ADAPTIVE_BACKOFF_STATUSES = [429, 500, 502, 503, 504]
+
+# ShuffleUserAgentMiddleware rotates through a pool of user agents generated
+# once when the crawl starts, with the share of each OS given by its weight.
+# A user agent is taken out of the rotation when more than
+# USER_AGENT_MAX_FAILURE_RATE of its last requests, after at least
+# USER_AGENT_MIN_REQUESTS, were not answered with 200
+USER_AGENT_POOL_SIZE = 50
+USER_AGENT_OS_WEIGHTS = {'win': 6, 'mac': 3, 'linux': 1}
+# keep the same user agent for all the requests to a domain
+USER_AGENT_STICKY = False
+USER_AGENT_MIN_REQUESTS = 20
+USER_AGENT_MAX_FAILURE_RATE = 0.5
+USER_AGENT_MIN_ACTIVE = 5
+# the statuses which do not depend on the user agent
+USER_AGENT_IGNORED_STATUSES = [404, 410]
+
 # Enable or disable downloader middlewares
 DOWNLOADER_MIDDLEWARES = {
     'news_crawler.middlewares.NewsCrawlerDownloaderMiddleware': 545,
     'news_crawler.middlewares.ShuffleUserAgentMiddleware': 550,
+    'news_crawler.middlewares.AdaptiveConcurrencyMiddleware': 560,
     # 'news_crawler.middlewares.ShowUserAgentMiddleware': 555,
 }
 
@@ -46,6 +145,26 @@ SPIDER_MIDDLEWARES = {
     'scrapy.spidermiddlewares.offsite.OffsiteMiddleware': 100,
 }
 
+# Enable or disable extensions
+EXTENSIONS = {
+    'news_crawler.extensions.LoggingExtension': 490,
+    'news_crawler.extensions.CrawlJobExtension': 500,
+    'news_crawler.extensions.MetricsExtension': 510,
+    'news_crawler.extensions.TracingExtension': 520,
+}
+# Prometheus metrics of the crawl, see news_crawler/metrics.py. With
+# PROMETHEUS_MULTIPROC_DIR set they are served by the API, otherwise
+# METRICS_PORT serves them from the crawl process (0 to disable)
+METRICS_ENABLED = True
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+# with TRACE_ENABLED the time each request spends in each stage of the crawl
+# is written to TRACE_DIR, and with PROFILE_ENABLED the crawl is profiled
+# with cProfile to PROFILE_DIR, see news_crawler/tracing.py
+TRACE_ENABLED = False
+TRACE_DIR = 'traces'
+PROFILE_ENABLED = False
+PROFILE_DIR = 'profiles'
+
 # Configure item pipelines
 ITEM_PIPELINES = {
   "news_crawler.pipelines.MongoDBPipeline": 600
@@ -1,10 +1,34 @@
-""" This module gets the URLs from urls.txt, loops through them
+""" This module gets the URLs from the URL frontier, loops through them
     and initiates the requests to be processed by the middlewares
     and pipelines.
 """
+import hashlib
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import pymongo
 import scrapy
-from dateutil.parser import isoparse
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.http import HtmlResponse
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+from news_crawler.discovery import (SOURCES_COLLECTION, SourceDiscovery,
+                                    SourceTooLarge)
+from news_crawler.frontier import FRONTIER_COLLECTION, URLFrontier
 from news_crawler.items import ArticleItem
+from news_crawler.logs import EventLogger
+from news_crawler.metrics import PARSE_TIME
+from news_crawler import tracing
+from news_crawler.extractors import (created_at_fields, extract_article,
+                                     process_response_lxml)
+from database.queries import normalize_tags
+
+# the hot paths log events with their fields, see news_crawler/logs.py
+events = EventLogger(logging.getLogger(__name__))
 
 
 def process_response(response) -> list:
@@ -22,16 +46,8 @@ def process_response(response) -> list:
 
     article = response.css('article')
 
-    # The date is stored as ISO format (string), and as year, month, and
-    # time seperately, to be used for filtering with time while querying.
     created_at = article.css('time').xpath('@datetime').get(default='')
-    result['created_at'] = {
-        "ISO_datetime": created_at,
-        "year": isoparse(created_at).year if created_at else created_at,
-        "month": isoparse(created_at).month if created_at else created_at,
-        "day": isoparse(created_at).day if created_at else created_at,
-        "time": str(isoparse(created_at).time()) if created_at else created_at,
-        }
+    result['created_at'] = created_at_fields(created_at)
 
     # the name of the article
     result['headline'] = article.xpath('//*[@id="main-heading"]/text()') \
@@ -99,10 +115,88 @@ def process_response(response) -> list:
     result['text'] = text
     result['images'] = images
     result['tags'] = tags
+    # normalized tags used for searching by tags
+    result['tag_slugs'] = normalize_tags(tags)
 
     return result
 
 
+# the engines that can be chosen with the ARTICLE_EXTRACTOR setting, they
+# return the same result
+EXTRACTORS = {
+    'selectors': process_response,
+    'lxml': process_response_lxml,
+}
+
+
+def extract_page(response, extractor, structured) -> tuple:
+    """ Extracts the article with extract_article and the engine named
+        extractor. Returns the result, the path used, and the time it took
+        in milliseconds.
+    """
+    start = time.perf_counter()
+    result, path = extract_article(response, EXTRACTORS[extractor],
+                                   structured)
+    return result, path, (time.perf_counter() - start) * 1000
+
+
+def extract_page_body(url, body, encoding, extractor, structured) -> tuple:
+    """ Same as extract_page, from the raw body of the response.
+        It runs in a process of the parse pool, so it only takes and returns
+        picklable values.
+    """
+    response = HtmlResponse(url, body=body, encoding=encoding)
+    return extract_page(response, extractor, structured)
+
+
+def response_validators(response) -> dict:
+    """ The validators of a response, stored in the frontier and sent back
+        when the page is refreshed.
+    """
+    def header(name):
+        value = response.headers.get(name)
+        return value.decode('latin-1') if value else None
+
+    return {
+        'etag': header('ETag'),
+        'last_modified': header('Last-Modified'),
+        'content_hash': hashlib.sha1(response.body).hexdigest(),
+        'length': len(response.body),
+        'fetched_at': datetime.now(timezone.utc),
+    }
+
+
+def conditional_headers(validators) -> dict:
+    """ The headers asking for the page only if it changed since the
+        response the validators were taken from.
+    """
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def future_to_deferred(future) -> defer.Deferred:
+    """ Returns a Deferred fired in the reactor thread with the result of
+        a concurrent.futures Future.
+    """
+    from twisted.internet import reactor
+    d = defer.Deferred()
+
+    def done(future):
+        if future.cancelled():
+            reactor.callFromThread(d.cancel)
+        elif future.exception() is not None:
+            reactor.callFromThread(d.errback, future.exception())
+        else:
+            reactor.callFromThread(d.callback, future.result())
+
+    future.add_done_callback(done)
+    return d
+
+
 class ArticleSpider(scrapy.Spider):
     # the name of the spider
     name = 'news_crawler'
@@ -112,24 +206,311 @@ class ArticleSpider(scrapy.Spider):
     # solution YET other than it is a bug
     allowed_domains = ['bbc.com']
 
+    # with ARTICLE_PARSE_PROCESSES the pages are parsed in a pool of
+    # processes instead of the reactor thread
+    parse_pool = None
+    heartbeat_loop = None
+    # with DISCOVERY_ENABLED the sitemaps and feeds of DISCOVERY_SOURCES are
+    # fetched first, and their new articles added to the frontier
+    discovery = None
+    source_priority = 1000
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        """ Opens the frontier as the worker FRONTIER_WORKER, a name unique
+            to the process by default.
+            Creates the parse pool if ARTICLE_PARSE_PROCESSES is set.
+            At most ARTICLE_PARSE_MAX_IN_FLIGHT pages are sent to the pool at
+            a time, the others wait for a slot while holding their response,
+            and SCRAPER_SLOT_MAX_ACTIVE_SIZE stops the downloads once too
+            many responses are waiting.
+        """
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        settings = crawler.settings
+        spider.client = pymongo.MongoClient(settings.get('MONGO_URI'))
+        spider.frontier = URLFrontier(
+            spider.client[settings.get('MONGO_DATABASE')][FRONTIER_COLLECTION],
+            ack_size=settings.getint('FRONTIER_BATCH_SIZE', 100),
+            worker=settings.get('FRONTIER_WORKER'),
+            lease_seconds=settings.getint('FRONTIER_LEASE_SECONDS', 300),
+            max_attempts=settings.getint('FRONTIER_RETRY_ATTEMPTS', 5),
+            base_delay=settings.getfloat('FRONTIER_RETRY_BASE_DELAY', 60),
+            max_delay=settings.getfloat('FRONTIER_RETRY_MAX_DELAY', 21600),
+            permanent_statuses=[int(status) for status in settings.getlist(
+                'FRONTIER_PERMANENT_STATUSES', [404, 410])])
+        if settings.getbool('DISCOVERY_ENABLED'):
+            spider.discovery = SourceDiscovery(
+                spider.client[settings.get('MONGO_DATABASE')]
+                [SOURCES_COLLECTION],
+                spider.frontier,
+                priority=settings.getint('DISCOVERY_PRIORITY', 0))
+        crawler.signals.connect(spider.start_heartbeat,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(spider.spider_idle,
+                                signal=signals.spider_idle)
+        processes = crawler.settings.getint('ARTICLE_PARSE_PROCESSES')
+        if processes > 0:
+            # spawn instead of fork, the reactor and its threads must not
+            # be copied in the workers
+            spider.parse_pool = ProcessPoolExecutor(
+                processes, mp_context=multiprocessing.get_context('spawn'))
+            spider.parse_slots = defer.DeferredSemaphore(
+                crawler.settings.getint('ARTICLE_PARSE_MAX_IN_FLIGHT',
+                                        2 * processes))
+        return spider
+
     def start_requests(self) -> scrapy.Request:
-        """ Gets the urls from the text file, puts them
-            in a list, and yields each request accordingly
+        """ Claims the pending urls of the frontier FRONTIER_BATCH_SIZE at
+            a time, and yields each request accordingly. Scrapy asks for the
+            next start request only when it has room for it, so about one
+            batch is held in memory whatever the size of the frontier.
+        """
+        self.frontier.ensure_indexes()
+        if self.discovery is not None:
+            yield from self.discovery_requests(
+                [(source, None) for source in
+                 self.settings.getlist('DISCOVERY_SOURCES')])
+        batch_size = self.settings.getint('FRONTIER_BATCH_SIZE', 100)
+        while True:
+            batch = self.frontier.claim(batch_size)
+            if not batch:
+                break
+            yield from self.frontier_requests(batch)
+
+    def frontier_requests(self, batch) -> scrapy.Request:
+        stats = self.crawler.stats
+        stats.inc_value('frontier/claimed', len(batch))
+        stats.set_value('frontier/reclaimed', self.frontier.reclaimed)
+        for entry in batch:
+            events.info('request', 'Getting %s', entry['url'],
+                        url=entry['url'], spider=self)
+            meta = {'frontier_id': entry['_id'],
+                    'frontier_attempts': entry.get('attempts', 1)}
+            headers = {}
+            if entry.get('refresh'):
+                # the article is already stored, it is only downloaded and
+                # parsed again if it changed
+                meta['refresh'] = True
+                meta['validators'] = entry.get('validators') or {}
+                headers = conditional_headers(meta['validators'])
+            yield scrapy.Request(url=entry['url'], callback=self.parse,
+                                 errback=self.crawl_failed,
+                                 priority=entry.get('priority', 0),
+                                 headers=headers, meta=meta)
+
+    def discovery_requests(self, sources) -> scrapy.Request:
+        """ Requests the (url, lastmod in its index) sources, conditionally
+            if they were fetched before. They are not restricted to the
+            allowed domains, the feeds have their own.
+        """
+        validators = self.discovery.validators(url for url, _ in sources)
+        for url, listed_lastmod in sources:
+            source_validators = validators.get(url, {})
+            yield scrapy.Request(url=url, callback=self.parse_source,
+                                 errback=self.discovery_failed,
+                                 priority=self.source_priority,
+                                 headers=conditional_headers(
+                                     source_validators),
+                                 dont_filter=True,
+                                 meta={'discovery_source': url,
+                                       'validators': source_validators,
+                                       'listed_lastmod': listed_lastmod})
+
+    def parse_source(self, response):
+        """ Submits the new articles of a sitemap or a feed to the frontier,
+            and fetches the sitemaps of an index that changed. The articles
+            are claimed once the spider is idle.
+        """
+        source = response.meta['discovery_source']
+        # a gzipped sitemap is capped like the responses, once decompressed
+        max_size = getattr(self, 'download_maxsize',
+                           self.settings.getint('DOWNLOAD_MAXSIZE'))
+        max_size = response.meta.get('download_maxsize', max_size)
+        try:
+            counts = self.discovery.process(
+                source, response.body, response_validators(response),
+                response.meta.get('listed_lastmod'), max_size)
+        except SourceTooLarge as e:
+            self.crawler.stats.inc_value('discovery/too_large')
+            self.logger.warning(f'Could not discover from {source}: {e}')
+            return
+        self.logger.info(f"Discovered {counts['added']} new URLs in "
+                         + f"{source}, {counts['entries']} entries")
+        stats = self.crawler.stats
+        stats.inc_value('discovery/sources')
+        stats.inc_value('discovery/bytes', len(response.body))
+        stats.inc_value('discovery/entries', counts['entries'])
+        stats.inc_value('discovery/new', counts['new'])
+        stats.inc_value('discovery/added', counts['added'])
+        yield from self.discovery_requests(counts['sitemaps'])
+
+    def discovery_failed(self, failure) -> None:
+        request = failure.request
+        source = request.meta['discovery_source']
+        if request.meta.get('not_modified'):
+            self.crawler.stats.inc_value('discovery/not_modified')
+            self.discovery.checked(source, request.meta.get('listed_lastmod'))
+            return
+        self.crawler.stats.inc_value('discovery/errors')
+        self.logger.warning(f'Could not discover from {source}: '
+                            + f'{failure.value!r}')
+
+    def start_heartbeat(self, spider) -> None:
+        """ Renews the leases of the urls in flight of this worker three
+            times per lease, so that they are not claimed by another worker.
+        """
+        self.heartbeat_loop = task.LoopingCall(self.frontier.heartbeat)
+        self.heartbeat_loop.start(self.frontier.lease_seconds / 3,
+                                  now=False)
+
+    def spider_idle(self, spider) -> None:
+        """ Once the start requests are consumed, claims the urls submitted
+            since then, and the urls of the workers whose lease expired.
+            The spider is kept open while other workers have urls in flight,
+            in case one of them dies.
+        """
+        batch = self.frontier.claim(
+            self.settings.getint('FRONTIER_BATCH_SIZE', 100))
+        for request in self.frontier_requests(batch):
+            self.crawler.engine.crawl(request)
+        # the urls this worker still holds will not be crawled once idle
+        if batch or self.frontier.in_flight(
+                exclude_worker=self.frontier.worker):
+            raise DontCloseSpider
+
+    def crawl_failed(self, failure) -> None:
+        """ Records the failure of a request in the frontier, which retries
+            it later or gives up on it, or marks it as done if it was
+            ignored because it is already stored.
+        """
+        request = failure.request
+        frontier_id = request.meta.get('frontier_id')
+        if request.meta.get('already_processed'):
+            self.crawler.stats.inc_value('frontier/done')
+            self.frontier.done(frontier_id)
+            tracing.finish(self.crawler, request.meta, request.url,
+                           'already_processed')
+            return
+        if request.meta.get('not_modified'):
+            # 304, the stored validators are still valid
+            stats = self.crawler.stats
+            stats.inc_value('frontier/done')
+            stats.inc_value('refresh/not_modified')
+            stats.inc_value('refresh/bytes_saved',
+                            request.meta['validators'].get('length', 0))
+            self.frontier.done(frontier_id)
+            tracing.finish(self.crawler, request.meta, request.url,
+                           'not_modified')
+            return
+
+        # the status of the origin, set by the downloader middleware, or of
+        # the response, none for network errors
+        status = request.meta.get('origin_status')
+        if failure.check(HttpError):
+            status = failure.value.response.status
+        state = self.frontier.failed(frontier_id, repr(failure.value),
+                                     status,
+                                     request.meta.get('frontier_attempts', 1))
+        self.crawler.stats.inc_value(f'frontier/{state}')
+        tracing.finish(self.crawler, request.meta, request.url, state)
+
+    def parse_failed(self, failure, response) -> list:
+        """ Records in the frontier that the page could not be parsed, so
+            that its URL does not stay in flight. It is retried like a
+            failed download.
         """
-        url_file = open('urls.txt')
-        start_urls = url_file.read().splitlines()
-        url_file.close()
-        for url in start_urls:
-            self.logger.info(f'Getting {url}')
-            yield scrapy.Request(url=url, callback=self.parse)
-
-    def parse(self, response) -> ArticleItem:
-        """ Calls the process_response function above, gets the result
-            and create and ArticleItem object from items.py
+        self.logger.error(f'Could not parse {response.url}',
+                          exc_info=(failure.type, failure.value,
+                                    failure.getTracebackObject()))
+        self.crawler.stats.inc_value('parse/errors')
+        state = self.frontier.failed(
+            response.meta.get('frontier_id'), repr(failure.value),
+            attempts=response.meta.get('frontier_attempts', 1))
+        self.crawler.stats.inc_value(f'frontier/{state}')
+        tracing.finish(self.crawler, response.meta, response.url, state)
+        return []
+
+    def crawled(self, items, response, validators) -> list:
+        self.crawler.stats.inc_value('frontier/done')
+        self.frontier.done(response.meta.get('frontier_id'), validators)
+        tracing.finish(self.crawler, response.meta, response.url,
+                       'parsed' if items else 'unchanged')
+        return items
+
+    def parse(self, response):
+        """ Gets the article from the structured data of the page if
+            ARTICLE_STRUCTURED_DATA is enabled, and from the html with the
+            extractor chosen with ARTICLE_EXTRACTOR for the missing fields.
+            A refreshed page whose body did not change is not parsed.
+            The extraction runs in the parse pool if there is one, in which
+            case a Deferred of the items is returned.
         """
-        self.logger.info(f'Processing article from {response.url}')
+        validators = response_validators(response)
+        if response.meta.get('refresh'):
+            # the server ignored the conditional request, but the page may
+            # still be the same
+            if validators['content_hash'] == \
+                    response.meta['validators'].get('content_hash'):
+                self.crawler.stats.inc_value('refresh/unchanged')
+                return self.crawled([], response, validators)
+            self.crawler.stats.inc_value('refresh/changed')
+
+        events.info('parse', 'Processing article from %s', response.url,
+                    url=response.url, spider=self)
+
+        extractor = self.settings.get('ARTICLE_EXTRACTOR', 'selectors')
+        structured = self.settings.getbool('ARTICLE_STRUCTURED_DATA')
+        if self.parse_pool is None:
+            try:
+                items = self.extracted(extract_page(response, extractor,
+                                                    structured),
+                                       response)
+            except Exception:
+                return self.parse_failed(Failure(), response)
+            return self.crawled(items, response, validators)
+
+        d = self.parse_slots.run(self._submit, response.url, response.body,
+                                 response.encoding, extractor, structured)
+        d.addCallback(self.extracted, response)
+        d.addCallbacks(self.crawled, self.parse_failed,
+                       callbackArgs=(response, validators),
+                       errbackArgs=(response,))
+        return d
+
+    def _submit(self, url, *args) -> defer.Deferred:
+        stats = self.crawler.stats
+        stats.inc_value('parse_pool/in_flight')
+        stats.max_value('parse_pool/in_flight_max',
+                        stats.get_value('parse_pool/in_flight'))
+        d = future_to_deferred(self.parse_pool.submit(extract_page_body,
+                                                      url, *args))
+
+        def release(result):
+            stats.inc_value('parse_pool/in_flight', -1)
+            return result
 
-        result = process_response(response)
+        return d.addBoth(release)
+
+    def extracted(self, extracted, response) -> list:
+        # the extraction time measured where it ran, in the pool or not
+        tracing.record(response.meta, 'parse', extracted[2] / 1000)
+        return self.to_items(response.url, extracted)
+
+    def to_items(self, url, extracted) -> list:
+        """ Gets the result of the extraction, and create and ArticleItem
+            object from items.py
+        """
+        result, path, elapsed_ms = extracted
+
+        # which path each page went through, and the time it took
+        events.debug('extracted', 'Extracted %s from %s in %.1f ms', url,
+                     path, elapsed_ms, url=url, path=path,
+                     elapsed_ms=elapsed_ms, spider=self)
+        stats = self.crawler.stats
+        stats.inc_value(f'extractor/{path}/pages')
+        stats.inc_value(f'extractor/{path}/time_ms', elapsed_ms)
+        stats.max_value(f'extractor/{path}/time_ms_max', elapsed_ms)
+        PARSE_TIME.labels(path).observe(elapsed_ms / 1000)
 
         item = ArticleItem()
         item['article_url'] = result['article_url']
@@ -139,5 +520,20 @@ class ArticleSpider(scrapy.Spider):
         item['text'] = result['text']
         item['images'] = result['images']
         item['tags'] = result['tags']
+        item['tag_slugs'] = result['tag_slugs']
+
+        return [item]
 
-        yield item
+    def closed(self, reason) -> None:
+        """ Writes the last states to the frontier, and puts back the urls
+            that were not crawled if the spider was closed before the end.
+            Stops the parse pool.
+        """
+        if self.heartbeat_loop is not None and self.heartbeat_loop.running:
+            self.heartbeat_loop.stop()
+        released = self.frontier.release()
+        if released:
+            self.logger.info(f'Released {released} URLs not crawled')
+        self.client.close()
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown(wait=False, cancel_futures=True)
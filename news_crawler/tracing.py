@@ -0,0 +1,127 @@
+""" This module times the stages each request of a crawl goes through, when
+    the crawl runs with TRACE_ENABLED (see TracingExtension in
+    extensions.py), and summarizes the traces and profiles.
+
+    The stages are timed in request.meta['trace'], which only exists when
+    tracing is enabled, so the timers cost a dict lookup otherwise:
+        scheduler   waiting in the scheduler
+        dedup       NewsCrawlerDownloaderMiddleware, with its MongoDB lookup
+        user_agent  ShuffleUserAgentMiddleware
+        slot        waiting for the download slot (DOWNLOAD_DELAY, ...)
+        download    the download itself
+        parse       extracting the article from the page
+        pipeline    from the end of the parse to the article being stored,
+                    or only buffered with MONGO_BUFFERED_WRITES, whose
+                    bulk writes are timed by the mongodb/write_latency_*
+                    stats instead
+    The extension writes one JSON line per request, and one for the
+    pipeline stage of each article, to TRACE_DIR/crawl-<pid>.jsonl.
+
+    Usage:
+        python -m news_crawler.tracing stages traces/*.jsonl [--top 10]
+        python -m news_crawler.tracing functions profiles/*.prof [--top 30]
+"""
+import argparse
+import contextlib
+import json
+import pstats
+import sys
+import time
+from collections import defaultdict
+
+TRACE_KEY = 'trace'
+
+# sent by the spider once it is done with a request, with its url, the
+# trace of its stages and its outcome
+request_traced = object()
+
+
+@contextlib.contextmanager
+def stage(meta, name):
+    """ Adds the time spent in the block to the stage name of the request.
+    """
+    trace = meta.get(TRACE_KEY)
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(meta, name, time.perf_counter() - start)
+
+
+def record(meta, name, seconds) -> None:
+    trace = meta.get(TRACE_KEY)
+    if trace is not None:
+        trace[name] = trace.get(name, 0) + seconds
+
+
+def finish(crawler, meta, url, outcome) -> None:
+    """ Sends the trace of a request the spider is done with.
+    """
+    if TRACE_KEY in meta:
+        # a response ignored by a downloader middleware was not received
+        # by the extension
+        if 'download_latency' in meta and 'download' not in meta[TRACE_KEY]:
+            record(meta, 'download', meta['download_latency'])
+        meta['trace_finished_at'] = time.perf_counter()
+        crawler.signals.send_catch_log(request_traced, url=url,
+                                       trace=meta[TRACE_KEY],
+                                       outcome=outcome)
+
+
+def percentile(values, fraction) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize_stages(lines) -> list:
+    """ Returns the (stage, requests, total, mean, p95) of the JSON lines
+        of the traces, in seconds, from the longest total.
+    """
+    times = defaultdict(list)
+    for line in lines:
+        if not line.strip():
+            continue
+        for name, seconds in json.loads(line)['stages'].items():
+            times[name].append(seconds)
+    summary = [(name, len(values), sum(values), sum(values) / len(values),
+                percentile(values, 0.95))
+               for name, values in times.items()]
+    return sorted(summary, key=lambda row: row[2], reverse=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Summarize the traces and profiles of the crawls and '
+        + 'of the API')
+    parser.add_argument('command', choices=['stages', 'functions'])
+    parser.add_argument('files', nargs='+',
+                        help='trace (.jsonl) or profile (.prof) files')
+    parser.add_argument('--top', type=int, default=None)
+    parser.add_argument('--sort', default='tottime',
+                        help='pstats sort key of the functions')
+    args = parser.parse_args()
+
+    if args.command == 'stages':
+        lines = []
+        for name in args.files:
+            with open(name) as file:
+                lines.extend(file)
+        summary = summarize_stages(lines)
+        total = sum(row[2] for row in summary) or 1
+        print(f"{'stage':<12}{'requests':>10}{'total s':>10}{'share':>8}"
+              + f"{'mean ms':>10}{'p95 ms':>10}")
+        for name, count, seconds, mean, p95 in summary[:args.top]:
+            print(f'{name:<12}{count:>10}{seconds:>10.2f}'
+                  + f'{seconds / total:>8.1%}{mean * 1000:>10.2f}'
+                  + f'{p95 * 1000:>10.2f}')
+    else:
+        # the profiles of several crawls or workers are added up
+        stats = pstats.Stats(*args.files, stream=sys.stdout)
+        stats.sort_stats(args.sort).print_stats(args.top or 30)
+
+
+if __name__ == '__main__':
+    main()
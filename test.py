@@ -3,9 +3,53 @@
     It tests the most important parts of the MongoDB insertion mechanism,
     which are the data types of the fields used for querying with the API.
 """
+import gzip
+import io
+import json
+import logging
+import os
 import unittest
-from news_crawler.spiders.articles import process_response
+from types import SimpleNamespace
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+import mongomock
+from bson import json_util, ObjectId
+from pymongo.errors import BulkWriteError, PyMongoError
+from database import (metrics, migrations, queries, revisions,
+                      serialization, versions)
+from news_crawler.extractors import (created_at_fields, extract_article,
+                                     process_response_lxml)
+from news_crawler.discovery import (ARTICLE, SITEMAP, SourceDiscovery,
+                                    SourceTooLarge, open_source,
+                                    parse_entries)
+from news_crawler.extensions import TracingExtension
+from news_crawler.dedup import BloomFilter, SeenURLs, canonical_url
+from news_crawler.jobs import (CANCELLED, FINISHED, JOBS_COLLECTION, QUEUED,
+                               RUNNING, CrawlJobs)
+from news_crawler.logs import EventFilter, EventLogger, QueuedLogging
+from news_crawler.frontier import (DONE, FAILED, IN_FLIGHT, PENDING, RETRY,
+                                   URLFrontier)
+from news_crawler.pipelines import MongoDBPipeline
+from news_crawler.middlewares import (AdaptiveConcurrencyMiddleware,
+                                      ShuffleUserAgentMiddleware,
+                                      UserAgentPool, agent_id)
+from news_crawler.spiders.articles import ArticleSpider, process_response
+from news_crawler.tracing import TRACE_KEY, stage, summarize_stages
+from scrapy.http import HtmlResponse, Request
 from scrapy.selector import Selector
+from scrapy.settings import Settings
+from scrapy.statscollectors import MemoryStatsCollector
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+from werkzeug.http import parse_accept_header
+
+# the API is tested on mongomock and an in-memory SQLite database
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+for variable in ('MONGODB_USER', 'MONGODB_PASSWORD', 'MONGODB_HOST',
+                 'MONGODB_PORT', 'SECRET_KEY', 'JWT_SECRET_KEY'):
+    os.environ.setdefault(variable, 'test')
+import app as api  # noqa: E402
+from flask_jwt_extended import create_access_token  # noqa: E402
 
 
 class TestAdd(unittest.TestCase):
@@ -30,11 +74,1102 @@ class TestAdd(unittest.TestCase):
         self.assertIsInstance(result['created_at']['month'], int)
         self.assertIsInstance(result['created_at']['day'], int)
         self.assertIsInstance(result['created_at']['time'], str)
+        self.assertEqual(result['created_at']['datetime'],
+                         datetime(2022, 10, 8, 19, 26, 37,
+                                  tzinfo=timezone.utc))
 
         self.assertIsInstance(result['tags'], list)
+        self.assertEqual(result['tag_slugs'],
+                         ['russia-ukraine-war', 'russia', 'crimea', 'ukraine'])
 
         self.assertIsInstance(result['author(s)'], list)
 
+    def test_created_at_offset(self) -> None:
+        """ The calendar fields keep the offset of the page, only datetime
+            is in UTC.
+        """
+        fields = created_at_fields('2022-10-08T23:30:00+02:00')
+        self.assertEqual((fields['year'], fields['month'], fields['day'],
+                          fields['time']), (2022, 10, 8, '23:30:00'))
+        self.assertEqual(fields['datetime'],
+                         datetime(2022, 10, 8, 21, 30, tzinfo=timezone.utc))
+
+    def test_lxml_extractor(self) -> None:
+        """ The lxml engine must give the same result as process_response.
+        """
+        with open('sample.html', 'r') as file:
+            fake_response = Selector(text=file.read())
+
+        self.assertEqual(process_response_lxml(fake_response),
+                         process_response(fake_response))
+
+    def test_structured_data(self) -> None:
+        """ sample.html has all the fields in its JSON-LD and
+            __INITIAL_DATA__, so the html is not needed.
+        """
+        with open('sample.html', 'rb') as file:
+            fake_response = HtmlResponse('https://www.bbc.com/news',
+                                         body=file.read(), encoding='utf-8')
+
+        result, path = extract_article(fake_response, process_response)
+        html_result = process_response(fake_response)
+
+        self.assertEqual(path, 'structured')
+        for field in ('article_url', 'created_at', 'headline', 'images',
+                      'tags', 'tag_slugs'):
+            self.assertEqual(result[field], html_result[field])
+        self.assertEqual(result['author(s)'], [['Paul Adams']])
+        self.assertTrue(result['text'].startswith(
+            '\t@Image-0\nUkraine is exploding with excitement'))
+
+
+class TestQueries(unittest.TestCase):
+
+    def test_text_search(self) -> None:
+        """ Any keyword matches by default, quoting them requires all.
+        """
+        self.assertEqual(queries.text_search(['brexit', 'trade deal']),
+                         {"$text": {"$search": 'brexit trade deal'}})
+        self.assertEqual(
+            queries.text_search(['brexit', '"trade deal"'], match_all=True),
+            {"$text": {"$search": '"brexit" "trade deal"'}})
+
+    def test_tag_search(self) -> None:
+        """ Tags are matched as slugs, so the case and punctuation of the
+            searched tags do not matter.
+        """
+        self.assertEqual(queries.normalize_tags([' Russia-Ukraine War',
+                                                 'russia ukraine_war', '']),
+                         ['russia-ukraine-war'])
+        self.assertEqual(queries.tag_search(['Crimea', 'UKRAINE'], True),
+                         {"tag_slugs": {"$all": ['crimea', 'ukraine']}})
+
+    def test_date_range(self) -> None:
+        """ year/month/day become [start, end) ranges, and a date without
+            a time as the upper bound includes the whole day.
+        """
+        utc = timezone.utc
+        self.assertEqual(queries.calendar_range(2022, 12),
+                         (datetime(2022, 12, 1, tzinfo=utc),
+                          datetime(2023, 1, 1, tzinfo=utc)))
+        self.assertEqual(
+            queries.parse_date_bounds('2022-10-01', '2022-10-08'),
+            {"created_at.datetime": {
+                "$gte": datetime(2022, 10, 1, tzinfo=utc),
+                "$lt": datetime(2022, 10, 9, tzinfo=utc)}})
+        self.assertEqual(
+            queries.parse_date_bounds(date_to='2022-10-08T12:00:00Z'),
+            {"created_at.datetime": {
+                "$lte": datetime(2022, 10, 8, 12, tzinfo=utc)}})
+        self.assertRaises(ValueError, queries.parse_date_bounds,
+                          '2022-10-08', '2022-10-01')
+
+    def test_score_cursor(self) -> None:
+        """ The ranked search cursor goes back and forth between the
+            next link and the aggregation pipeline.
+        """
+        _id = ObjectId()
+        cursor = queries.encode_score_cursor(1.25, _id)
+        self.assertEqual(queries.decode_score_cursor(cursor), (1.25, _id))
+        self.assertRaises(ValueError, queries.decode_score_cursor, 'abc')
+
+    def test_backfill_created_at(self) -> None:
+        """ A malformed ISO_datetime is skipped, the other articles are
+            still migrated.
+        """
+        collection = mongomock.MongoClient().BBC.articles
+        collection.insert_many([
+            {'_id': 1, 'created_at': {'ISO_datetime': '2022-10-08T12:00:00Z'}},
+            {'_id': 2, 'created_at': {'ISO_datetime': 'yesterday'}},
+            {'_id': 3, 'created_at': {'ISO_datetime': '2022-10-09T08:30:00'}},
+        ])
+        modified, skipped = migrations.backfill_created_at(collection,
+                                                           batch_size=1)
+        self.assertEqual((modified, skipped), (2, [2]))
+        self.assertNotIn('datetime', collection.find_one({'_id': 2})
+                         ['created_at'])
+        self.assertEqual(collection.find_one({'_id': 3})
+                         ['created_at']['datetime'],
+                         datetime(2022, 10, 9, 8, 30))
+
+
+class TestDedup(unittest.TestCase):
+
+    def test_canonical_url(self) -> None:
+        """ The og:url and the requested URL of an article can differ.
+        """
+        self.assertEqual(
+            canonical_url('http://WWW.BBC.com/news/world-63183409/?b=1&a=2#x'),
+            'https://www.bbc.com/news/world-63183409?a=2&b=1')
+
+    def test_seen_urls(self) -> None:
+        """ Added URLs are always found, in both modes.
+        """
+        urls = [f'https://www.bbc.com/news/{i}' for i in range(1000)]
+        for mode in ('exact', 'bloom'):
+            seen = SeenURLs(mode, capacity=1000, error_rate=0.01)
+            for url in urls:
+                seen.add(url)
+            self.assertTrue(all(url + '/' in seen for url in urls))
+        self.assertNotIn('https://www.bbc.com/sport', seen)
+
+    def test_bloom_filter_error_rate(self) -> None:
+        """ The false positive rate stays close to the configured one.
+        """
+        bloom = BloomFilter(10000, error_rate=0.01)
+        for i in range(10000):
+            bloom.add(str(i))
+        false_positives = sum(str(i) in bloom for i in range(10000, 20000))
+        self.assertLess(false_positives, 200)
+
+
+class TestSerialization(unittest.TestCase):
+
+    def test_same_as_json_util(self) -> None:
+        """ orjson gives the same extended JSON as bson.json_util.
+        """
+        document = {
+            '_id': ObjectId(),
+            'headline': 'Élection à Beyrouth',
+            'created_at': {
+                'datetime': datetime(2022, 10, 10, 7, 15, 30, 250000),
+                'aware': datetime(2022, 10, 10, 9, 15, tzinfo=timezone.utc),
+                'old': datetime(1969, 7, 20, 20, 17),
+            },
+            'tags': ['Lebanon', None],
+        }
+        self.assertEqual(json.loads(serialization.dumps(document)),
+                         json.loads(json_util.dumps(document)))
+        self.assertEqual(json.loads(serialization.dumps(document,
+                                                        pretty=True)),
+                         json.loads(json_util.dumps(document)))
+
+    def test_negotiate_encoding(self) -> None:
+        """ brotli is preferred, and an encoding with q=0 is refused.
+        """
+        def negotiate(header):
+            return serialization.negotiate_encoding(
+                parse_accept_header(header))
+        self.assertEqual(negotiate('gzip, deflate, br'), 'br')
+        self.assertEqual(negotiate('gzip, br;q=0'), 'gzip')
+        self.assertIsNone(negotiate('identity'))
+
+
+class TestRevisions(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.db = mongomock.MongoClient().BBC
+        self.article = {'article_url': 'https://www.bbc.com/news/1',
+                        'headline': 'Storm hits the coast',
+                        'text': 'The storm hit the coast on Monday. '
+                        + 'Thousands are without power.',
+                        'tags': ['Weather'], 'images': []}
+
+    def write(self, document) -> int:
+        """ Writes the document as the pipeline does, returns the number of
+            unchanged articles.
+        """
+        articles, stored, unchanged = revisions.plan_writes(
+            self.db.articles, [dict(document)])
+        if stored:
+            self.db[revisions.REVISIONS_COLLECTION].bulk_write(stored)
+        if articles:
+            self.db.articles.bulk_write(articles)
+        return unchanged
+
+    def test_text_delta(self) -> None:
+        """ Only the changed words are stored, and they give the old text
+            back.
+        """
+        old = self.article['text']
+        new = old.replace('Thousands', 'Hundreds of thousands')
+        delta = revisions.text_delta(new, old)
+        self.assertEqual(len(delta), 1)
+        self.assertEqual(revisions.apply_text_delta(new, delta), old)
+
+    def test_history(self) -> None:
+        """ An unchanged article is not written, a changed one replaces the
+            stored version, which can be rebuilt.
+        """
+        self.assertEqual(self.write(self.article), 0)
+        self.assertEqual(self.write(dict(self.article, images=['a'])), 1)
+        changed = dict(self.article, headline='Storm hits the north coast',
+                       text=self.article['text'] + ' Schools are closed.')
+        self.assertEqual(self.write(changed), 0)
+
+        stored = self.db.articles.find_one()
+        self.assertEqual((stored['revision'], stored['headline']),
+                         (2, changed['headline']))
+        self.assertEqual([(version['revision'], version['changed'])
+                          for version in revisions.history(
+                              self.db, self.article['article_url'])],
+                         [(2, []), (1, ['headline', 'text'])])
+        first = revisions.get_revision(self.db, self.article['article_url'],
+                                       1)
+        for field in revisions.TRACKED_FIELDS:
+            self.assertEqual(first[field], self.article[field])
+        self.assertIsNone(revisions.get_revision(
+            self.db, self.article['article_url'], 3))
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self) -> None:
+        crawler = SimpleNamespace(settings=Settings())
+        self.stats = MemoryStatsCollector(crawler)
+        self.pipeline = MongoDBPipeline(None, 'BBC', stats=self.stats)
+        self.pipeline.db = mongomock.MongoClient().BBC
+        self.articles = [{'article_url': f'https://www.bbc.com/news/{i}',
+                          'headline': f'Headline {i}', 'text': 'Text',
+                          'tags': ['UK']} for i in range(3)]
+
+    def test_upserts(self) -> None:
+        """ The articles are upserted once, and not written again when
+            they did not change.
+        """
+        for article in self.articles:
+            self.pipeline.process_item(dict(article), None)
+        self.pipeline.process_item(dict(self.articles[0]), None)
+        self.assertEqual(self.pipeline.db.articles.count_documents({}), 3)
+        self.assertEqual(self.stats.get_value('mongodb/upserted'), 3)
+        self.assertEqual(self.stats.get_value('mongodb/unchanged'), 1)
+
+    def test_partial_failure(self) -> None:
+        """ The articles written by a bulk write that failed on some of them
+            are counted, and the failed ones are reported.
+        """
+        error = BulkWriteError({
+            'nUpserted': 2, 'nModified': 0,
+            'writeErrors': [{
+                'index': 1, 'code': 11000, 'errmsg': 'E11000 duplicate key',
+                'op': {'q': {'article_url': self.articles[1]['article_url']},
+                       'upsert': True}}]})
+        with mock.patch.object(mongomock.Collection, 'bulk_write',
+                               side_effect=error), \
+                self.assertLogs('news_crawler.pipelines', 'ERROR') as logs:
+            self.pipeline._flushed(self.pipeline._bulk_write(
+                [dict(article) for article in self.articles]), 3)
+        self.assertEqual(self.stats.get_value('mongodb/upserted'), 2)
+        self.assertEqual(self.stats.get_value('mongodb/write_errors'), 1)
+        self.assertEqual(self.stats.get_value('mongodb/items_written'), 2)
+        self.assertIn(self.articles[1]['article_url'], logs.output[0])
+
+    def test_one_flush_at_a_time(self) -> None:
+        """ A batch is only planned once the previous one is written, so
+            an article changed in both is stored with two revisions.
+        """
+        writes = []
+
+        def to_thread(f, *args):
+            writes.append((f, args, defer.Deferred()))
+            return writes[-1][2]
+
+        self.pipeline.buffered = True
+        self.pipeline.flush_size = 10
+        with mock.patch('news_crawler.pipelines.threads.deferToThread',
+                        to_thread):
+            for headline in ('First', 'Second'):
+                self.pipeline.process_item(
+                    dict(self.articles[0], headline=headline), None)
+                self.pipeline.flush()
+            self.assertEqual(len(writes), 1)
+            for f, args, d in writes:
+                d.callback(f(*args))
+        self.assertEqual(len(writes), 2)
+        article = self.pipeline.db.articles.find_one()
+        self.assertEqual((article['headline'], article['revision']),
+                         ('Second', 2))
+        self.assertEqual(self.pipeline.pending_flushes, set())
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_command_latency(self) -> None:
+        """ The MongoDB commands are timed per command name.
+        """
+        def count(name):
+            return metrics.REGISTRY.get_sample_value(
+                f'mongodb_command_{name}', {'command': 'find'}) or 0
+
+        before = (count('duration_seconds_count'), count('failures_total'))
+        listener = metrics.CommandLatencyListener()
+        event = SimpleNamespace(command_name='find', duration_micros=2500)
+        listener.succeeded(event)
+        listener.failed(event)
+        self.assertEqual((count('duration_seconds_count'),
+                          count('failures_total')),
+                         (before[0] + 2, before[1] + 1))
+        body, content_type = metrics.render()
+        self.assertIn(b'mongodb_command_duration_seconds_bucket', body)
+        self.assertTrue(content_type.startswith('text/plain'))
+
+
+class TestTracing(unittest.TestCase):
+
+    def test_stages(self) -> None:
+        """ The stages are only timed when the request is traced, and
+            summarized from the longest.
+        """
+        untraced, traced = {}, {TRACE_KEY: {}}
+        for meta in (untraced, traced):
+            with stage(meta, 'dedup'):
+                pass
+        self.assertEqual(untraced, {})
+        self.assertIn('dedup', traced[TRACE_KEY])
+
+        lines = [json.dumps({'url': 'a', 'stages': {'download': 0.2,
+                                                    'parse': 0.05}}),
+                 json.dumps({'url': 'b', 'stages': {'download': 0.4}}),
+                 json.dumps({'url': 'b', 'stages': {'pipeline': 0.01}})]
+        self.assertEqual([(name, count) for name, count, *_ in
+                          summarize_stages(lines)],
+                         [('download', 2), ('parse', 1), ('pipeline', 1)])
+
+    def test_stats(self) -> None:
+        """ The stages faster than a millisecond still add up in the stats.
+        """
+        crawler = get_crawler(ArticleSpider)
+        extension = TracingExtension(crawler)
+        extension.trace_file = io.StringIO()
+        for _ in range(10):
+            extension.request_traced('a', {'dedup': 0.0004}, 'done')
+        self.assertEqual(crawler.stats.get_value('trace/dedup/us'), 4000)
+
+
+class TestFrontier(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.collection = mongomock.MongoClient().BBC.frontier
+        self.urls = [f'https://www.bbc.com/news/{i}' for i in range(10)]
+
+    def test_submit(self) -> None:
+        """ A URL is only added once, whatever its form.
+        """
+        frontier = URLFrontier(self.collection)
+        self.assertEqual(frontier.submit(self.urls, batch_size=3),
+                         {'added': 10, 'duplicates': 0})
+        self.assertEqual(frontier.submit(['http://WWW.bbc.com/news/1/',
+                                          'https://www.bbc.com/sport']),
+                         {'added': 1, 'duplicates': 1})
+
+    def test_claim(self) -> None:
+        """ The URLs are claimed by priority, then in the order they were
+            submitted, and are not claimed again once done.
+        """
+        frontier = URLFrontier(self.collection)
+        frontier.submit(self.urls[:5])
+        frontier.submit(self.urls[5:], priority=10)
+        claimed = frontier.claim(7)
+        self.assertEqual([entry['url'] for entry in claimed],
+                         self.urls[5:] + self.urls[:2])
+        for entry in claimed:
+            frontier.done(entry['_id'])
+        frontier.flush()
+        self.assertEqual(frontier.counts()[DONE], 7)
+        self.assertEqual(len(frontier.claim(10)), 3)
+
+    def test_leases(self) -> None:
+        """ The workers claim disjoint URLs, and the URLs of a worker whose
+            lease expired are claimed by the others.
+        """
+        URLFrontier(self.collection).submit(self.urls)
+        a = URLFrontier(self.collection, worker='a')
+        b = URLFrontier(self.collection, worker='b')
+        claimed_a = {entry['_id'] for entry in a.claim(6)}
+        claimed_b = {entry['_id'] for entry in b.claim(6)}
+        self.assertEqual((len(claimed_a), len(claimed_b)), (6, 4))
+        self.assertFalse(claimed_a & claimed_b)
+        self.assertEqual(b.claim(6), [])
+
+        # a dies, its leases expire
+        self.collection.update_many(
+            {'worker': 'a'},
+            {'$set': {'lease_expires': datetime.now(timezone.utc)
+                      - timedelta(seconds=1)}})
+        self.assertEqual({entry['_id'] for entry in b.claim(10)}, claimed_a)
+        self.assertEqual(b.reclaimed, 6)
+
+        for url_id in claimed_b:
+            b.done(url_id)
+        self.assertEqual(b.release(), 6)
+        self.assertEqual(b.counts(), {PENDING: 6, IN_FLIGHT: 0, DONE: 4,
+                                      RETRY: 0, FAILED: 0})
+
+    def test_stale_ack(self) -> None:
+        """ A worker whose lease expired does not ack the URLs reclaimed by
+            another worker, and does not wait for its own URLs once idle.
+        """
+        URLFrontier(self.collection).submit(self.urls[:2])
+        a = URLFrontier(self.collection, worker='a')
+        b = URLFrontier(self.collection, worker='b')
+        [entry, held] = a.claim(2)
+        self.assertEqual(a.in_flight(exclude_worker='a'), 0)
+        self.assertEqual(b.in_flight(exclude_worker='b'), 2)
+
+        self.collection.update_one(
+            {'_id': entry['_id']},
+            {'$set': {'lease_expires': datetime.now(timezone.utc)
+                      - timedelta(seconds=1)}})
+        self.assertEqual([e['_id'] for e in b.claim(2)], [entry['_id']])
+        a.done(entry['_id'])
+        a.flush()
+        self.assertEqual(self.collection.find_one(entry['_id'])['worker'], 'b')
+        self.assertEqual(a.counts()[IN_FLIGHT], 2)
+        a.done(held['_id'])
+        a.flush()
+        self.assertEqual(a.counts()[DONE], 1)
+
+    def test_retries(self) -> None:
+        """ A failed URL is retried after a backoff, until it failed
+            max_attempts times. A 404 is not retried.
+        """
+        frontier = URLFrontier(self.collection, max_attempts=2)
+        frontier.submit(self.urls[:2])
+        entry, missing = frontier.claim(2)
+        self.assertEqual(frontier.failed(entry['_id'], 'error', 503,
+                                         entry['attempts']), RETRY)
+        self.assertEqual(frontier.failed(missing['_id'], 'error', 404,
+                                         missing['attempts']), FAILED)
+        self.assertEqual(frontier.claim(2), [])
+
+        # the backoff is over
+        self.collection.update_many({}, {'$set': {
+            'retry_at': datetime.now(timezone.utc) - timedelta(seconds=1)}})
+        [entry] = frontier.claim(2)
+        self.assertEqual(entry['attempts'], 2)
+        self.assertEqual(frontier.failed(entry['_id'], 'error', 503,
+                                         entry['attempts']), FAILED)
+        frontier.flush()
+        self.assertEqual(
+            sorted((group['status'], group['count'], group['max_attempts'])
+                   for group in frontier.failure_report()),
+            [(404, 1, 1), (503, 1, 2)])
+
+    def test_backoff(self) -> None:
+        """ The delay doubles after each failure, with a jitter.
+        """
+        frontier = URLFrontier(self.collection, base_delay=60,
+                               max_delay=600)
+        for attempts, delay in ((1, 60), (2, 120), (3, 240), (10, 600)):
+            self.assertTrue(delay / 2 <= frontier.backoff(attempts) <= delay)
+
+    def test_refresh(self) -> None:
+        """ A refreshed URL is claimed again with the validators of its
+            last response.
+        """
+        frontier = URLFrontier(self.collection)
+        frontier.submit(self.urls[:2])
+        first, second = frontier.claim(2)
+        frontier.done(first['_id'], {'etag': '"v1"', 'length': 100})
+        frontier.done(second['_id'])
+        frontier.flush()
+        self.assertEqual(frontier.refresh(older_than=3600), 0)
+        self.assertEqual(frontier.refresh(), 2)
+        claimed = {entry['_id']: entry for entry in frontier.claim(2)}
+        self.assertTrue(all(entry['refresh'] for entry in claimed.values()))
+        self.assertEqual(claimed[first['_id']]['validators']['etag'], '"v1"')
+        self.assertNotIn('validators', claimed[second['_id']])
+
+
+class TestCrawlJobs(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.collection = mongomock.MongoClient().BBC[JOBS_COLLECTION]
+        self.jobs = CrawlJobs(self.collection, max_jobs=2)
+        self.jobs.ensure_indexes()
+        self.started = []
+
+    def start(self, job_id) -> int:
+        self.started.append(job_id)
+        return len(self.started)
+
+    def state(self, job) -> str:
+        return self.jobs.get(job['_id'])['state']
+
+    def test_slots(self) -> None:
+        """ At most max_jobs crawls run, whichever API worker dispatches
+            the jobs, and a finished job frees its slot for the next one.
+        """
+        jobs = [self.jobs.create() for _ in range(3)]
+        self.assertEqual(self.jobs.dispatch(self.start),
+                         [job['_id'] for job in jobs[:2]])
+        # another API worker
+        other = CrawlJobs(self.collection, max_jobs=2)
+        self.assertEqual(other.dispatch(self.start), [])
+        self.assertEqual(self.jobs.queue_position(jobs[2]), 0)
+
+        self.jobs.finish(jobs[0]['_id'], FINISHED)
+        self.assertEqual(other.dispatch(self.start), [jobs[2]['_id']])
+        self.assertEqual(self.jobs.get(jobs[2]['_id'])['slot'], 0)
+
+    def test_start_failure(self) -> None:
+        """ A job whose crawl could not be started fails and frees its slot.
+        """
+        job = self.jobs.create()
+
+        def start(job_id):
+            raise OSError('no scrapy')
+
+        self.assertEqual(self.jobs.dispatch(start), [])
+        self.assertEqual(self.state(job), 'failed')
+        self.assertNotIn('slot', self.jobs.get(job['_id']))
+
+    def test_cancel(self) -> None:
+        """ A queued job is cancelled at once, a running one stops at its
+            next progress report.
+        """
+        running = self.jobs.create()
+        self.jobs.dispatch(self.start)
+        self.jobs.max_jobs = 1
+        queued = self.jobs.create()
+
+        self.assertEqual(self.jobs.cancel(queued['_id'])['state'], CANCELLED)
+        job = self.jobs.cancel(running['_id'])
+        self.assertEqual((job['state'], job['cancel_requested']),
+                         (RUNNING, True))
+        self.assertTrue(self.jobs.heartbeat(running['_id'], {}))
+        self.assertIsNone(self.jobs.cancel('unknown'))
+
+    def test_reap_stale(self) -> None:
+        """ A running job that stopped reporting is failed, and its slot
+            given to the next queued job.
+        """
+        self.jobs.max_jobs = 1
+        lost = self.jobs.create()
+        self.jobs.dispatch(self.start)
+        self.assertFalse(self.jobs.heartbeat(lost['_id'], {'pages': 1}))
+        queued = self.jobs.create()
+        self.assertEqual(self.jobs.dispatch(self.start), [])
+
+        self.collection.update_one(
+            {'_id': lost['_id']},
+            {'$set': {'updated_at': datetime.now(timezone.utc)
+                      - timedelta(seconds=self.jobs.stale_seconds + 1)}})
+        self.assertEqual(self.jobs.dispatch(self.start), [queued['_id']])
+        self.assertEqual(self.jobs.get(lost['_id'])['reason'], 'lost')
+        self.assertEqual(self.state(queued), RUNNING)
+
+
+class TestSpider(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.spider = ArticleSpider.from_crawler(get_crawler(
+            ArticleSpider, {'MONGO_DATABASE': 'BBC', 'FRONTIER_WORKER': 'a'}))
+        self.addCleanup(self.spider.client.close)
+        self.spider.frontier = URLFrontier(
+            mongomock.MongoClient().BBC.frontier, worker='a')
+        self.spider.frontier.submit(['https://www.bbc.com/news/1'])
+        self.entry = self.spider.frontier.claim(1)[0]
+
+    def response(self) -> HtmlResponse:
+        return HtmlResponse(self.entry['url'], body=b'<html></html>',
+                            request=Request(self.entry['url'], meta={
+                                'frontier_id': self.entry['_id']}))
+
+    def assertRetried(self) -> None:
+        self.spider.frontier.flush()
+        self.assertEqual(self.spider.frontier.counts()[RETRY], 1)
+        self.assertEqual(self.spider.crawler.stats.get_value('parse/errors'),
+                         1)
+
+    def test_parse_error(self) -> None:
+        """ A page that could not be parsed is retried later instead of
+            staying in flight.
+        """
+        with mock.patch('news_crawler.spiders.articles.extract_page',
+                        side_effect=ValueError('bad page')), \
+                self.assertLogs(self.spider.name, 'ERROR'):
+            self.assertEqual(self.spider.parse(self.response()), [])
+        self.assertRetried()
+
+    def test_parse_pool_error(self) -> None:
+        """ The same for a page that failed in the parse pool.
+        """
+        self.spider.parse_pool = mock.Mock()
+        self.spider.parse_slots = defer.DeferredSemaphore(1)
+        results = []
+        with mock.patch.object(self.spider, '_submit',
+                               return_value=defer.fail(ValueError('bad'))), \
+                self.assertLogs(self.spider.name, 'ERROR'):
+            self.spider.parse(self.response()).addCallback(results.append)
+        self.assertEqual(results, [[]])
+        self.assertRetried()
+
+
+class TestDiscovery(unittest.TestCase):
+    """ Uses the sitemaps and feed of fixtures/discovery, which can also be
+        served with python -m http.server 8000 -d fixtures/discovery
+    """
+
+    def setUp(self) -> None:
+        db = mongomock.MongoClient().BBC
+        self.frontier = URLFrontier(db.frontier)
+        self.discovery = SourceDiscovery(db.discovery_sources, self.frontier)
+
+    def read(self, name) -> bytes:
+        with open(f'fixtures/discovery/{name}', 'rb') as file:
+            return file.read()
+
+    def test_parse_entries(self) -> None:
+        """ The gzipped sitemap index lists its sitemaps, with their lastmod.
+        """
+        with open_source(self.read('sitemap-index.xml.gz')) as stream:
+            entries = list(parse_entries(stream))
+        self.assertEqual([(kind, url) for kind, url, _ in entries],
+                         [(SITEMAP, 'http://localhost:8000/sitemap-news.xml'),
+                          (SITEMAP, 'http://localhost:8000/'
+                           + 'sitemap-2022-09.xml.gz')])
+        self.assertEqual(entries[0][2],
+                         datetime(2022, 10, 18, 9, 15, tzinfo=timezone.utc))
+
+        with open_source(self.read('rss.xml')) as stream:
+            entries = list(parse_entries(stream))
+        self.assertEqual({kind for kind, _, _ in entries}, {ARTICLE})
+        self.assertEqual(len(entries), 2)
+
+        # the loc of the image of an article is not its url
+        with open_source(self.read('sitemap-news.xml')) as stream:
+            entries = list(parse_entries(stream))
+        self.assertEqual(entries[0][1],
+                         'https://www.bbc.com/news/world-europe-63296318')
+
+    def test_max_size(self) -> None:
+        """ A gzipped source is not decompressed past max_size bytes.
+        """
+        body = gzip.compress(self.read('sitemap-news.xml'))
+        with open_source(body, max_size=512) as stream:
+            with self.assertRaises(SourceTooLarge):
+                list(parse_entries(stream))
+        with self.assertRaises(SourceTooLarge):
+            self.discovery.process('news', body, max_size=512)
+        self.assertEqual(self.discovery.status(), [])
+        counts = self.discovery.process(
+            'news', body, max_size=len(self.read('sitemap-news.xml')))
+        self.assertEqual(counts['added'], 3)
+
+    def test_watermarks(self) -> None:
+        """ Only the entries newer than the mark of the source are submitted,
+            and a sitemap is only fetched again when its index lastmod
+            changed.
+        """
+        index = self.discovery.process('index',
+                                       self.read('sitemap-index.xml.gz'))
+        self.assertEqual(len(index['sitemaps']), 2)
+        url, lastmod = index['sitemaps'][0]
+        news = self.discovery.process(url, self.read('sitemap-news.xml'),
+                                      listed_lastmod=lastmod)
+        self.assertEqual((news['new'], news['added']), (3, 3))
+        rss = self.discovery.process('rss', self.read('rss.xml'))
+        self.assertEqual((rss['new'], rss['added']), (2, 1))
+
+        self.assertEqual(self.discovery.process(
+            url, self.read('sitemap-news.xml'))['new'], 0)
+        self.assertEqual(self.discovery.process(
+            'index', self.read('sitemap-index.xml.gz'))['sitemaps'],
+            [index['sitemaps'][1]])
+        self.assertEqual(self.frontier.counts()[PENDING], 4)
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+
+    def setUp(self) -> None:
+        crawler = SimpleNamespace(settings=Settings())
+        crawler.stats = MemoryStatsCollector(crawler)
+        self.middleware = AdaptiveConcurrencyMiddleware(
+            crawler, max_concurrency=4, min_delay=0.5, delay_step=0.5,
+            target_latency=2.0)
+        self.slot = SimpleNamespace(delay=3.0, concurrency=1)
+        self.stats = crawler.stats
+
+    def test_additive_increase(self) -> None:
+        """ The delay goes down to its minimum, then the concurrency up to
+            its maximum, while the origin answers 200 quickly.
+        """
+        for _ in range(100):
+            self.middleware.observe('bbc.com', self.slot, 200, 0.3)
+        self.assertEqual((self.slot.delay, self.slot.concurrency), (0.5, 4))
+        self.assertEqual(self.stats.get_value('adaptive/bbc.com/concurrency'),
+                         4)
+        self.assertEqual(self.stats.get_value('adaptive/bbc.com/delay_ms'),
+                         500)
+
+    def test_multiplicative_decrease(self) -> None:
+        """ An error status of the origin halves the concurrency and
+            doubles the delay, once for the requests in flight.
+        """
+        self.slot.delay, self.slot.concurrency = 0.5, 4
+        # the response being processed and another one in flight
+        self.slot.active = {'request', 'other request'}
+        self.middleware.observe('bbc.com', self.slot, 503, 0.3)
+        self.middleware.observe('bbc.com', self.slot, 503, 0.3)
+        self.assertEqual((self.slot.delay, self.slot.concurrency), (1.0, 2))
+        self.assertEqual(self.stats.get_value('adaptive/bbc.com/decreases'),
+                         1)
+
+    def test_slow_origin(self) -> None:
+        """ A latency above the target backs off, even with 200.
+        """
+        self.middleware.observe('bbc.com', self.slot, 200, 5.0)
+        self.assertEqual(self.slot.delay, 6.0)
+
+
+class TestUserAgentPool(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.pool = UserAgentPool(['ua-1', 'ua-2', 'ua-3'], min_requests=4,
+                                  max_failure_rate=0.5, min_active=2)
+        crawler = SimpleNamespace(settings=Settings())
+        self.middleware = ShuffleUserAgentMiddleware(
+            MemoryStatsCollector(crawler), self.pool, sticky=True)
+
+    def test_rotation(self) -> None:
+        """ Each user agent is used once per turn of the rotation.
+        """
+        self.assertEqual(sorted(self.pool.next() for _ in range(3)),
+                         ['ua-1', 'ua-2', 'ua-3'])
+
+    def test_retirement(self) -> None:
+        """ A user agent failing too often leaves the rotation, until
+            min_active user agents are left.
+        """
+        for _ in range(4):
+            self.pool.record('ua-1', True)
+            self.pool.record('ua-2', False)
+            self.pool.record('ua-3', True)
+        self.assertEqual(self.pool.retired, {'ua-1'})
+        self.assertEqual({self.pool.next() for _ in range(4)},
+                         {'ua-2', 'ua-3'})
+        report = {row['user_agent']: row for row in self.pool.report()}
+        self.assertEqual(report['ua-3']['failure_rate'], 1.0)
+        self.assertFalse(report['ua-3']['retired'])
+
+    def test_sticky(self) -> None:
+        """ A domain keeps its user agent until it is retired.
+        """
+        requests = [Request('https://www.bbc.com/news/' + str(i))
+                    for i in range(3)]
+        for request in requests:
+            self.middleware.process_request(request, None)
+        u_agent = requests[0].meta['user_agent']
+        self.assertEqual({request.headers['User-Agent'].decode()
+                          for request in requests}, {u_agent})
+        for _ in range(4):
+            self.pool.record(u_agent, True)
+        request = Request('https://www.bbc.com/news/3')
+        self.middleware.process_request(request, None)
+        self.assertNotEqual(request.meta['user_agent'], u_agent)
+
+    def test_stats(self) -> None:
+        """ The stats of a user agent are named after it, not after its
+            rank in the report.
+        """
+        self.pool.record('ua-1', False)
+        for _ in range(2):
+            self.pool.record('ua-2', True)
+        self.middleware.spider_closed(SimpleNamespace(
+            name='test', logger=logging.getLogger('test')))
+        stats = self.middleware.stats
+        self.assertEqual(stats.get_value(f"user_agent/{agent_id('ua-2')}/"
+                                         + 'failures'), 2)
+        self.assertEqual(stats.get_value(f"user_agent/{agent_id('ua-1')}/"
+                                         + 'requests'), 1)
+        self.assertNotEqual(agent_id('ua-1'), agent_id('ua-2'))
+
+
+class TestLogging(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.stream = io.StringIO()
+        self.handler = logging.StreamHandler(self.stream)
+        self.logger = logging.getLogger('test.logging')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self) -> None:
+        self.logger.removeHandler(self.handler)
+
+    def test_rate_limit(self) -> None:
+        """ A rate limited event is kept limit times per second, the other
+            events are all kept.
+        """
+        now = [0.0]
+        event_filter = EventFilter(rate_limits={'response': 2},
+                                   clock=lambda: now[0])
+        kept = [event_filter.keep('response') for _ in range(4)]
+        now[0] = 0.5
+        kept.append(event_filter.keep('response'))
+        self.assertEqual(kept, [True, True, False, False, True])
+        self.assertTrue(all(event_filter.keep('parse') for _ in range(4)))
+        self.assertEqual(event_filter.dropped, {'response': 2})
+
+    def test_queued_json(self) -> None:
+        """ The records are written as JSON lines by the background thread,
+            with the fields of their event, and the sampled events are
+            dropped, but not the warnings nor the records of no event.
+        """
+        logging_queue = QueuedLogging(self.logger, [self.handler],
+                                      json_format=True,
+                                      sample_rates={'response': 0})
+        logging_queue.start()
+        events = EventLogger(self.logger)
+        events.info('request', 'Getting %s', 'https://www.bbc.com/news/1',
+                    url='https://www.bbc.com/news/1')
+        events.info('response', 'GET %s 200', 'https://www.bbc.com/news/1')
+        events.warning('response', 'GET %s 503', 'https://www.bbc.com/news/2',
+                       status=503)
+        # not an event, even if its message is the name of one
+        self.logger.info('response')
+        logging_queue.stop()
+
+        lines = [json.loads(line)
+                 for line in self.stream.getvalue().splitlines()]
+        self.assertEqual([line['message'] for line in lines],
+                         ['Getting https://www.bbc.com/news/1',
+                          'GET https://www.bbc.com/news/2 503', 'response'])
+        self.assertEqual(lines[0]['event'], 'request')
+        self.assertEqual(lines[0]['url'], 'https://www.bbc.com/news/1')
+        self.assertEqual(lines[1]['status'], 503)
+        self.assertEqual(logging_queue.dropped(), {'response': 1})
+        # the handler is given back to the logger
+        self.assertEqual(self.logger.handlers, [self.handler])
+        self.assertIsNone(self.handler.formatter)
+
+
+class APITestCase(unittest.TestCase):
+    """ Runs the API on mongomock, with its own SQLite tables and caches.
+    """
+
+    def setUp(self) -> None:
+        self.mongo = mongomock.MongoClient()
+        for patcher in (
+                mock.patch.object(api._conf, 'get_client',
+                                  return_value=self.mongo),
+                mock.patch.object(api, 'revoked_tokens',
+                                  api.RevokedTokenCache()),
+                mock.patch.object(api, 'response_cache',
+                                  api.ResponseCache())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        context = api.app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        api.db.create_all()
+        self.addCleanup(api.db.drop_all)
+        self.addCleanup(api.db.session.remove)
+        self.client = api.app.test_client()
+        self.headers = {'Authorization': 'Bearer '
+                        + create_access_token(identity='test')}
+
+
+class TestPagination(APITestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.ids = [str(article_id) for article_id in
+                    self.mongo.BBC.articles.insert_many(
+                        [{'article_url': f'https://www.bbc.com/news/{i}'}
+                         for i in range(5)]).inserted_ids]
+
+    def get_all(self, query) -> object:
+        return self.client.get(f'/api/get-all?{query}', headers=self.headers)
+
+    def page_ids(self, response) -> list:
+        return [article['_id']['$oid']
+                for article in response.get_json()['data']]
+
+    def stream_ids(self, response) -> list:
+        return [json.loads(line)['_id']['$oid']
+                for line in response.get_data().splitlines()]
+
+    def test_pages(self) -> None:
+        """ The next link follows the last article of a page, and is only
+            given when there is a next page.
+        """
+        response = self.get_all('limit=2')
+        self.assertEqual(self.page_ids(response), self.ids[:2])
+        next_url = response.get_json()['next']
+        self.assertIn(f'after={self.ids[1]}', next_url)
+        response = self.client.get(next_url, headers=self.headers)
+        self.assertEqual(self.page_ids(response), self.ids[2:4])
+
+        # the last page is full, but there is no article after it
+        response = self.get_all(f'limit=2&after={self.ids[2]}')
+        self.assertEqual(self.page_ids(response), self.ids[3:])
+        self.assertIsNone(response.get_json()['next'])
+        self.assertIsNone(self.get_all('').get_json()['next'])
+        self.assertEqual(self.get_all(f'after={self.ids[4]}').status_code,
+                         404)
+
+    def test_bad_arguments(self) -> None:
+        for query in ('after=1234', 'limit=0', 'limit=-1', 'limit=x',
+                      'stream=1&limit=0'):
+            self.assertEqual(self.get_all(query).status_code, 400, query)
+
+    def test_stream(self) -> None:
+        """ stream=1 returns all the articles as NDJSON, whatever the batch
+            size.
+        """
+        with mock.patch.dict(api.app.config, {'API_STREAM_BATCH_SIZE': 2}):
+            response = self.get_all('stream=1')
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            self.assertEqual(self.stream_ids(response), self.ids)
+            response = self.get_all(f'stream=1&limit=2&after={self.ids[0]}')
+            self.assertEqual(self.stream_ids(response), self.ids[1:3])
+
+
+class TestRevokedTokens(APITestCase):
+
+    def test_revoked_after_prune(self) -> None:
+        """ A token revoked after the expired ones were deleted is still
+            seen by the other workers, its id is not one they already read.
+        """
+        for jti in ('expired-1', 'expired-2'):
+            api.RevokedTokenModel(jti=jti, expires=100).add()
+        worker = api.RevokedTokenCache()
+        worker.refresh(200)
+        self.assertEqual(worker.last_id, 2)
+
+        # another worker deletes the expired tokens, then one is revoked
+        pruning = api.RevokedTokenCache()
+        pruning.refresh(200)
+        api.RevokedTokenModel(jti='revoked', expires=10 ** 10).add()
+
+        worker.next_refresh = 0
+        self.assertTrue(worker.is_revoked('revoked'))
+
+    def test_revoke(self) -> None:
+        """ A revoked token is rejected right away.
+        """
+        response = self.client.post('/token/revoke', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/token/revoke', headers=self.headers)
+        self.assertEqual(response.status_code, 401)
+
+
+class TestResponseCache(APITestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.mongo.BBC.articles.insert_many(
+            [{'headline': f'Headline {i}'} for i in range(3)])
+
+    def get_all(self, headers=None, **kwargs):
+        return self.client.get('/api/get-all?limit=2',
+                               headers={**self.headers, **(headers or {})},
+                               **kwargs)
+
+    def test_hit_and_invalidation(self) -> None:
+        """ The same query is served from the cache until the pipeline bumps
+            the version of the articles.
+        """
+        first = self.get_all()
+        self.mongo.BBC.articles.delete_many({})
+        self.assertEqual(self.get_all().get_data(), first.get_data())
+
+        versions.bump_version(self.mongo.BBC, 'articles')
+        api.response_cache.next_version_check = 0
+        self.assertEqual(self.get_all().status_code, 404)
+
+    def test_etag(self) -> None:
+        """ A request with the ETag of the cached response gets a 304.
+        """
+        etag = self.get_all().headers['ETag']
+        response = self.get_all(headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+
+    def test_host(self) -> None:
+        """ The next link of a cached page points to the host the request
+            was sent to.
+        """
+        for host in ('api.example.com', 'localhost:5000'):
+            page = json.loads(self.get_all(base_url=f'http://{host}')
+                              .get_data())
+            self.assertTrue(page['next'].startswith(f'http://{host}/'))
+
+
+class TestJobsAPI(APITestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        api.get_jobs().ensure_indexes()
+        patcher = mock.patch('news_crawler.jobs.subprocess.Popen')
+        self.popen = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.popen.return_value.pid = 1234
+        self.popen.return_value.poll.return_value = None
+
+    def test_scrape(self) -> None:
+        """ /scrape starts a crawl at once when a slot is free, and queues
+            the job otherwise.
+        """
+        response = self.client.get('/scrape', headers=self.headers)
+        self.assertEqual(response.status_code, 202)
+        job = response.get_json()
+        self.assertEqual(job['state'], RUNNING)
+        self.assertEqual(response.headers['Location'], job['status_url'])
+        self.assertIn(f"CRAWL_JOB_ID={job['job_id']}",
+                      self.popen.call_args[0][0])
+
+        queued = self.client.get('/scrape', headers=self.headers).get_json()
+        self.assertEqual((queued['state'], queued['queue_position']),
+                         (QUEUED, 0))
+        self.assertEqual(self.popen.call_count, 1)
+
+    def test_cancel(self) -> None:
+        """ Cancelling the running job only flags it, the queued one is
+            cancelled at once.
+        """
+        running = self.client.get('/scrape', headers=self.headers).get_json()
+        queued = self.client.get('/scrape', headers=self.headers).get_json()
+        response = self.client.post(f"/jobs/{queued['job_id']}/cancel",
+                                    headers=self.headers)
+        self.assertEqual(response.get_json()['state'], CANCELLED)
+        response = self.client.post(f"/jobs/{running['job_id']}/cancel",
+                                    headers=self.headers)
+        self.assertTrue(response.get_json()['cancel_requested'])
+        self.assertEqual(self.client.post('/jobs/unknown/cancel',
+                                          headers=self.headers).status_code,
+                         404)
+        self.assertEqual(
+            [job['state'] for job in self.client.get(
+                '/jobs', headers=self.headers).get_json()],
+            [CANCELLED, RUNNING])
+
+    def test_refresh(self) -> None:
+        """ /scrape?refresh=1 fetches again the URLs crawled more than
+            refresh_older_than hours ago, and starts no job on errors.
+        """
+        frontier = api.get_frontier()
+        frontier.submit(['https://www.bbc.com/news/1',
+                         'https://www.bbc.com/news/2'])
+        old, recent = frontier.claim(2)
+        frontier.done(old['_id'])
+        frontier.done(recent['_id'])
+        frontier.flush()
+        frontier.collection.update_one(
+            {'_id': old['_id']},
+            {'$set': {'updated_at': datetime.now(timezone.utc)
+                      - timedelta(hours=2)}})
+
+        for value in ('x', '-1', 'nan'):
+            response = self.client.get(
+                f'/scrape?refresh=1&refresh_older_than={value}',
+                headers=self.headers)
+            self.assertEqual(response.status_code, 400)
+        response = self.client.get('/scrape?refresh=1&refresh_older_than=1',
+                                   headers=self.headers)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(frontier.counts()[PENDING], 1)
+
+        with mock.patch.object(URLFrontier, 'refresh',
+                               side_effect=PyMongoError('down')):
+            response = self.client.get('/scrape?refresh=1',
+                                       headers=self.headers)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.popen.call_count, 1)
+
 
 if __name__ == '__main__':
     unittest.main()